@@ -0,0 +1,58 @@
+"""
+Benchmarks for making provenance in memory.
+"""
+from desc_provenance import Provenance
+from .common import make_provenance
+import os
+import tempfile
+
+
+class Generate:
+    def time_generate(self):
+        Provenance().generate()
+
+    def peakmem_generate(self):
+        Provenance().generate()
+
+
+class Copy:
+    params = [[10, 1000, 100000], [0, 1000000]]
+    param_names = ["nkeys", "diff_bytes"]
+
+    def setup(self, nkeys, diff_bytes):
+        self.p = make_provenance(nkeys, diff_bytes)
+
+    def time_copy(self, nkeys, diff_bytes):
+        self.p.copy()
+
+    def time_copy_and_specialize(self, nkeys, diff_bytes):
+        # The usual pattern of making one copy per output
+        for i in range(100):
+            q = self.p.copy()
+            q["config", "output"] = i
+
+
+class InputFanIn:
+    # Recording many inputs that each have their own provenance
+    params = [[1, 10, 100], ["hdf", "yml", "prov"]]
+    param_names = ["ninputs", "format"]
+
+    def setup(self, ninputs, fmt):
+        self.tmp = tempfile.TemporaryDirectory()
+        p = make_provenance(100)
+        self.inputs = {}
+        for i in range(ninputs):
+            path = os.path.join(self.tmp.name, f"input_{i}.{fmt}")
+            p.write(path)
+            self.inputs[f"input_{i}"] = path
+
+    def teardown(self, ninputs, fmt):
+        self.tmp.cleanup()
+
+    def time_add_input_file(self, ninputs, fmt):
+        p = Provenance()
+        for name, path in self.inputs.items():
+            p.add_input_file(name, path)
+
+    def time_add_input_files(self, ninputs, fmt):
+        Provenance().add_input_files(self.inputs)
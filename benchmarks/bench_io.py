@@ -0,0 +1,96 @@
+"""
+Benchmarks for writing and reading each type of file.
+"""
+from desc_provenance import Provenance, git
+from .common import formats, make_provenance
+import os
+import tempfile
+import itertools
+
+
+class _FileSuite:
+    # Each benchmark gets a fresh directory, holding one file written
+    # in setup for the read benchmarks
+    def make_files(self, fmt, p):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fmt = fmt
+        self.p = p
+        self.counter = itertools.count()
+        self.existing = os.path.join(self.tmp.name, f"existing.{fmt}")
+        p.write(self.existing)
+
+    def new_path(self):
+        # Writers add to existing files, so always write to a new one
+        return os.path.join(self.tmp.name, f"new_{next(self.counter)}.{self.fmt}")
+
+    def teardown(self, *params):
+        self.tmp.cleanup()
+
+
+class Items(_FileSuite):
+    # Provenance with many items
+    params = [formats, [10, 1000, 100000]]
+    param_names = ["format", "nkeys"]
+    timeout = 300
+
+    def setup(self, fmt, nkeys):
+        # Reading a whole FITS header takes time quadratic in its size, so
+        # this would take hours.  Each item also needs three cards, beyond
+        # what most FITS readers will handle.
+        if fmt == "fits" and nkeys > 10000:
+            raise NotImplementedError("Too many items for a FITS header")
+        self.make_files(fmt, make_provenance(nkeys))
+        self.last_key = f"item_{nkeys - 1}"
+
+    def time_write(self, fmt, nkeys):
+        self.p.write(self.new_path())
+
+    def time_read(self, fmt, nkeys):
+        Provenance().read(self.existing)
+
+    def time_get_first(self, fmt, nkeys):
+        Provenance.get(self.existing, "git", "head")
+
+    def time_get_last(self, fmt, nkeys):
+        Provenance.get(self.existing, "config", self.last_key)
+
+    def peakmem_read(self, fmt, nkeys):
+        Provenance().read(self.existing)
+
+
+class Diff(_FileSuite):
+    # Provenance with a large git diff, which is stored as a long
+    # multi-line string
+    params = [formats, [0, 10000, 1000000], [None, "zlib"]]
+    param_names = ["format", "diff_bytes", "compression"]
+    timeout = 300
+
+    def setup(self, fmt, diff_bytes, compression):
+        p = make_provenance(100, diff_bytes)
+        # Store the diff as generate would
+        capture = git.DiffCapture(max_bytes=None, compression=compression)
+        capture.update(p["git", "diff"].encode())
+        for key, value in capture.finish().items():
+            p["git", key] = value
+        self.make_files(fmt, p)
+
+    def time_write(self, fmt, diff_bytes, compression):
+        self.p.write(self.new_path())
+
+    def time_get_diff(self, fmt, diff_bytes, compression):
+        Provenance.get(self.existing, "git", "diff")
+
+    def time_get_head(self, fmt, diff_bytes, compression):
+        Provenance.get(self.existing, "git", "head")
+
+
+class WriteMany(_FileSuite):
+    params = [["hdf", "yml", "prov"], [1, 8]]
+    param_names = ["format", "max_workers"]
+
+    def setup(self, fmt, max_workers):
+        self.make_files(fmt, make_provenance(1000))
+
+    def time_write_many(self, fmt, max_workers):
+        paths = [self.new_path() for i in range(20)]
+        self.p.write_many(paths, max_workers=max_workers)
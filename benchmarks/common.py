@@ -0,0 +1,64 @@
+"""
+Synthetic provenance used by the benchmarks.
+"""
+from desc_provenance import Provenance
+import random
+import string
+
+# Suffixes of each of the file types that the I/O benchmarks cover
+formats = ["hdf", "fits", "yml", "pkl", "prov"]
+
+
+def random_text(rng, n):
+    return "".join(rng.choice(string.ascii_letters) for _ in range(n))
+
+
+def make_diff(rng, nbytes):
+    # Something that looks roughly like a git diff, in 80 character lines
+    lines = []
+    size = 0
+    while size < nbytes:
+        line = rng.choice("+- ") + random_text(rng, 79)
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def make_provenance(nkeys, diff_bytes=0, multiline_fraction=0.01, seed=1):
+    """Make provenance with roughly the mix of items seen in practice.
+
+    Parameters
+    ----------
+    nkeys: int
+        Number of config items, which make up the bulk of large provenance
+
+    diff_bytes: int
+        Size of the git diff to include
+
+    multiline_fraction: float
+        Fraction of the config items that are multi-line strings
+
+    seed: int
+        Seed for the random values, so every run uses the same provenance
+
+    Returns
+    -------
+    Provenance
+    """
+    rng = random.Random(seed)
+    p = Provenance()
+    p["git", "head"] = "%040x" % rng.getrandbits(160)
+    p["git", "diff"] = make_diff(rng, diff_bytes)
+    for i in range(nkeys):
+        x = rng.random()
+        if x < multiline_fraction:
+            value = "\n".join(random_text(rng, 60) for _ in range(5))
+        elif x < 0.4:
+            value = random_text(rng, 20)
+        elif x < 0.7:
+            value = rng.randint(-1000000, 1000000)
+        else:
+            value = rng.random()
+        p["config", f"item_{i}"] = value
+    p.comments.append("Synthetic provenance for benchmarking")
+    return p
@@ -0,0 +1,324 @@
+"""
+A compact binary format for provenance files, with suffix .prov.
+
+These are quick to write and can be memory-mapped, so that a single
+item can be found without reading the rest of the file.  The layout is:
+
+- a fixed-size header (see header_format) giving the number of items
+  and the position and size of each of the blocks below
+- a string table, with each section and key name stored once
+- the values, each stored as raw bytes according to its type
+- the comments, as a JSON list
+- an index with a fixed-size entry (see entry_format) for each item, in
+  the order they were written, giving the location of its section and key
+  names in the string table, its type, and the location of its value
+- the numbers of the index entries sorted by section and then key, as
+  4-byte integers, so that items can be found by binary search
+
+All numbers are little-endian.  Offsets to the strings and values are
+relative to the start of their blocks.
+"""
+from . import errors
+import json
+import mmap
+import sys
+import struct
+import numbers
+import contextlib
+
+magic = b"DESCPROV"
+format_version = 1
+
+# magic, version, number of items, then the offset and length of the
+# strings, values, comments, and index blocks, and the offset of the
+# sorted order
+header_format = struct.Struct("<8sII9Q")
+
+# section offset and length, key offset and length, value type, then
+# the value offset and length
+entry_format = struct.Struct("<IIIIB3xQQ")
+
+order_format = struct.Struct("<I")
+
+# Value types
+type_none = 0
+type_bool = 1
+type_int = 2
+type_float = 3
+type_str = 4
+type_json = 5
+
+_int64 = struct.Struct("<q")
+_float64 = struct.Struct("<d")
+
+
+def _is_numpy_bool(value):
+    # Numpy values can only exist if numpy has already been imported,
+    # so we can avoid importing it ourselves.
+    np = sys.modules.get("numpy")
+    return np is not None and isinstance(value, np.bool_)
+
+
+def _encode_value(value):
+    # Return the type code and bytes for a value
+    if value is None:
+        return type_none, b""
+    if isinstance(value, bool) or _is_numpy_bool(value):
+        return type_bool, b"\x01" if value else b"\x00"
+    if isinstance(value, numbers.Integral):
+        value = int(value)
+        if -(2**63) <= value < 2**63:
+            return type_int, _int64.pack(value)
+        return type_json, json.dumps(value).encode("utf-8")
+    if isinstance(value, numbers.Real):
+        return type_float, _float64.pack(float(value))
+    if isinstance(value, str):
+        return type_str, value.encode("utf-8")
+    # Lists and other structures that can be stored as JSON, and strings
+    # for anything else, as in the other formats
+    try:
+        return type_json, json.dumps(value).encode("utf-8")
+    except TypeError:
+        return type_str, str(value).encode("utf-8")
+
+
+def _decode_value(code, data):
+    if code == type_none:
+        return None
+    if code == type_bool:
+        return data != b"\x00"
+    if code == type_int:
+        return _int64.unpack(data)[0]
+    if code == type_float:
+        return _float64.unpack(data)[0]
+    if code == type_str:
+        return data.decode("utf-8")
+    if code == type_json:
+        return json.loads(data.decode("utf-8"))
+    raise errors.ProvenanceFileSchemeUnsupported(f"Unknown value type {code}")
+
+
+def encode(provenance, comments):
+    """Encode provenance in the binary format.
+
+    Parameters
+    ----------
+    provenance: dict
+        Maps (section, key) to values
+
+    comments: list
+        Comment strings
+
+    Returns
+    -------
+    bytes
+    """
+    strings = bytearray()
+    string_locations = {}
+
+    def intern(name):
+        loc = string_locations.get(name)
+        if loc is None:
+            data = name.encode("utf-8")
+            loc = (len(strings), len(data))
+            strings.extend(data)
+            string_locations[name] = loc
+        return loc
+
+    values = bytearray()
+    index = bytearray()
+    names = []
+    for (section, key), value in provenance.items():
+        section_loc = intern(section)
+        key_loc = intern(key)
+        code, data = _encode_value(value)
+        index.extend(
+            entry_format.pack(*section_loc, *key_loc, code, len(values), len(data))
+        )
+        values.extend(data)
+        names.append((section.encode("utf-8"), key.encode("utf-8")))
+
+    order = sorted(range(len(names)), key=names.__getitem__)
+    order = b"".join(order_format.pack(i) for i in order)
+    comments = json.dumps(list(comments)).encode("utf-8")
+
+    strings_offset = header_format.size
+    values_offset = strings_offset + len(strings)
+    comments_offset = values_offset + len(values)
+    index_offset = comments_offset + len(comments)
+    order_offset = index_offset + len(index)
+
+    header = header_format.pack(
+        magic,
+        format_version,
+        len(names),
+        strings_offset,
+        len(strings),
+        values_offset,
+        len(values),
+        comments_offset,
+        len(comments),
+        index_offset,
+        len(index),
+        order_offset,
+    )
+    return b"".join([header, strings, values, comments, index, order])
+
+
+@contextlib.contextmanager
+def _corrupt_data():
+    # Reading past the end of truncated or corrupt data raises struct.error
+    try:
+        yield
+    except struct.error as e:
+        raise errors.ProvenanceFileSchemeUnsupported(
+            f"Corrupt or truncated .prov file: {e}"
+        ) from e
+
+
+class ProvReader:
+    """Read provenance from data in the binary format.
+
+    Nothing is decoded until it is asked for, so this works well with
+    memory-mapped files.
+
+    Parameters
+    ----------
+    data: bytes-like
+        The complete file contents, e.g. an mmap.mmap object
+    """
+
+    def __init__(self, data):
+        self.data = data
+        if len(data) < header_format.size:
+            raise errors.ProvenanceFileSchemeUnsupported("File is too short")
+        with _corrupt_data():
+            header = header_format.unpack_from(data, 0)
+        (
+            file_magic,
+            version,
+            self.nitem,
+            self.strings_offset,
+            _,
+            self.values_offset,
+            _,
+            self.comments_offset,
+            self.comments_length,
+            self.index_offset,
+            _,
+            self.order_offset,
+        ) = header
+        if file_magic != magic:
+            raise errors.ProvenanceFileSchemeUnsupported("Not a .prov file")
+        if version > format_version:
+            raise errors.ProvenanceFileSchemeUnsupported(
+                f"Unsupported .prov format version {version}"
+            )
+
+    def _entry(self, i):
+        return entry_format.unpack_from(
+            self.data, self.index_offset + i * entry_format.size
+        )
+
+    def _string(self, offset, length):
+        start = self.strings_offset + offset
+        return bytes(self.data[start : start + length])
+
+    def _value(self, entry):
+        start = self.values_offset + entry[5]
+        return _decode_value(entry[4], bytes(self.data[start : start + entry[6]]))
+
+    def get(self, section, key):
+        """Get a single item, by binary search.
+
+        Parameters
+        ----------
+        section: str
+
+        key: str
+
+        Returns
+        -------
+        value
+        """
+        target = (section.encode("utf-8"), key.encode("utf-8"))
+        lo, hi = 0, self.nitem
+        with _corrupt_data():
+            while lo < hi:
+                mid = (lo + hi) // 2
+                (i,) = order_format.unpack_from(
+                    self.data, self.order_offset + mid * order_format.size
+                )
+                entry = self._entry(i)
+                name = (
+                    self._string(entry[0], entry[1]),
+                    self._string(entry[2], entry[3]),
+                )
+                if name == target:
+                    return self._value(entry)
+                if name < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        raise errors.ProvenanceMissingItem(f"{section}/{key}")
+
+    def items(self):
+        """Decode every item, in the order they were written.
+
+        Returns
+        -------
+        dict
+            Maps (section, key) to values
+        """
+        d = {}
+        with _corrupt_data():
+            for i in range(self.nitem):
+                entry = self._entry(i)
+                section = self._string(entry[0], entry[1]).decode("utf-8")
+                key = self._string(entry[2], entry[3]).decode("utf-8")
+                d[section, key] = self._value(entry)
+        return d
+
+    def comments(self):
+        """Decode the comments.
+
+        Returns
+        -------
+        list
+        """
+        start = self.comments_offset
+        return json.loads(bytes(self.data[start : start + self.comments_length]))
+
+
+@contextlib.contextmanager
+def open_reader(prov_file):
+    """Open a .prov file for reading, memory-mapping it if possible.
+
+    Parameters
+    ----------
+    prov_file: str or pathlib.Path or binary file object
+
+    Yields
+    ------
+    ProvReader
+    """
+    if isinstance(prov_file, (bytes, bytearray)):
+        yield ProvReader(prov_file)
+        return
+
+    f = open(prov_file, "rb") if not hasattr(prov_file, "read") else prov_file
+    try:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # e.g. in-memory files or empty files, which can't be mapped
+            f.seek(0)
+            data = f.read()
+        try:
+            yield ProvReader(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    finally:
+        if f is not prov_file:
+            f.close()
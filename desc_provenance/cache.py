@@ -0,0 +1,433 @@
+"""
+Caching of provenance read from files.
+
+Provenance read by Provenance.get and Provenance.read can be cached, so that
+files that have not changed are never re-opened.  Entries are keyed on the
+path to the file and its device, inode, size, and modification time, so a
+changed file is always re-read.
+
+There are two tiers: an in-memory LRU cache for this process, and an optional
+SQLite database on disk that several processes can share.
+
+The cache is off by default; use Provenance.enable_cache to switch it on.
+"""
+from . import errors
+import os
+import sys
+import json
+import time
+import threading
+import collections
+
+_active = None
+
+
+def enable(
+    max_entries=1024, max_bytes=256 * 2**20, sqlite_path=None, sqlite_max_entries=100000
+):
+    """Switch on caching of provenance read from files.
+
+    See ProvenanceCache for the parameters.
+
+    Returns
+    -------
+    ProvenanceCache
+        The new cache
+    """
+    global _active
+    _active = ProvenanceCache(
+        max_entries=max_entries,
+        max_bytes=max_bytes,
+        sqlite_path=sqlite_path,
+        sqlite_max_entries=sqlite_max_entries,
+    )
+    return _active
+
+
+def disable():
+    """Switch off caching of provenance read from files."""
+    global _active
+    _active = None
+
+
+def active():
+    """Return the active ProvenanceCache, or None if caching is off."""
+    return _active
+
+
+def invalidate(filename):
+    """Forget anything cached about a file, if caching is on.
+
+    Parameters
+    ----------
+    filename: str or pathlib.Path
+    """
+    cache = _active
+    if cache is not None:
+        cache.invalidate(filename)
+
+
+def file_signature(filename):
+    """Return the key used to cache provenance from a file.
+
+    Parameters
+    ----------
+    filename: str or pathlib.Path
+
+    Returns
+    -------
+    tuple or None
+        (path, device, inode, size, mtime in ns), or None if the
+        file can't be found.
+    """
+    path = os.path.abspath(filename)
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None
+    return (path, s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns)
+
+
+def _size(value):
+    # A rough estimate of the memory used by a value, including anything
+    # it contains
+    n = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        n += sum(_size(v) for v in value)
+    elif isinstance(value, dict):
+        n += sum(_size(k) + _size(v) for k, v in value.items())
+    return n
+
+
+class _Entry:
+    # The provenance we know about for one file.  If complete is False
+    # then items holds only the items that have been asked for so far.
+    # nbytes is a rough estimate of the memory it uses.
+    __slots__ = ["items", "comments", "complete", "nbytes"]
+
+    def __init__(self, items, comments, complete, nbytes=None):
+        self.items = items
+        self.comments = comments
+        self.complete = complete
+        if nbytes is None:
+            nbytes = _size(items) + _size(comments)
+        self.nbytes = nbytes
+
+
+class MemoryCache:
+    """An in-memory LRU cache of provenance, keyed by file signature.
+
+    Parameters
+    ----------
+    max_entries: int
+        Maximum number of files to keep
+
+    max_bytes: int
+        Maximum total memory to use, across all files, roughly estimated
+        from the sizes of the keys and values
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, signature):
+        with self._lock:
+            entry = self._entries.get(signature[0])
+            if entry is None or entry[0] != signature:
+                return None
+            self._entries.move_to_end(signature[0])
+            return entry[1]
+
+    def put(self, signature, entry):
+        with self._lock:
+            old = self._entries.pop(signature[0], None)
+            if old is not None:
+                self._nbytes -= old[1].nbytes
+            self._entries[signature[0]] = (signature, entry)
+            self._nbytes += entry.nbytes
+
+            # Evict the least recently used entries, but always
+            # keep the new one
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._nbytes > self.max_bytes
+            ):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+
+    def invalidate(self, path):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._nbytes -= old[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+def _json_value(value):
+    # Convert a value to one that JSON stores and reads back as an equal
+    # value of the same type, or raise TypeError if there isn't one
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if type(value) is list:
+        return [_json_value(v) for v in value]
+    if type(value) is dict and all(isinstance(k, str) for k in value):
+        return {k: _json_value(v) for k, v in value.items()}
+    # numpy scalars, which come from HDF5 files, are converted to the
+    # equivalent python types.  Arrays and bytes can't be stored.
+    if getattr(value, "ndim", None) == 0 and hasattr(value, "item"):
+        v = value.item()
+        if isinstance(v, (bool, int, float, str)):
+            return v
+    raise TypeError(f"Cannot store {type(value).__name__} values as JSON")
+
+
+class SQLiteCache:
+    """A cache of provenance in an SQLite database, which can be shared
+    between processes.
+
+    Values are stored as JSON, so numpy scalars are read back as
+    the corresponding python types.  Provenance with values that JSON
+    can't store exactly, like arrays, bytes, or tuples, is not stored.
+
+    Parameters
+    ----------
+    path: str
+        The database file, which is created if needed
+
+    max_entries: int
+        Maximum number of files to keep.  The least recently used are removed
+        when this is exceeded.
+    """
+
+    # Reading an entry only records that it was used if this many seconds
+    # have passed since that was last recorded, so that reads seldom need
+    # to lock the database for writing
+    access_interval = 600.0
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS provenance (
+            path TEXT PRIMARY KEY,
+            dev INTEGER,
+            ino INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            complete INTEGER,
+            items TEXT,
+            comments TEXT,
+            accessed REAL
+        );
+        CREATE INDEX IF NOT EXISTS provenance_accessed ON provenance (accessed);
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().executescript(self._schema)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or processes,
+        # so we make one for each.
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, "pid", None) != pid:
+            import sqlite3
+
+            local.connection = sqlite3.connect(self.path, timeout=30)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.pid = pid
+        return local.connection
+
+    def get(self, signature):
+        db = self._connection()
+        row = db.execute(
+            "SELECT dev, ino, size, mtime_ns, complete, items, comments, accessed "
+            "FROM provenance WHERE path = ?",
+            (signature[0],),
+        ).fetchone()
+        if row is None or tuple(row[:4]) != signature[1:]:
+            return None
+        now = time.time()
+        if now - row[7] > self.access_interval:
+            self._touch(db, signature[0], now)
+        items = {(s, k): v for s, k, v in json.loads(row[5])}
+        comments = json.loads(row[6]) if row[6] is not None else None
+        return _Entry(items, comments, bool(row[4]))
+
+    def _touch(self, db, path, now):
+        # Record that an entry was used.  This is only a hint for trimming,
+        # so it is skipped if the database stays locked by other processes.
+        import sqlite3
+
+        try:
+            with db:
+                db.execute(
+                    "UPDATE provenance SET accessed = ? WHERE path = ?", (now, path)
+                )
+        except sqlite3.OperationalError:
+            pass
+
+    def put(self, signature, entry):
+        try:
+            items = [[s, k, _json_value(v)] for (s, k), v in entry.items.items()]
+            comments = None if entry.comments is None else _json_value(entry.comments)
+        except TypeError:
+            # Leave these to the in-memory cache
+            return
+        items = json.dumps(items)
+        comments = None if comments is None else json.dumps(comments)
+        db = self._connection()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO provenance VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                signature + (int(entry.complete), items, comments, time.time()),
+            )
+
+        # Trim the database now and then, rather than on every write
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.trim()
+
+    def trim(self):
+        """Remove the least recently used entries beyond max_entries."""
+        db = self._connection()
+        with db:
+            db.execute(
+                "DELETE FROM provenance WHERE path IN "
+                "(SELECT path FROM provenance ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def invalidate(self, path):
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM provenance WHERE path = ?", (path,))
+
+    def clear(self):
+        db = self._connection()
+        with db:
+            db.execute("DELETE FROM provenance")
+
+
+class ProvenanceCache:
+    """A two-tier cache of provenance read from files.
+
+    Parameters
+    ----------
+    max_entries: int
+        Maximum number of files to keep in memory
+
+    max_bytes: int
+        Maximum total memory to use for the cache, roughly
+
+    sqlite_path: str or None
+        Path to an SQLite database to also cache provenance in,
+        which can be shared between processes.
+
+    sqlite_max_entries: int
+        Maximum number of files to keep in the database
+    """
+
+    def __init__(
+        self,
+        max_entries=1024,
+        max_bytes=256 * 2**20,
+        sqlite_path=None,
+        sqlite_max_entries=100000,
+    ):
+        self.memory = MemoryCache(max_entries, max_bytes)
+        if sqlite_path is None:
+            self.sqlite = None
+        else:
+            self.sqlite = SQLiteCache(sqlite_path, sqlite_max_entries)
+
+    def _lookup(self, signature):
+        entry = self.memory.get(signature)
+        if entry is None and self.sqlite is not None:
+            entry = self.sqlite.get(signature)
+            if entry is not None:
+                self.memory.put(signature, entry)
+        return entry
+
+    def read_get(self, filename, item, load):
+        """Get all the provenance from a file, or a single item,
+        using the cache if possible.
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+
+        item: tuple or None
+            (section, key) of the item to get, or None to get everything
+
+        load: callable
+            Function to call to read the file if needed, which should
+            return a single value if an item is specified, or a dict of
+            provenance and a list of comments otherwise.
+
+        Returns
+        -------
+        value or (dict, list)
+            The same as load would
+        """
+        signature = file_signature(filename)
+        if signature is None:
+            return load()
+
+        entry = self._lookup(signature)
+        if entry is not None:
+            if item is None:
+                if entry.complete:
+                    return dict(entry.items), entry.comments[:]
+            elif item in entry.items:
+                return entry.items[item]
+            elif entry.complete:
+                raise errors.ProvenanceMissingItem(f"{item[0]}/{item[1]}")
+
+        result = load()
+
+        if item is None:
+            d, comments = result
+            entry = _Entry(dict(d), list(comments), True)
+        else:
+            # Add the item to what we already know about the file
+            if entry is None:
+                items, nbytes = {}, _size({})
+            else:
+                items, nbytes = dict(entry.items), entry.nbytes
+            items[item] = result
+            entry = _Entry(items, None, False, nbytes + _size(item) + _size(result))
+
+        self.memory.put(signature, entry)
+        if self.sqlite is not None:
+            self.sqlite.put(signature, entry)
+        return result
+
+    def invalidate(self, filename):
+        """Forget anything cached about a file.
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+        """
+        path = os.path.abspath(filename)
+        self.memory.invalidate(path)
+        if self.sqlite is not None:
+            self.sqlite.invalidate(path)
+
+    def clear(self):
+        """Forget everything in the cache."""
+        self.memory.clear()
+        if self.sqlite is not None:
+            self.sqlite.clear()
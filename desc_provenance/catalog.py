@@ -0,0 +1,493 @@
+"""
+A searchable catalog of the provenance of all the files in a directory tree.
+
+Finding, for example, every output made from a particular git revision
+would otherwise mean reading the provenance of every file.  A catalog
+reads it once, in parallel, and keeps the parts that describe where each
+file came from in an indexed SQLite database:
+
+- all of the base section, including the file_id
+- git/head
+- the input_id and input_path sections
+
+Re-scanning a tree only re-reads files that have changed since they were
+last scanned, according to their size, modification time, and inode.
+"""
+from .provenance import (
+    Provenance,
+    base_section,
+    git_section,
+    input_id_section,
+    input_path_section,
+)
+from . import lineage
+import os
+import time
+import itertools
+import sqlite3
+
+# The sections that are stored completely
+catalog_sections = [base_section, input_id_section, input_path_section]
+
+
+def _sql_value(value):
+    # Convert a provenance value to something SQLite can store
+    if hasattr(value, "item"):
+        # numpy scalars, from HDF5 files
+        value = value.item()
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def _extract(path):
+    # Read the parts of a file's provenance that we catalog.  This runs in
+    # the worker processes, so must not raise.  Returns a list of
+    # (section, key, value) items and an error message or None.
+    try:
+        with Provenance.open(path) as view:
+            sections = view.sections()
+            items = []
+            for section in catalog_sections:
+                if section in sections:
+                    for key, value in view.section(section).items():
+                        items.append((section, key, _sql_value(value)))
+            (head,) = view.get_many([(git_section, "head")], default=None)
+            if head is not None:
+                items.append((git_section, "head", _sql_value(head)))
+        return items, None
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}"
+
+
+def _walk(root, suffixes):
+    # Yield the (real path, signature) of every file in a tree with one of
+    # the suffixes, where root is already a real path.  Symbolic links to
+    # directories are not followed, to avoid loops, but links to files are
+    # resolved, so that paths match the ones used in queries.
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if os.path.splitext(entry.name)[1] not in suffixes:
+                    continue
+                s = entry.stat()
+                path = entry.path
+                if entry.is_symlink():
+                    path = os.path.realpath(path)
+            except OSError:
+                continue
+            yield path, (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns)
+
+
+class Catalog:
+    """An SQLite catalog of the provenance of files in directory trees.
+
+    Use scan to add or update a tree, and the other methods to query it.
+    All paths are stored and returned as real absolute paths, with any
+    symbolic links resolved, and paths given to queries are resolved
+    in the same way.
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        The database file, which is created if needed
+    """
+
+    _schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            dev INTEGER,
+            ino INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            file_id TEXT,
+            git_head TEXT,
+            error TEXT,
+            scanned REAL
+        );
+        CREATE INDEX IF NOT EXISTS files_file_id ON files (file_id);
+        CREATE INDEX IF NOT EXISTS files_git_head ON files (git_head);
+        CREATE TABLE IF NOT EXISTS items (
+            path TEXT,
+            section TEXT,
+            key TEXT,
+            value
+        );
+        CREATE INDEX IF NOT EXISTS items_path ON items (path);
+        CREATE INDEX IF NOT EXISTS items_value ON items (section, value);
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def scan(
+        self, root, max_workers=None, chunksize=64, suffixes=None, batch_size=1000
+    ):
+        """Add or update the provenance of all the files in a directory tree.
+
+        Files that have not changed since the last scan are skipped, and
+        files that have been removed since then are dropped from the catalog.
+        Files that could not be read, for example because they have no
+        provenance, are recorded along with the reason and not retried
+        until they change.  Symbolic links to files are catalogued under
+        the path of the file they point to.
+
+        Results are committed in batches, so other connections are not
+        blocked for the whole scan, and an interrupted scan keeps what it
+        had done.
+
+        Parameters
+        ----------
+        root: str or pathlib.Path
+            The top of the tree
+
+        max_workers: int or None
+            Number of processes to read files with.  None for the number
+            of CPUs, or 1 to read them in this process.
+
+        chunksize: int
+            Number of files to send to each process at a time
+
+        suffixes: list or None
+            File suffixes to look at, including the leading ".".  Defaults
+            to all the types Provenance can read.
+
+        batch_size: int
+            Number of files to update in each transaction
+
+        Returns
+        -------
+        dict
+            The number of files that were "unchanged", "updated", "failed"
+            (a subset of the updated ones), and "removed"
+        """
+        root = os.path.realpath(root)
+        if suffixes is None:
+            suffixes = set(Provenance._read_get_methods)
+        else:
+            suffixes = set(suffixes)
+
+        known = {
+            row[0]: tuple(row[1:])
+            for row in self.db.execute(
+                "SELECT path, dev, ino, size, mtime_ns FROM files "
+                "WHERE path = ? OR substr(path, 1, ?) = ?",
+                (root, len(root) + 1, os.path.join(root, "")),
+            )
+        }
+
+        # Several links can lead to the same file
+        found = dict(_walk(root, suffixes))
+
+        changed = {}
+        unchanged = 0
+        for path, signature in found.items():
+            # Links can also lead outside the tree
+            if path in known:
+                old = known.pop(path)
+            else:
+                old = self._signature(path)
+            if old == signature:
+                unchanged += 1
+            else:
+                changed[path] = signature
+        # Anything left in known has gone
+        removed = list(known)
+
+        paths = list(changed)
+        if max_workers == 1 or len(paths) < 2:
+            results = map(_extract, paths)
+            executor = None
+        else:
+            import concurrent.futures
+
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+            results = executor.map(_extract, paths, chunksize=chunksize)
+
+        failed = 0
+        try:
+            with self.db:
+                self._remove(removed)
+            results = zip(paths, results)
+            while True:
+                batch = list(itertools.islice(results, batch_size))
+                if not batch:
+                    break
+                with self.db:
+                    self._remove([path for path, _ in batch])
+                    for path, (items, error) in batch:
+                        if error is not None:
+                            failed += 1
+                        self._insert(path, changed[path], items, error)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return {
+            "unchanged": unchanged,
+            "updated": len(paths),
+            "failed": failed,
+            "removed": len(removed),
+        }
+
+    def _signature(self, path):
+        row = self.db.execute(
+            "SELECT dev, ino, size, mtime_ns FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        return None if row is None else tuple(row)
+
+    def _remove(self, paths):
+        rows = [(path,) for path in paths]
+        self.db.executemany("DELETE FROM files WHERE path = ?", rows)
+        self.db.executemany("DELETE FROM items WHERE path = ?", rows)
+
+    def _insert(self, path, signature, items, error):
+        values = {(section, key): value for section, key, value in items}
+        file_id = values.get((base_section, "file_id"))
+        git_head = values.get((git_section, "head"))
+        self.db.execute(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path,) + signature + (file_id, git_head, error, time.time()),
+        )
+        self.db.executemany(
+            "INSERT INTO items VALUES (?, ?, ?, ?)",
+            [(path, section, key, value) for section, key, value in items],
+        )
+
+    # Queries
+    # -------
+
+    def _paths(self, sql, args):
+        return [row[0] for row in self.db.execute(sql, args)]
+
+    def file_id(self, path):
+        """Return the file_id of a file, or None if it has none.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+
+        Returns
+        -------
+        str or None
+        """
+        row = self.db.execute(
+            "SELECT file_id FROM files WHERE path = ?", (os.path.realpath(path),)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def find_file_id(self, file_id):
+        """Return the paths of files with the given file_id.
+
+        This is normally one file, but copies of a file share its ID.
+
+        Parameters
+        ----------
+        file_id: str
+
+        Returns
+        -------
+        list
+        """
+        return self._paths(
+            "SELECT path FROM files WHERE file_id = ? ORDER BY path", (file_id,)
+        )
+
+    def from_revision(self, head):
+        """Return the paths of files made from a git revision.
+
+        Parameters
+        ----------
+        head: str
+            The commit hash, or the start of it
+
+        Returns
+        -------
+        list
+        """
+        # Compare prefixes with a range rather than LIKE, so that
+        # the index can be used
+        return self._paths(
+            "SELECT path FROM files WHERE git_head >= ? AND git_head < ? ORDER BY path",
+            (head, head + "\U0010ffff"),
+        )
+
+    def using_input(self, file_id=None, path=None):
+        """Return the paths of files that used an input file.
+
+        The input can be identified by its file_id, its path, or both, in
+        which case files that recorded either are included.
+
+        Parameters
+        ----------
+        file_id: str or None
+
+        path: str or pathlib.Path or None
+
+        Returns
+        -------
+        list
+        """
+        if file_id is None and path is None:
+            raise ValueError("Must supply a file_id or a path")
+        conditions = []
+        args = []
+        if file_id is not None:
+            conditions.append("(section = ? AND value = ?)")
+            args += [input_id_section, file_id]
+        if path is not None:
+            conditions.append("(section = ? AND value = ?)")
+            args += [input_path_section, os.path.realpath(path)]
+        return self._paths(
+            "SELECT DISTINCT path FROM items WHERE "
+            + " OR ".join(conditions)
+            + " ORDER BY path",
+            args,
+        )
+
+    def inputs(self, path):
+        """Return the inputs recorded by a file.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+
+        Returns
+        -------
+        dict
+            Maps the input names to (path, file_id) pairs.  Either may be
+            None if it was not recorded.
+        """
+        inputs = {}
+        rows = self.db.execute(
+            "SELECT section, key, value FROM items "
+            "WHERE path = ? AND section IN (?, ?)",
+            (os.path.realpath(path), input_path_section, input_id_section),
+        )
+        for section, key, value in rows:
+            input_path, file_id = inputs.get(key, (None, None))
+            if section == input_path_section:
+                inputs[key] = (value, file_id)
+            else:
+                inputs[key] = (input_path, value)
+        return inputs
+
+    def items(self, path):
+        """Return the catalogued provenance of a file.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+
+        Returns
+        -------
+        dict
+            Maps (section, key) to values
+        """
+        rows = self.db.execute(
+            "SELECT section, key, value FROM items WHERE path = ?",
+            (os.path.realpath(path),),
+        )
+        return {(section, key): value for section, key, value in rows}
+
+    def descendants(self, path, max_depth=None):
+        """Find everything that was made from a file, directly or indirectly.
+
+        This follows the inputs recorded by the catalogued files, so
+        the tree(s) containing them must have been scanned.
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+
+        max_depth: int or None
+            Maximum number of generations to follow, or None for no limit
+
+        Returns
+        -------
+        desc_provenance.lineage.Lineage
+            The graph of the file and its descendants
+        """
+        root = os.path.realpath(path)
+        graph = lineage.Lineage(root, "descendants")
+
+        def node_info(p):
+            row = self.db.execute(
+                "SELECT file_id, error FROM files WHERE path = ?", (p,)
+            ).fetchone()
+            if row is None:
+                return None, "ProvenanceMissingFile: not in the catalog"
+            return row
+
+        level = [root]
+        depth = 0
+        while level:
+            for p in level:
+                file_id, error = node_info(p)
+                graph.nodes[p] = lineage.LineageNode(p, file_id, depth, error)
+            if max_depth is not None and depth >= max_depth:
+                break
+
+            next_level = {}
+            for parent in level:
+                node = graph.nodes[parent]
+                node.expanded = True
+                for child in self.using_input(file_id=node.file_id, path=parent):
+                    for name, (input_path, recorded_id) in self.inputs(child).items():
+                        if input_path != parent and (
+                            node.file_id is None or recorded_id != node.file_id
+                        ):
+                            continue
+                        status = lineage.edge_status(
+                            recorded_id, node.file_id, node.error
+                        )
+                        graph.edges.append(
+                            lineage.LineageEdge(
+                                child, parent, name, recorded_id, node.file_id, status
+                            )
+                        )
+                    if child not in graph.nodes:
+                        next_level[child] = None
+            level = list(next_level)
+            depth += 1
+
+        graph._find_cycles()
+        return graph
+
+    def errors(self):
+        """Return the files that could not be read, and why.
+
+        Returns
+        -------
+        dict
+            Maps paths to error messages
+        """
+        rows = self.db.execute(
+            "SELECT path, error FROM files WHERE error IS NOT NULL ORDER BY path"
+        )
+        return dict(rows.fetchall())
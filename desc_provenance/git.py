@@ -1,25 +1,540 @@
 from .utils import get_caller_directory
+import os
+import stat
+import struct
+import threading
 import subprocess
+import collections
 
+# Everything we need to know to find the state of a repository.
+# The git_dir is usually root/.git, but in a worktree the .git entry
+# is a file pointing somewhere else, and shared things like refs
+# live in the common_dir of the main repository.
+Repository = collections.namedtuple("Repository", ["root", "git_dir", "common_dir"])
 
-def diff(dirname=None, parent_frames=1):
+# Cache of git results for each repository, keyed by the repository root.
+# Each entry is (signature, {name: value}) where the signature describes
+# the state of the repository at the time the values were computed.
+cache_enabled = True
+_cache = {}
+_index_cache = {}
+_cache_lock = threading.Lock()
+
+# Size of blocks read from git's output
+_CHUNK_SIZE = 65536
+
+
+def clear_cache():
+    """Forget all cached git information."""
+    with _cache_lock:
+        _cache.clear()
+        _index_cache.clear()
+
+
+def find_repository(dirname):
+    """Find the git repository containing a directory.
+
+    Parameters
+    ----------
+    dirname: str
+        Any directory inside the working tree
+
+    Returns
+    -------
+    Repository or None
+        The repository root and git directories, or None if
+        the directory is not in a git working tree.
+    """
+    path = os.path.abspath(dirname)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            # worktrees and submodules have a file pointing to the real
+            # git directory instead.
+            try:
+                with open(dot_git) as f:
+                    line = f.readline().strip()
+            except OSError:
+                return None
+            if not line.startswith("gitdir:"):
+                return None
+            git_dir = os.path.join(path, line[len("gitdir:") :].strip())
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    git_dir = os.path.normpath(git_dir)
+
+    # Linked worktrees record where the main repository lives
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    except OSError:
+        pass
+
+    return Repository(path, git_dir, common_dir)
+
+
+def _stat_key(path):
+    # The parts of a stat result that change when a file is modified.
+    # A missing file gets None, which is also a valid part of a signature.
+    try:
+        s = os.stat(path)
+    except OSError:
+        return None
+    return (s.st_mtime_ns, s.st_size, s.st_ino)
+
+
+def _read_varint(data, pos):
+    # The offset-style variable length integer used in version 4 indices
+    c = data[pos]
+    pos += 1
+    value = c & 0x7F
+    while c & 0x80:
+        value += 1
+        c = data[pos]
+        pos += 1
+        value = (value << 7) + (c & 0x7F)
+    return value, pos
+
+
+def _parse_index(data):
+    # Read the paths of all the tracked files from the content of a
+    # .git/index file.  Returns None if we don't understand the format.
+    if data[:4] != b"DIRC":
+        return None
+    version, count = struct.unpack(">II", data[4:12])
+    if version not in (2, 3, 4):
+        return None
+
+    paths = []
+    previous = b""
+    pos = 12
+    for _ in range(count):
+        # Fixed size part: ten 32-bit stat fields, the object ID, and the flags
+        (flags,) = struct.unpack(">H", data[pos + 60 : pos + 62])
+        name_start = pos + 62
+        if version >= 3 and flags & 0x4000:
+            name_start += 2
+
+        if version == 4:
+            # names are prefix-compressed against the previous entry
+            strip, name_start = _read_varint(data, name_start)
+            end = data.index(b"\0", name_start)
+            name = previous[: len(previous) - strip] + data[name_start:end]
+            pos = end + 1
+        else:
+            # names are NUL-padded to a multiple of eight bytes
+            end = data.index(b"\0", name_start)
+            name = data[name_start:end]
+            pos += (end - pos + 8) & ~7
+
+        previous = name
+        paths.append(os.fsdecode(name))
+    return paths
+
+
+def tracked_files(repo):
+    """Return the paths of the files tracked in a repository's index.
+
+    The list is cached until the index file changes.
+
+    Parameters
+    ----------
+    repo: Repository
+
+    Returns
+    -------
+    list or None
+        Paths relative to the repository root, or None if the
+        index could not be read.
+    """
+    index_path = os.path.join(repo.git_dir, "index")
+    key = _stat_key(index_path)
+    if key is None:
+        return []
+
+    with _cache_lock:
+        cached = _index_cache.get(index_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    try:
+        with open(index_path, "rb") as f:
+            paths = _parse_index(f.read())
+    except (OSError, ValueError, struct.error, IndexError):
+        paths = None
+
+    with _cache_lock:
+        _index_cache[index_path] = (key, paths)
+    return paths
+
+
+def _head_ref(git_dir):
+    # Return the name of the ref that HEAD points to, or None if detached
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    if head.startswith("ref:"):
+        return head[len("ref:") :].strip()
+    return None
+
+
+def state_signature(repo):
+    """Describe the state of a repository cheaply, without running git.
+
+    The signature changes if HEAD, the ref that it points to, the index,
+    or any tracked file in the working tree changes.
+
+    Parameters
+    ----------
+    repo: Repository
+
+    Returns
+    -------
+    tuple or None
+        A hashable signature, or None if the state can't be determined
+    """
+    paths = tracked_files(repo)
+    if paths is None:
+        return None
+
+    ref = _head_ref(repo.git_dir)
+    if ref is None:
+        ref_keys = None
+    else:
+        # Per-worktree refs are in the git dir, shared ones in the common dir
+        ref_keys = (
+            _stat_key(os.path.join(repo.git_dir, ref)),
+            _stat_key(os.path.join(repo.common_dir, ref)),
+            _stat_key(os.path.join(repo.common_dir, "packed-refs")),
+        )
+
+    # We only need the time of the working tree files, but take
+    # the size too since it is free
+    files = []
+    for path in paths:
+        try:
+            s = os.lstat(os.path.join(repo.root, path))
+        except OSError:
+            files.append(None)
+            continue
+        if stat.S_ISDIR(s.st_mode):
+            # submodules appear as directories
+            files.append(None)
+        else:
+            files.append((s.st_mtime_ns, s.st_size))
+
+    return (
+        _stat_key(os.path.join(repo.git_dir, "HEAD")),
+        ref,
+        ref_keys,
+        _stat_key(os.path.join(repo.git_dir, "index")),
+        tuple(files),
+    )
+
+
+def _cache_lookup(dirname, name):
+    # Look up a cached value for the repository containing dirname.
+    # Returns (hit, value, key) where the key is needed to store
+    # a newly computed value, and is None if it can't be cached.
+    repo = find_repository(dirname) if cache_enabled else None
+    if repo is None:
+        return False, None, None
+
+    signature = state_signature(repo)
+    if signature is None:
+        return False, None, None
+
+    with _cache_lock:
+        entry = _cache.get(repo.root)
+        if entry is not None and entry[0] == signature and name in entry[1]:
+            return True, entry[1][name], None
+    return False, None, (repo.root, signature)
+
+
+def _cache_store(key, name, value):
+    # Errors are never cached, since they may be transient.
+    text = value["diff"] if isinstance(value, dict) else value
+    if key is None or text.startswith("ERROR_GIT"):
+        return
+    root, signature = key
+    with _cache_lock:
+        entry = _cache.get(root)
+        if entry is None or entry[0] != signature:
+            entry = _cache[root] = (signature, {})
+        entry[1][name] = value
+
+
+def _cached(dirname, name, compute):
+    # Look up a cached value for the repository containing dirname,
+    # or compute and store it if the repository has changed since.
+    hit, value, key = _cache_lookup(dirname, name)
+    if hit:
+        return value
+    value = compute()
+    _cache_store(key, name, value)
+    return value
+
+
+async def _acached(dirname, name, compute):
+    # Coroutine version of _cached, where compute returns an awaitable.
+    # Checking the repository state means finding it and statting its
+    # files, so is done in the executor rather than blocking the loop.
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    hit, value, key = await loop.run_in_executor(None, _cache_lookup, dirname, name)
+    if hit:
+        return value
+    value = await compute()
+    _cache_store(key, name, value)
+    return value
+
+
+# By default we keep at most this many bytes of the diff.  The full
+# size and hash are always recorded.
+DEFAULT_DIFF_MAX_BYTES = 1024 * 1024
+
+# Compressed diffs are stored as text with one of these prefixes,
+# which can never start the output of git diff
+COMPRESSED_PREFIXES = {
+    "zlib": "ZLIB+BASE64:",
+    "zstd": "ZSTD+BASE64:",
+}
+
+
+def _compressor(compression):
+    if compression is None:
+        return None
+    elif compression == "zlib":
+        import zlib
+
+        return zlib.compressobj(9)
+    elif compression == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown diff compression {compression}")
+
+
+def _utf8_boundary(data):
+    # Return the length of the longest prefix of data that does not
+    # end part way through a UTF-8 character.
+    n = len(data)
+    for i in range(1, min(4, n) + 1):
+        c = data[n - i]
+        # continuation bytes look like 10xxxxxx
+        if c & 0xC0 != 0x80:
+            # this is the lead byte; check if its character is complete
+            if c >= 0xF0:
+                length = 4
+            elif c >= 0xE0:
+                length = 3
+            elif c >= 0xC0:
+                length = 2
+            else:
+                length = 1
+            return n if length <= i else n - i
+    return n
+
+
+def _universal_newlines(text):
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+class DiffCapture:
+    """Collect the output of git diff as it is streamed from the process.
+
+    Everything is hashed and counted, but only the first max_bytes
+    are kept, optionally compressed as they arrive.
+
+    Parameters
+    ----------
+    max_bytes: int or None
+        The maximum number of bytes of the diff to keep, or None for no limit
+
+    compression: str or None
+        "zlib", "zstd", or None to store the diff as plain text
+    """
+
+    def __init__(self, max_bytes=DEFAULT_DIFF_MAX_BYTES, compression=None):
+        import hashlib
+
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.size = 0
+        self.kept = 0
+        self.truncated = False
+        self._hash = hashlib.sha256()
+        self._compressor = _compressor(compression)
+        self._chunks = []
+
+    def update(self, chunk):
+        """Add the next chunk of bytes from the diff"""
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+        if self.truncated:
+            return
+
+        if self.max_bytes is not None and self.kept + len(chunk) > self.max_bytes:
+            chunk = chunk[: self.max_bytes - self.kept]
+            # Don't keep part of a character
+            chunk = chunk[: _utf8_boundary(chunk)]
+            self.truncated = True
+
+        self.kept += len(chunk)
+        if self._compressor is None:
+            self._chunks.append(chunk)
+        else:
+            self._chunks.append(self._compressor.compress(chunk))
+
+    def finish(self):
+        """Return the collected diff and information about it.
+
+        Returns
+        -------
+        dict
+            Items to record in the git section of the provenance
+        """
+        if self._compressor is None:
+            try:
+                text = b"".join(self._chunks).decode()
+            except UnicodeDecodeError:
+                return {"diff": "ERROR_GIT_DECODING"}
+            text = _universal_newlines(text)
+        else:
+            import base64
+
+            self._chunks.append(self._compressor.flush())
+            data = base64.b64encode(b"".join(self._chunks)).decode("ascii")
+            text = COMPRESSED_PREFIXES[self.compression] + data
+
+        return {
+            "diff": text,
+            "diff_size": self.size,
+            "diff_sha256": self._hash.hexdigest(),
+            "diff_truncated": self.truncated,
+        }
+
+
+def decode_diff(value):
+    """Return the text of a diff recorded by DiffCapture.
+
+    Diffs that were not compressed are returned unchanged.
+
+    Parameters
+    ----------
+    value: str
+        The value recorded in the provenance
+
+    Returns
+    -------
+    str
+    """
+    if not isinstance(value, str):
+        return value
+
+    for compression, prefix in COMPRESSED_PREFIXES.items():
+        if value.startswith(prefix):
+            break
+    else:
+        return value
+
+    import base64
+
+    data = base64.b64decode(value[len(prefix) :])
+    if compression == "zlib":
+        import zlib
+
+        data = zlib.decompress(data)
+    else:
+        import zstandard
+
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return _universal_newlines(data.decode())
+
+
+def diff(dirname=None, parent_frames=1, max_bytes=None):
     """
     Run git diff in the caller's directory (default) or another specified directory,
     and return stdout+stderr
+
+    The whole diff is returned unless max_bytes is set; use diff_info to
+    compress the diff or get its full size and hash as well.  Results are
+    cached per repository until the repository changes.
     """
     if dirname is None:
         dirname = get_caller_directory(parent_frames + 1)
+    return diff_info(dirname, max_bytes=max_bytes)["diff"]
+
+
+def diff_info(
+    dirname=None,
+    parent_frames=1,
+    max_bytes=DEFAULT_DIFF_MAX_BYTES,
+    compression=None,
+):
+    """
+    Run git diff in the caller's directory (default) or another specified directory,
+    streaming its output so that large diffs are never held in memory.
 
+    Results are cached per repository until the repository changes.
+
+    Parameters
+    ----------
+    dirname: str or None
+        Directory to run in, by default the caller's.
+
+    parent_frames: int
+        Number of additional frames to go up in the call stack to find
+        the default directory
+
+    max_bytes: int or None
+        The maximum number of bytes of the diff to keep, or None for no limit
+
+    compression: str or None
+        "zlib", "zstd", or None to store the diff as plain text
+
+    Returns
+    -------
+    dict
+        "diff" is the (possibly truncated or compressed) diff text, or an
+        error string.  If git ran successfully then "diff_size" is the size
+        of the complete diff in bytes, "diff_sha256" its hash, and
+        "diff_truncated" whether it was cut at max_bytes.
+    """
     if dirname is None:
-        return "ERROR_GIT_NO_DIRECTORY"
+        dirname = get_caller_directory(parent_frames + 1)
+
+    if dirname is None:
+        return {"diff": "ERROR_GIT_NO_DIRECTORY"}
+
+    name = f"diff:{max_bytes}:{compression}"
+    info = _cached(dirname, name, lambda: _run_diff(dirname, max_bytes, compression))
+    # The cached dict should not be modified by the caller
+    return dict(info)
+
+
+def _run_diff(dirname, max_bytes, compression, timeout=5):
+    # Make this first so that we complain about bad options straight away
+    capture = DiffCapture(max_bytes, compression)
+
     # We use git diff head because it shows all differences,
     # including any that have been staged but not committed.
     try:
-        diff = subprocess.run(
+        proc = subprocess.Popen(
             "git diff HEAD".split(),
             cwd=dirname,
-            universal_newlines=True,
-            timeout=5,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
@@ -27,33 +542,137 @@ def diff(dirname=None, parent_frames=1):
     # There are lots of different ways this can go wrong.
     # Here are some - any others it is probably worth knowing
     # about
-    except subprocess.TimeoutExpired:
-        return "ERROR_GIT_TIMEOUT"
-    except UnicodeDecodeError:
-        return "ERROR_GIT_DECODING"
     except subprocess.SubprocessError:
-        return "ERROR_GIT_OTHER"
+        return {"diff": "ERROR_GIT_OTHER"}
     except FileNotFoundError:
-        return "ERROR_GIT_NOT_RUNNABLE"
+        return {"diff": "ERROR_GIT_NOT_RUNNABLE"}
     except OSError:
-        return "ERROR_GIT_OTHER_OSERROR"
+        return {"diff": "ERROR_GIT_OTHER_OSERROR"}
+
+    # Kill git if it takes too long, which will end the stream below
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        with proc.stdout:
+            for chunk in iter(lambda: proc.stdout.read(_CHUNK_SIZE), b""):
+                capture.update(chunk)
+        proc.wait()
+    finally:
+        timer.cancel()
+
+    if timed_out.is_set():
+        return {"diff": "ERROR_GIT_TIMEOUT"}
+
     # If for some reason we are running outside the main repo
     # this will return an error too
-    if diff.returncode:
-        return "ERROR_GIT_FAIL"
+    if proc.returncode:
+        return {"diff": "ERROR_GIT_FAIL"}
 
-    return diff.stdout
+    return capture.finish()
+
+
+def _read_ref(repo, ref, depth=0):
+    # Resolve a ref name to an object ID by reading the git directory,
+    # following symbolic refs.  Returns None if it can't be found.
+    if depth > 5:
+        return None
+
+    # Per-worktree refs (including HEAD) live in the git dir, and
+    # shared refs in the common dir.  For ordinary repos they are the same.
+    for base in (repo.git_dir, repo.common_dir):
+        try:
+            with open(os.path.join(base, ref)) as f:
+                content = f.read().strip()
+        except (OSError, UnicodeDecodeError):
+            continue
+        if content.startswith("ref:"):
+            return _read_ref(repo, content[len("ref:") :].strip(), depth + 1)
+        if _is_object_id(content):
+            return content
+        return None
+
+    # Otherwise the ref may have been packed together with others
+    try:
+        with open(os.path.join(repo.common_dir, "packed-refs")) as f:
+            for line in f:
+                # Skip the header and the peeled values of annotated tags
+                if line.startswith("#") or line.startswith("^"):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref and _is_object_id(parts[0]):
+                    return parts[0]
+    except (OSError, UnicodeDecodeError):
+        pass
+    return None
+
+
+def _is_object_id(text):
+    # SHA-1 or SHA-256 object names
+    if len(text) not in (40, 64):
+        return False
+    try:
+        int(text, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def read_revision(dirname):
+    """Find the git revision ID of a directory without running git.
+
+    This reads HEAD and the refs directly from the git directory,
+    handling symbolic refs, packed refs, linked worktrees, and
+    detached heads.
+
+    Parameters
+    ----------
+    dirname: str
+        Any directory inside the working tree
+
+    Returns
+    -------
+    str or None
+        The revision in the same form as git rev-parse HEAD,
+        or None if it could not be determined.
+    """
+    repo = find_repository(dirname)
+    if repo is None:
+        return None
+    rev = _read_ref(repo, "HEAD")
+    if rev is None:
+        return None
+    # Match the output of git rev-parse
+    return rev + "\n"
 
 
 def current_revision(dirname=None, parent_frames=1):
     """Return the git revision ID in the caller's directory (default) or another
     specified directory.
+
+    The revision is read directly from the git directory if possible,
+    and otherwise by running git, with results cached per repository
+    until the repository changes.
     """
     if dirname is None:
         dirname = get_caller_directory(parent_frames + 1)
 
     if dirname is None:
         return "ERROR_GIT_NO_DIRECTORY"
+
+    rev = read_revision(dirname)
+    if rev is not None:
+        return rev
+
+    return _cached(dirname, "revision", lambda: _run_rev_parse(dirname))
+
+
+def _run_rev_parse(dirname):
     try:
         rev = subprocess.run(
             "git rev-parse HEAD".split(),
@@ -79,3 +698,104 @@ def current_revision(dirname=None, parent_frames=1):
     if rev.returncode:
         return "ERROR_GIT_FAIL"
     return rev.stdout
+
+
+async def _arun_git(dirname, *args, capture=None, timeout=5):
+    # Run git without blocking the event loop, mirroring the errors
+    # reported by the synchronous versions above.  If a DiffCapture is
+    # supplied the output is streamed into it and its result returned.
+    import asyncio
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "git",
+            *args,
+            cwd=dirname,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+    except FileNotFoundError:
+        return "ERROR_GIT_NOT_RUNNABLE"
+    except OSError:
+        return "ERROR_GIT_OTHER_OSERROR"
+
+    async def communicate():
+        if capture is None:
+            stdout, _ = await proc.communicate()
+            return stdout
+        while True:
+            chunk = await proc.stdout.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            capture.update(chunk)
+        await proc.wait()
+
+    try:
+        stdout = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return "ERROR_GIT_TIMEOUT"
+
+    if proc.returncode:
+        return "ERROR_GIT_FAIL"
+
+    if capture is not None:
+        return capture.finish()
+
+    try:
+        text = stdout.decode()
+    except UnicodeDecodeError:
+        return "ERROR_GIT_DECODING"
+    # Match the universal newlines mode used above
+    return _universal_newlines(text)
+
+
+async def adiff(dirname):
+    """Coroutine version of diff, which runs git asynchronously.
+
+    Unlike diff the directory must be specified.
+    """
+    return (await adiff_info(dirname, max_bytes=None))["diff"]
+
+
+async def adiff_info(dirname, max_bytes=DEFAULT_DIFF_MAX_BYTES, compression=None):
+    """Coroutine version of diff_info, which runs git asynchronously.
+
+    Unlike diff_info the directory must be specified.
+    """
+    if dirname is None:
+        return {"diff": "ERROR_GIT_NO_DIRECTORY"}
+
+    async def run():
+        capture = DiffCapture(max_bytes, compression)
+        info = await _arun_git(dirname, "diff", "HEAD", capture=capture)
+        # errors are reported as plain strings
+        if isinstance(info, str):
+            info = {"diff": info}
+        return info
+
+    name = f"diff:{max_bytes}:{compression}"
+    return dict(await _acached(dirname, name, run))
+
+
+async def acurrent_revision(dirname):
+    """Coroutine version of current_revision, which runs git asynchronously
+    if the revision cannot be read directly.
+
+    Unlike current_revision the directory must be specified.
+    """
+    if dirname is None:
+        return "ERROR_GIT_NO_DIRECTORY"
+
+    # Reading the revision means finding and reading files in the repository
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    rev = await loop.run_in_executor(None, read_revision, dirname)
+    if rev is not None:
+        return rev
+
+    return await _acached(
+        dirname, "revision", lambda: _arun_git(dirname, "rev-parse", "HEAD")
+    )
@@ -0,0 +1,312 @@
+"""
+Following the lineage of files through the inputs they record.
+
+Each file written with provenance records the path and file_id of each of
+its inputs, which in turn record theirs.  Provenance.ancestry follows these
+back from a file, reading each ancestor only once however many files used
+it, and Catalog.descendants follows them forwards through a catalog.
+
+Each edge of the resulting graph notes whether the file_id recorded for the
+input matches the ID actually in the input file now, so that inputs which
+have been overwritten since they were used can be found.
+"""
+from .provenance import (
+    Provenance,
+    base_section,
+    input_id_section,
+    input_path_section,
+    unknown_value,
+)
+import pathlib
+import collections
+
+# The possible states of an edge
+verified = "verified"  # the recorded ID matches the input file
+mismatch = "mismatch"  # the input file has a different ID now
+unknown = "unknown"  # the ID was not recorded, or the input has none
+missing = "missing"  # the input file could not be found
+
+
+class LineageEdge(
+    collections.namedtuple(
+        "LineageEdge", ["child", "parent", "name", "recorded_id", "parent_id", "status"]
+    )
+):
+    """A record that one file used another as an input.
+
+    Attributes
+    ----------
+    child: str
+        The path to the file that used the input
+
+    parent: str
+        The path to the input file
+
+    name: str
+        The name the child gave the input
+
+    recorded_id: str
+        The file_id of the input recorded by the child
+
+    parent_id: str or None
+        The file_id in the input file now, or None if it has none
+
+    status: str
+        One of verified, mismatch, unknown, or missing
+    """
+
+    __slots__ = ()
+
+
+class LineageNode:
+    """A file in a lineage graph.
+
+    Attributes
+    ----------
+    path: str
+
+    file_id: str or None
+        None if the file has no ID, or could not be read
+
+    depth: int
+        Number of edges from the file the graph starts at
+
+    expanded: bool
+        False if the links from this file were not followed because
+        the maximum depth was reached
+
+    error: str or None
+        Why the file could not be read, if it could not
+    """
+
+    __slots__ = ["path", "file_id", "depth", "expanded", "error"]
+
+    def __init__(self, path, file_id, depth, error=None):
+        self.path = path
+        self.file_id = file_id
+        self.depth = depth
+        self.expanded = False
+        self.error = error
+
+    def __repr__(self):
+        return f"LineageNode({self.path!r}, file_id={self.file_id!r}, depth={self.depth})"
+
+
+class Lineage:
+    """A graph of files linked by the inputs they recorded.
+
+    Attributes
+    ----------
+    root: str
+        The path to the file the graph starts at
+
+    direction: str
+        "ancestors" if the graph follows the inputs of the root, or
+        "descendants" if it follows the files that used it
+
+    nodes: dict
+        Maps paths to LineageNode objects
+
+    edges: list
+        LineageEdge objects, in the order they were found
+
+    cycles: list
+        Edges that lead back to a file that is already on the
+        path from the root to them.  This can only happen if files have been
+        overwritten.
+    """
+
+    def __init__(self, root, direction):
+        self.root = root
+        self.direction = direction
+        self.nodes = {}
+        self.edges = []
+        self.cycles = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, path):
+        return path in self.nodes
+
+    def parents(self, path):
+        """Return the edges to the inputs of a file.
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        list
+        """
+        return [edge for edge in self.edges if edge.child == path]
+
+    def children(self, path):
+        """Return the edges to the files that used a file as an input.
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        list
+        """
+        return [edge for edge in self.edges if edge.parent == path]
+
+    def mismatches(self):
+        """Return the edges where the input file has changed since it was used.
+
+        Returns
+        -------
+        list
+        """
+        return [edge for edge in self.edges if edge.status == mismatch]
+
+    def _find_cycles(self):
+        # Depth-first search from the root, noting edges back to
+        # a file that is on the current path.
+        outgoing = collections.defaultdict(list)
+        for edge in self.edges:
+            if self.direction == "ancestors":
+                outgoing[edge.child].append((edge.parent, edge))
+            else:
+                outgoing[edge.parent].append((edge.child, edge))
+
+        on_path = {self.root}
+        done = set()
+        stack = [(self.root, iter(outgoing[self.root]))]
+        while stack:
+            path, it = stack[-1]
+            for end, edge in it:
+                if end in on_path:
+                    self.cycles.append(edge)
+                elif end not in done:
+                    on_path.add(end)
+                    stack.append((end, iter(outgoing[end])))
+                    break
+            else:
+                stack.pop()
+                on_path.discard(path)
+                done.add(path)
+
+
+def edge_status(recorded_id, parent_id, parent_error):
+    """Work out the status of an edge from the IDs at each end.
+
+    Parameters
+    ----------
+    recorded_id: str or None
+        The ID the child recorded for the input
+
+    parent_id: str or None
+        The ID in the input file
+
+    parent_error: str or None
+        Why the input file could not be read, if it could not
+
+    Returns
+    -------
+    str
+    """
+    if parent_error is not None and parent_error.startswith("ProvenanceMissingFile"):
+        return missing
+    if recorded_id in (None, unknown_value) or parent_id is None:
+        return unknown
+    if recorded_id == parent_id:
+        return verified
+    return mismatch
+
+
+def read_links(path):
+    """Read the file_id and the inputs recorded in a file.
+
+    Parameters
+    ----------
+    path: str
+
+    Returns
+    -------
+    file_id: str or None
+
+    inputs: dict
+        Maps input names to (path, recorded file_id) pairs
+
+    error: str or None
+        Why the file could not be read, if it could not, in which case
+        file_id is None and inputs is empty
+    """
+    try:
+        with Provenance.open(path) as view:
+            sections = view.sections()
+            (file_id,) = view.get_many([(base_section, "file_id")], default=None)
+            paths, ids = {}, {}
+            if input_path_section in sections:
+                paths = view.section(input_path_section)
+            if input_id_section in sections:
+                ids = view.section(input_id_section)
+    except Exception as e:
+        return None, {}, f"{type(e).__name__}: {e}"
+    inputs = {name: (p, ids.get(name)) for name, p in paths.items()}
+    return file_id, inputs, None
+
+
+def ancestry(path, max_depth=None, max_workers=None, memo=None):
+    """Follow the inputs of a file back as far as they go.
+
+    See Provenance.ancestry, which calls this.
+    """
+    root = str(pathlib.Path(path).absolute().resolve())
+    lineage = Lineage(root, "ancestors")
+    if memo is None:
+        memo = {}
+
+    executor = None
+    if max_workers != 1:
+        import concurrent.futures
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    try:
+        level = [root]
+        depth = 0
+        while level:
+            # Read all the files at this depth that we have not seen before
+            # at the same time
+            needed = [p for p in level if p not in memo]
+            if executor is None or len(needed) < 2:
+                results = map(read_links, needed)
+            else:
+                results = executor.map(read_links, needed)
+            memo.update(zip(needed, results))
+
+            for p in level:
+                file_id, _, error = memo[p]
+                lineage.nodes[p] = LineageNode(p, file_id, depth, error)
+
+            if max_depth is not None and depth >= max_depth:
+                break
+
+            next_level = {}
+            for child in level:
+                lineage.nodes[child].expanded = True
+                for name, (parent, recorded_id) in memo[child][1].items():
+                    if parent not in lineage.nodes:
+                        next_level[parent] = None
+                    lineage.edges.append((child, parent, name, recorded_id))
+            level = list(next_level)
+            depth += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Now we have read everything we can fill in the status of each edge
+    edges = []
+    for child, parent, name, recorded_id in lineage.edges:
+        parent_id, _, error = memo[parent]
+        status = edge_status(recorded_id, parent_id, error)
+        edges.append(LineageEdge(child, parent, name, recorded_id, parent_id, status))
+    lineage.edges = edges
+    lineage._find_cycles()
+    return lineage
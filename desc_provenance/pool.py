@@ -0,0 +1,238 @@
+"""
+A pool of open read-only HDF5 files.
+
+Opening an HDF5 file can be slow on parallel file systems, so when the
+same files are read repeatedly, for example when following the inputs of
+many pipeline stages, it helps to keep them open.  When the pool is
+switched on, files opened for reading through utils.open_hdf are kept open
+in a bounded least-recently-used pool.
+
+Files are re-opened if they change on disk, and closed before they are
+opened for writing.  The pool is off by default; use
+Provenance.enable_hdf_pool to switch it on.
+"""
+from .cache import file_signature
+import os
+import threading
+import contextlib
+import collections
+
+_active = None
+
+
+def enable(max_handles=64, locking=False):
+    """Switch on pooling of open HDF5 files.
+
+    Any existing pool is closed first.
+
+    Parameters
+    ----------
+    max_handles: int
+        Maximum number of files to keep open
+
+    locking: bool
+        Whether to use HDF5 file locking for the pooled files.
+        See HDFHandlePool.
+
+    Returns
+    -------
+    HDFHandlePool
+        The new pool
+    """
+    global _active
+    disable()
+    _active = HDFHandlePool(max_handles, locking)
+    return _active
+
+
+def disable():
+    """Close all pooled files and switch off pooling."""
+    global _active
+    pool = _active
+    _active = None
+    if pool is not None:
+        pool.close_all()
+
+
+def active():
+    """Return the active HDFHandlePool, or None if pooling is off."""
+    return _active
+
+
+def close_all():
+    """Close all the files in the active pool, if there is one."""
+    pool = _active
+    if pool is not None:
+        pool.close_all()
+
+
+class _Handle:
+    # An open file, and the threads currently using it.
+    # A file that has been dropped from the pool is only closed once
+    # nobody is using it any more.
+    __slots__ = ["file", "path", "signature", "users", "dropped"]
+
+    def __init__(self, file, path, signature):
+        self.file = file
+        self.path = path
+        self.signature = signature
+        # Maps thread IDs to how many times they are using this
+        self.users = collections.Counter()
+        self.dropped = False
+
+    def in_use(self):
+        return bool(self.users)
+
+
+class HDFHandlePool:
+    """A bounded pool of HDF5 files open for reading.
+
+    Parameters
+    ----------
+    max_handles: int
+        Maximum number of files to keep open.  Files in use are never
+        closed, so more than this may be open for a short time.
+
+    locking: bool
+        Whether to open the files with HDF5 file locking.  With locking,
+        other processes cannot open a file for writing while it is in the
+        pool, so it is off by default.  Files that change are re-opened
+        anyway.  Ignored with h5py versions before 3.5, which always lock.
+    """
+
+    def __init__(self, max_handles=64, locking=False):
+        self.max_handles = max_handles
+        self.locking = locking
+        self._handles = collections.OrderedDict()
+        # Handles that have been dropped from the pool but are still in use
+        self._dropped = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._handles)
+
+    @contextlib.contextmanager
+    def open(self, filename):
+        """Use a pooled read-only handle for a file, opening it if needed.
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+
+        Yields
+        ------
+        h5py.File
+        """
+        handle = self._acquire(filename)
+        try:
+            yield handle.file
+        finally:
+            self._release(handle)
+
+    def _open(self, path):
+        import h5py
+
+        try:
+            return h5py.File(path, "r", locking=self.locking)
+        except TypeError:
+            # h5py < 3.5 has no locking option
+            return h5py.File(path, "r")
+
+    def _use(self, handle):
+        handle.users[threading.get_ident()] += 1
+        return handle
+
+    def _acquire(self, filename):
+        path = os.path.abspath(filename)
+        thread = threading.get_ident()
+
+        with self._cond:
+            while True:
+                signature = file_signature(path)
+                handle = self._handles.get(path)
+                if handle is not None and handle.signature == signature:
+                    self._handles.move_to_end(path)
+                    return self._use(handle)
+                # The file has changed on disk since we opened it
+                if handle is not None:
+                    self._drop(path)
+
+                # HDF5 shares the underlying file between handles to the
+                # same path, so a new one would see the same old data
+                # while an old one is still open.  Wait for it to be
+                # finished with, unless this thread is using it, in which
+                # case it has to carry on with the old one.
+                old = self._dropped.get(path)
+                if old is None:
+                    break
+                if old.users[thread]:
+                    return self._use(old)
+                self._cond.wait()
+
+            # Mark the file as being opened, so other threads wait for us
+            placeholder = _Handle(None, path, None)
+            self._dropped[path] = placeholder
+
+        # Open outside the lock, since this is the slow part.
+        # This raises the usual errors if the file is missing or broken.
+        try:
+            f = self._open(path)
+        finally:
+            with self._cond:
+                del self._dropped[path]
+                self._cond.notify_all()
+
+        with self._cond:
+            new = self._use(_Handle(f, path, signature))
+            self._handles[path] = new
+            while len(self._handles) > self.max_handles:
+                self._drop(next(iter(self._handles)))
+        return new
+
+    def _release(self, handle):
+        with self._cond:
+            thread = threading.get_ident()
+            handle.users[thread] -= 1
+            if not handle.users[thread]:
+                del handle.users[thread]
+            if handle.dropped and not handle.in_use():
+                self._close(handle)
+
+    def _drop(self, path):
+        # Remove a file from the pool, closing it unless it is in use.
+        # Must be called with the lock held.
+        handle = self._handles.pop(path)
+        handle.dropped = True
+        if handle.in_use():
+            self._dropped[path] = handle
+        else:
+            handle.file.close()
+
+    def _close(self, handle):
+        # Close a dropped handle that has been finished with, and let
+        # anyone waiting to re-open it know.  Called with the lock held.
+        handle.file.close()
+        if self._dropped.get(handle.path) is handle:
+            del self._dropped[handle.path]
+            self._cond.notify_all()
+
+    def evict(self, filename):
+        """Close a file if it is in the pool, for example before writing to it.
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+        """
+        path = os.path.abspath(filename)
+        with self._cond:
+            if path in self._handles:
+                self._drop(path)
+
+    def close_all(self):
+        """Close all the files in the pool.
+
+        Any that are in use are closed as soon as they are finished with.
+        """
+        with self._cond:
+            for path in list(self._handles):
+                self._drop(path)
@@ -1,19 +1,19 @@
 from . import git
 from . import errors
 from . import utils
+import os
 import sys
 import uuid
-import socket
-import getpass
+import time
 import pathlib
 import warnings
 import datetime
 import functools
 import contextlib
 import collections
-import numpy as np
 import pickle
 import copy
+import numbers
 
 # Some useful constants
 unknown_value = "UNKNOWN"
@@ -22,17 +22,245 @@ base_section = "base"
 config_section = "config"
 input_id_section = "input_id"
 input_path_section = "input_path"
+input_error_section = "input_error"
 git_section = "git"
 versions_section = "versions"
 comments_section = "comments"
 
+# Provenance is appended to pickle files as a list starting with this
+pickle_record_marker = "provenance_dump"
+
+# followed by a small fixed-size pickle containing this marker and where
+# the provenance record starts, so that it can be found without unpickling
+# everything else in the file.
+pickle_trailer_marker = "desc_provenance_trailer"
+
+# Layouts that can be used to store provenance in HDF5 files
+hdf_layouts = ["attributes", "compact"]
+
+# Type codes for the values in the compact HDF5 layout
+_compact_bool = 1
+_compact_int = 2
+_compact_float = 3
+_compact_str = 4
+
+# Version of the layout used to store provenance in FITS headers, and the
+# keywords that record it and the number of cards in the index of where each
+# item is stored, which follow it.  Version 1 files have no version keyword.
+fits_layout_version = 3
+fits_version_keyword = "PROVVER"
+fits_index_keyword = "PROVIDX"
+
+# Each card of the index holds the items that hash to it, as a short hash
+# and the position of the item's cards, and must fit in a single card
+fits_index_prefix = "PIDX"
+fits_index_max_cards = 9999
+fits_index_entry_size = 68
+
+
+
+def _fits_item_card(name):
+    # Match a card that is part of the provenance items
+    import re
+
+    return re.fullmatch(r"(SEC|KEY|VAL)(\d+)(_\d+)?", name)
+
+
+def _tracing():
+    # Return the trace module if any hooks are registered, or None.  Hooks
+    # can only be registered once it has been imported, so we never need
+    # to import it ourselves.
+    trace = sys.modules.get(f"{__package__}.trace")
+    return trace if trace is not None and trace.hooks else None
+
+
+def _active_cache():
+    # Return the active cache, or None.  Caching can only be switched on once
+    # the cache module has been imported, so we never need to import it here.
+    cache = sys.modules.get(f"{__package__}.cache")
+    return None if cache is None else cache.active()
+
+
+def fits_provenance_hdu(f):
+    """Return the HDU of an open FITS file that contains the provenance.
+
+    This is the provenance extension if there is one, or the primary
+    HDU otherwise.
+    """
+    return f[provenance_group] if provenance_group in f else f[0]
+
+
+def _fits_index_slot(section, key, ncard):
+    # Which card of a FITS index an item goes in, and the tag that
+    # identifies it there
+    import hashlib
+
+    digest = hashlib.blake2b(f"{section}\0{key}".encode(), digest_size=8).digest()
+    h = int.from_bytes(digest, "little")
+    return h % ncard, f"{h // ncard % 0x1000000:06x}"
+
+
+def _pickle_trailer(offset):
+    # The trailer is itself a valid pickle, so that anything reading the
+    # file object by object can still do so.  Its size does not depend on
+    # the offset.
+    packed = offset.to_bytes(8, "little")
+    return pickle.dumps((pickle_trailer_marker, packed), protocol=4)
+
+
+def _parse_pickle_trailer(data):
+    # Get the record offset from a trailer, or None if the data is not one.
+    # The offset is packed into the eight bytes before the final four opcodes.
+    template = _pickle_trailer(0)
+    n = len(template) - 12
+    if (
+        len(data) != len(template)
+        or data[:n] != template[:n]
+        or data[n + 8 :] != template[n + 8 :]
+    ):
+        return None
+    return int.from_bytes(data[n : n + 8], "little")
+
+
+def _is_pickle_record(obj):
+    return isinstance(obj, list) and len(obj) == 3 and obj[0] == pickle_record_marker
+
+
+def _compact_hdf_dtype():
+    # Each item in a compact HDF5 section is stored as a row with its key,
+    # a type code, and a column for each type of value.
+    import numpy as np
+    import h5py
+
+    return np.dtype(
+        [
+            ("key", h5py.string_dtype()),
+            ("type", "u1"),
+            ("int", "i8"),
+            ("float", "f8"),
+            ("str", h5py.string_dtype()),
+        ]
+    )
+
+
+def _encode_compact_section(items):
+    # Convert a dict of items into an array for the compact HDF5 layout.
+    # Values of other types are returned separately to be stored as
+    # attributes instead.
+    import numpy as np
+
+    rows = []
+    extras = {}
+    for key, value in items.items():
+        if isinstance(value, (bool, np.bool_)):
+            rows.append((key, _compact_bool, int(value), 0.0, ""))
+        elif isinstance(value, numbers.Integral) and -(2**63) <= value < 2**63:
+            rows.append((key, _compact_int, int(value), 0.0, ""))
+        elif isinstance(value, numbers.Real):
+            rows.append((key, _compact_float, 0, float(value), ""))
+        elif isinstance(value, str):
+            rows.append((key, _compact_str, 0, 0.0, value))
+        else:
+            extras[key] = value
+    return np.array(rows, dtype=_compact_hdf_dtype()), extras
+
+
+def _decode_compact_section(data):
+    # The inverse of _encode_compact_section
+    d = {}
+    for key, code, i, x, text in data.tolist():
+        key = key.decode("utf-8")
+        if code == _compact_bool:
+            d[key] = bool(i)
+        elif code == _compact_int:
+            d[key] = i
+        elif code == _compact_float:
+            d[key] = x
+        else:
+            d[key] = text.decode("utf-8")
+    return d
+
+
+def hdf_section_items(group):
+    """Read all the provenance items in one section of an HDF5 file.
+
+    Sections can be stored as a group with an attribute for each item,
+    or in the compact layout as a single dataset, which may also have
+    attributes for any items that were added later or are of other types.
+
+    Parameters
+    ----------
+    group: h5py.Group or h5py.Dataset
+        The section
+
+    Returns
+    -------
+    dict
+        The key: value pairs in the section
+    """
+    import h5py
+
+    d = {}
+    if isinstance(group, h5py.Dataset):
+        d.update(_decode_compact_section(group[()]))
+    d.update(group.attrs.items())
+    return d
+
+
+def hdf_section_item(group, key):
+    """Read a single item from one section of an HDF5 file.
+
+    See hdf_section_items for the layouts this can read.
+
+    Parameters
+    ----------
+    group: h5py.Group or h5py.Dataset
+        The section
+
+    key: str
+        The item name
+
+    Returns
+    -------
+    value or None
+        None if the item is not present
+    """
+    import h5py
+
+    # Attributes take precedence, as in hdf_section_items
+    value = group.attrs.get(key)
+    if value is None and isinstance(group, h5py.Dataset):
+        value = _decode_compact_section(group[()]).get(key)
+    return value
+
+
+def hdf_comments(group):
+    """Read the comments from an HDF5 file.
+
+    Parameters
+    ----------
+    group: h5py.Group or h5py.Dataset
+        The comments section
+
+    Returns
+    -------
+    list
+    """
+    import h5py
+
+    comments = []
+    if isinstance(group, h5py.Dataset):
+        comments.extend(group.asstr()[()].tolist())
+    comments.extend(group.attrs.values())
+    return comments
+
 
 def writer_method(method):
     """Do some book-keeping to turn a provenance method into a writer method
 
     We put this decorator around all the methods that write
-    provenance to a file, so that they all generate, remove,
-    and return a unique ID for each new file they write to.
+    provenance to a file, so that they all generate and return a unique
+    ID for each new file they write to, without changing the object.
 
     It's not intended for users.
     """
@@ -41,25 +269,74 @@ def writer_method(method):
     # etc.
     @functools.wraps(method)
     def wrapped_method(self, *args, **kwargs):
-        # Record it in the provenance object
-        file_id = self.generate_file_id()
+        # Write from a copy that has the new ID, rather than adding it to
+        # this object, so that several threads can write the same object
+        # to different files at once.
+        file_id = uuid.uuid4().hex
 
-        # I was a bit confused at the need to include
-        # self here, but it seems to be required
+        writer = self._with_file_id(file_id)
         try:
-            method(self, *args, **kwargs)
+            trace = _tracing()
+            if trace is not None:
+                path = args[0] if args else None
+                with trace.span(method.__name__, path, len(writer.provenance)):
+                    method(writer, *args, **kwargs)
+            else:
+                method(writer, *args, **kwargs)
         finally:
-            # At the end, remove it from the Provenance, because it will not
-            # be relevant for future files
-            del self.provenance[base_section, "file_id"]
-        # But return it; this is mainly to help testing
+            # Make sure we never use old cached information for this file
+            c = _active_cache()
+            if c is not None and args and utils.is_path(args[0]):
+                c.invalidate(args[0])
         return file_id
 
     return wrapped_method
 
 
+def reader_method(method):
+    """Time a _read_get_* method if any trace hooks are registered.
+
+    The span is named read_<type> or get_<type> depending on whether
+    a single item was asked for.
+
+    It's not intended for users.
+    """
+    file_type = method.__name__[len("_read_get_") :]
+
+    @functools.wraps(method)
+    def wrapped_method(cls, filename, item=None):
+        trace = _tracing()
+        if trace is None:
+            return method(cls, filename, item)
+        if item is None:
+            with trace.span(f"read_{file_type}", filename) as s:
+                result = method(cls, filename, item)
+                s.nkeys = len(result[0])
+        else:
+            with trace.span(f"get_{file_type}", filename, 1):
+                result = method(cls, filename, item)
+        return result
+
+    return wrapped_method
+
+
+def decoded_value(section, key, value):
+    """Undo any compression applied to a stored provenance value.
+
+    Only the git diff can currently be compressed.
+    """
+    if section == git_section and key == "diff":
+        return git.decode_diff(value)
+    return value
+
+
 def writable_value(x):
-    if isinstance(x, (int, np.integer)) or isinstance(x, (float, np.floating)):
+    if isinstance(x, (int, float)):
+        return x
+    # Numpy values can only exist if numpy has already been imported,
+    # so we can avoid importing it ourselves.
+    np = sys.modules.get("numpy")
+    if np is not None and isinstance(x, (np.integer, np.floating)):
         return x
     return str(x)
 
@@ -71,19 +348,82 @@ class Provenance:
     provenance[category, key] = value
     """
 
+    # Limits on the git diff recorded by generate.  The diff is cut
+    # after this many bytes, and can be compressed with "zlib" or "zstd".
+    # Its full size and hash are always recorded.
+    diff_max_bytes = git.DEFAULT_DIFF_MAX_BYTES
+    diff_compression = None
+
+    # Maximum time in seconds to wait for the domain name of this machine
+    # to be looked up, after which we use its plain host name.
+    domain_timeout = utils.DEFAULT_HOST_TIMEOUT
+
+    # How write_hdf stores provenance, one of hdf_layouts.  The "compact"
+    # layout stores each section as a single dataset instead of one
+    # attribute per item, which is much faster for large sections.
+    # Both layouts can always be read.
+    hdf_layout = "attributes"
+
+    # By default YAML is read with the (C-accelerated, if available) safe
+    # loader, and provenance-only YAML files are written with the safe
+    # dumper.  Files with other content are always updated in round-trip
+    # mode to preserve their comments and formatting.  Set this to True to
+    # use round-trip mode for everything.
+    yaml_round_trip = False
+
+    # Number of threads used by generate to find the IDs of input files
+    # (None for the default number), and the maximum time in seconds to
+    # spend on each one (None for no limit).
+    input_max_workers = None
+    input_timeout = None
+
     def __init__(self, code_dir=None, parent_frames=0):
         """Create an empty provenance object"""
         self.code_dir = code_dir or utils.get_caller_directory(parent_frames + 1)
         self.provenance = {}
         self.comments = []
+        # How long each stage of generate took
+        self.timings = {}
+        # Our items as shared by copies, and the dictionary they came from
+        self._snapshot = None
 
     def copy(self):
-        cls = self.__class__
-        cp = cls(code_dir=self.code_dir)
-        cp.provenance = copy.deepcopy(self.provenance)
-        cp.comments = copy.deepcopy(self.comments)
+        """
+        Make a copy of this provenance, which can be changed independently.
+
+        This is quick even for large provenance, since the values are shared
+        with the copy rather than copied, and each copy keeps only its own
+        changes.  Copies made without changing this object in between share
+        a single snapshot of its items.  Settings like hdf_layout made on this
+        object are kept.  Values that can be changed in place, like lists, are
+        also shared, so should be replaced rather than changed, and changes
+        should be made through this object rather than to its provenance
+        dictionary directly.
+
+        Returns
+        -------
+        Provenance
+        """
+        if isinstance(self.provenance, utils.CopyOnWriteDict):
+            items = self.provenance.copy()
+        else:
+            items = self._snapshot_items().copy()
+        cp = copy.copy(self)
+        cp.provenance = items
+        cp.comments = self.comments[:]
+        cp.timings = self.timings.copy()
+        cp._snapshot = None
         return cp
 
+    def _snapshot_items(self):
+        # A frozen copy of our items for copies to share, so that our own
+        # dictionary can stay a plain one.  It is kept until we are changed.
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] is not self.provenance:
+            frozen = utils.CopyOnWriteDict(dict(self.provenance))
+            snapshot = self._snapshot = (self.provenance, frozen)
+        return snapshot[1]
+
     # Generation methods
     # ------------------
     def generate(
@@ -112,48 +452,176 @@ class Provenance:
             Optional comments to include.  Not intended to be machine-readable
         directory: str or None
             Optional directory in which to run git information
+
+        Afterwards the timings attribute maps the name of each stage to the
+        time in seconds it took: core (including looking up the domain name),
+        git_diff, git_head, module_versions, argv, and user_info (including
+        finding the IDs of the input files).
         """
+        self.timings = {}
         # Record various core pieces of information
-        self._add_core_info()
+        with self._stage("core"):
+            self._add_core_info()
         self._add_git_info(directory)
-        self._add_module_versions()
-        self._add_argv_info()
+        with self._stage("module_versions"):
+            self._add_module_versions()
+        with self._stage("argv"):
+            self._add_argv_info()
+        with self._stage("user_info"):
+            self._add_user_info(user_config, input_files, comments)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        # Time one stage of generate, and tell any trace hooks about it
+        trace = _tracing()
+        if trace is not None:
+            with trace.span(f"generate.{name}") as s:
+                yield
+            self.timings[name] = s.duration
+        else:
+            t = time.perf_counter()
+            yield
+            self.timings[name] = time.perf_counter() - t
+
+    def _staged(self, name, function, *args):
+        # Wrap a function so that calling it, for example in an executor,
+        # is timed as a stage
+        def run():
+            with self._stage(name):
+                return function(*args)
+
+        return run
+
+    async def _astage(self, name, awaitable):
+        # Time awaiting something as a stage
+        with self._stage(name):
+            return await awaitable
+
+    async def agenerate(
+        self,
+        user_config=None,
+        input_files=None,
+        comments=None,
+        directory=None,
+        executor=None,
+    ):
+        """
+        Coroutine version of generate, which does not block the event loop.
 
-        # Add user inputs
-        if input_files is not None:
-            for name, path in input_files.items():
-                self.add_input_file(name, path)
+        Git is run asynchronously, concurrently with the other information
+        collection, which is run in an executor, as is opening input files
+        to find their IDs.
 
-        # Add any specific items given by the user
-        if user_config is not None:
-            for key, value in user_config.items():
-                self[config_section, key] = writable_value(value)
+        Parameters
+        ----------
+        user_config: dict or None
+            Optional input configuration options
+        input_files: dict or None
+            Optional name_for_file: file_path dict
+        comments: list or None
+            Optional comments to include.  Not intended to be machine-readable
+        directory: str or None
+            Optional directory in which to run git information
+        executor: concurrent.futures.Executor or None
+            Executor to run blocking work in.  Defaults to the loop's
+            default executor.
 
-        if comments is not None:
-            for comment in comments:
-                self.add_comment(comment)
+        Afterwards the timings attribute has the same stages as for
+        generate, but core, git_diff, git_head, and module_versions are
+        run at the same time, so their times overlap.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        directory = directory or self.code_dir
+        self.timings = {}
+
+        core, diff, head, versions = await asyncio.gather(
+            loop.run_in_executor(executor, self._staged("core", self._core_info)),
+            self._astage(
+                "git_diff",
+                git.adiff_info(directory, self.diff_max_bytes, self.diff_compression),
+            ),
+            self._astage("git_head", git.acurrent_revision(directory)),
+            loop.run_in_executor(
+                executor, self._staged("module_versions", utils.find_module_versions)
+            ),
+        )
+
+        # Store everything in the same order that generate does
+        self.update(core)
+        for key, value in diff.items():
+            self[git_section, key] = value
+        self[git_section, "head"] = head
+        self._add_module_versions(versions)
+        with self._stage("argv"):
+            self._add_argv_info()
+
+        await loop.run_in_executor(
+            executor,
+            self._staged(
+                "user_info", self._add_user_info, user_config, input_files, comments
+            ),
+        )
 
     # Core methods called in generate above
     # -------------------------------------
+    def _core_info(self):
+        domain, domain_source = utils.host_name(self.domain_timeout)
+        return {
+            (base_section, "process_id"): uuid.uuid4().hex,
+            (base_section, "domain"): domain,
+            (base_section, "domain_source"): domain_source,
+            (base_section, "creation"): datetime.datetime.now().isoformat(),
+            (base_section, "user"): utils.user_name(),
+        }
+
     def _add_core_info(self):
-        self[base_section, "process_id"] = uuid.uuid4().hex
-        self[base_section, "domain"] = socket.getfqdn()
-        self[base_section, "creation"] = datetime.datetime.now().isoformat()
-        self[base_section, "user"] = getpass.getuser()
+        self.update(self._core_info())
 
     def _add_argv_info(self):
         for i, arg in enumerate(sys.argv):
             self[base_section, f"argv_{i}"] = arg
 
     def _add_git_info(self, directory):
-        # Add some git information
-        self[git_section, "diff"] = git.diff(directory)
-        self[git_section, "head"] = git.current_revision()
-
-    def _add_module_versions(self):
-        for module, version in utils.find_module_versions().items():
+        # Add some git information.  Both of these are cached
+        # for each repository, so repeated calls are cheap.
+        directory = directory or self.code_dir
+        with self._stage("git_diff"):
+            diff = git.diff_info(
+                directory,
+                max_bytes=self.diff_max_bytes,
+                compression=self.diff_compression,
+            )
+        for key, value in diff.items():
+            self[git_section, key] = value
+        with self._stage("git_head"):
+            self[git_section, "head"] = git.current_revision(directory)
+
+    def _add_module_versions(self, versions=None):
+        if versions is None:
+            versions = utils.find_module_versions()
+        for module, version in versions.items():
             self[versions_section, module] = version
 
+    def _add_user_info(self, user_config, input_files, comments):
+        # Add user inputs
+        if input_files is not None:
+            self.add_input_files(
+                input_files,
+                max_workers=self.input_max_workers,
+                timeout=self.input_timeout,
+            )
+
+        # Add any specific items given by the user
+        if user_config is not None:
+            for key, value in user_config.items():
+                self[config_section, key] = writable_value(value)
+
+        if comments is not None:
+            for comment in comments:
+                self.add_comment(comment)
+
     def add_input_file(self, name, path):
         """
         Tell the provenance the name and path to one of your input files
@@ -169,16 +637,124 @@ class Provenance:
         """
         # get the absolute form path to the file
         path = str(pathlib.Path(path).absolute().resolve())
+        self._record_input_file(name, path, self._find_input_id(path))
 
-        # Save it in ourselves
-        self[input_path_section, name] = path
+    def add_input_files(self, input_files, max_workers=None, timeout=None):
+        """
+        Tell the provenance the names and paths of several input files.
+
+        This does the same as calling add_input_file for each of them, but
+        opens the files in parallel to find their IDs.  They are recorded
+        in the same order as the input dictionary.
+
+        Parameters
+        ----------
+        input_files: dict
+            Maps names or tags to file paths
+
+        max_workers: int or None
+            Maximum number of threads to use.  None for the default number.
+
+        timeout: float or None
+            Maximum time in seconds to spend finding the ID of any one file.
+            None for no limit.  The files are opened in daemon threads, so
+            any that are still stuck opening a file afterwards, for example
+            on an unresponsive network file system, are abandoned and do not
+            stop the interpreter from exiting.
+        """
+        paths = {
+            name: str(pathlib.Path(path).absolute().resolve())
+            for name, path in input_files.items()
+        }
+
+        # There's no point starting threads for a single file
+        if len(paths) < 2 and timeout is None:
+            for name, path in paths.items():
+                self._record_input_file(name, path, self._find_input_id(path))
+            return
+
+        import concurrent.futures
+        import threading
+        import queue
+
+        # Note when each file's work actually starts, since it may
+        # wait in the queue for a while first
+        start_times = {}
+
+        # We use our own daemon threads rather than a ThreadPoolExecutor,
+        # since the interpreter waits for the executor's threads on exit
+        work = queue.SimpleQueue()
+        futures = {}
+        for name, path in paths.items():
+            futures[name] = concurrent.futures.Future()
+            work.put((name, path, futures[name]))
+
+        def worker():
+            while True:
+                try:
+                    name, path, future = work.get_nowait()
+                except queue.Empty:
+                    return
+                if not future.set_running_or_notify_cancel():
+                    continue
+                start_times[name] = time.monotonic()
+                try:
+                    future.set_result(self._find_input_id(path))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        if max_workers is None:
+            # The same default as ThreadPoolExecutor
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        for _ in range(min(max_workers, len(paths))):
+            threading.Thread(target=worker, name="provenance-input", daemon=True).start()
+
+        try:
+            for name, future in futures.items():
+                result = None
+                while result is None:
+                    start = start_times.get(name)
+                    if start is None or timeout is None:
+                        wait = timeout
+                    else:
+                        wait = max(0, start + timeout - time.monotonic())
+                    try:
+                        result = future.result(wait)
+                    except concurrent.futures.TimeoutError:
+                        # If the file has not started yet then keep waiting
+                        start = start_times.get(name)
+                        if start is not None and time.monotonic() - start >= timeout:
+                            result = (
+                                unknown_value,
+                                f"TimeoutError: no ID found within {timeout} seconds",
+                            )
+                self._record_input_file(name, paths[name], result)
+        finally:
+            # Any files that haven't been started are skipped, and threads
+            # stuck on files are left to finish or not on their own
+            for future in futures.values():
+                future.cancel()
+
+    @classmethod
+    def _find_input_id(cls, path):
         # If the file was saved with its own provenance then it will have its own
-        # unique file_id.  Try to record that ID.  The file may be some other type,
-        # or not have provenance, so ignore any errors here.
+        # unique file_id.  Try to find that ID.  The file may be some other type,
+        # or not have provenance, so in that case we record the reason.
+        # Returns (file_id, reason) where the reason is None if it was found
         try:
-            self[input_id_section, name] = self.get(path, base_section, "file_id")
-        except:
-            self[input_id_section, name] = unknown_value
+            return cls.get(path, base_section, "file_id"), None
+        except Exception as e:
+            return unknown_value, f"{type(e).__name__}: {e}"
+
+    def _record_input_file(self, name, path, result):
+        file_id, reason = result
+        self[input_path_section, name] = path
+        self[input_id_section, name] = file_id
+        if reason is None:
+            self._snapshot = None
+            self.provenance.pop((input_error_section, name), None)
+        else:
+            self[input_error_section, name] = reason
 
     def add_comment(self, comment):
         """
@@ -198,14 +774,16 @@ class Provenance:
     # ------------------
     def __getitem__(self, section_name):
         section, name = section_name
-        return self.provenance[section, name]
+        return decoded_value(section, name, self.provenance[section, name])
 
     def __setitem__(self, section_name, value):
         section, name = section_name
+        self._snapshot = None
         self.provenance[section, name] = value
 
     def __delitem__(self, section_name):
         section, name = section_name
+        self._snapshot = None
         del self.provenance[section, name]
 
     def update(self, d):
@@ -220,6 +798,7 @@ class Provenance:
         d: dict or mapping
             The dict to update from.
         """
+        self._snapshot = None
         for (section, name), value in d.items():
             self.provenance[section, name] = value
 
@@ -253,7 +832,7 @@ class Provenance:
 
         # If passed a directory, make a provenance file in that directory
         if suffix == "" and isinstance(f, pathlib.Path) and f.is_dir():
-            return self.write_yaml(f + "provenance.yaml")
+            return self.write_prov(f / "provenance.prov")
 
         if suffix and not suffix.startswith("."):
             suffix = "." + suffix
@@ -267,14 +846,45 @@ class Provenance:
             ".yaml": self.write_yaml,
             ".pkl": self.write_pickle,
             ".pickle": self.write_pickle,
+            ".prov": self.write_prov,
         }
         method = writers.get(suffix)
 
+        # For other file types, write a provenance file alongside it
         if method is None:
-            return self.write_yaml(f + ".provenance.yaml")
+            if not isinstance(f, pathlib.Path):
+                raise errors.ProvenanceFileTypeUnknown(
+                    f"Cannot write provenance to an open file with suffix {suffix}"
+                )
+            return self.write_prov(f.with_name(f.name + ".provenance.prov"))
 
         return method(f)
 
+    def write_many(self, paths, max_workers=None):
+        """
+        Write this provenance to several files at once, each with its own file ID.
+
+        The file types are guessed from their suffixes, as in write.
+
+        Parameters
+        ----------
+        paths: list
+            The file names to write to
+
+        max_workers: int or None
+            Maximum number of threads to use.  None for the default number.
+
+        Returns
+        -------
+        dict
+            Maps each path to the file ID written to it
+        """
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {path: executor.submit(self.write, path) for path in paths}
+            return {path: future.result() for path, future in futures.items()}
+
     def read(self, filename):
         """
         Read all provenance from any supported file type, guessing
@@ -291,24 +901,36 @@ class Provenance:
         -------
         None
         """
-        p = pathlib.Path(filename)
+        d, com = self._read_get(filename)
+        self.update(d)
+        self.comments.extend(com)
 
-        readers = {
-            ".hdf": self.read_hdf,
-            ".hdf5": self.read_hdf,
-            ".fits": self.read_fits,
-            ".fit": self.read_fits,
-            ".yml": self.read_yaml,
-            ".yaml": self.read_yaml,
-            ".pkl": self.read_yaml,
-            ".pickle": self.read_pickle,
-        }
+    @classmethod
+    def read_record(cls, filename, interner=None):
+        """
+        Read all provenance from any supported file type into a compact,
+        read-only record, guessing the file type from its suffix.
 
-        method = readers.get(p.suffix)
-        if method is None:
-            raise errors.ProvenanceFileTypeUnknown(filename)
+        Records take much less memory than Provenance objects, since
+        they share their keys and any equal values with other records.
+        Use this when many files' provenance is needed at the same time.
+
+        Parameters
+        ----------
+        filename: str
 
-        return method(filename)
+        interner: desc_provenance.record.Interner or None
+            Where to share values with other records.  Defaults to
+            the shared default_interner.
+
+        Returns
+        -------
+        desc_provenance.record.ProvenanceRecord
+        """
+        from .record import ProvenanceRecord
+
+        d, com = cls._read_get(filename)
+        return ProvenanceRecord(d, com, interner)
 
     @classmethod
     def get(cls, filename, section, key):
@@ -337,26 +959,260 @@ class Provenance:
         if not p.exists():
             raise errors.ProvenanceMissingFile(filename)
 
-        getters = {
-            ".hdf": cls.get_hdf,
-            ".hdf5": cls.get_hdf,
-            ".fits": cls.get_fits,
-            ".fit": cls.get_fits,
-            ".yml": cls.get_yaml,
-            ".yaml": cls.get_yaml,
-            ".pkl": cls.get_pickle,
-            ".pickle": cls.get_pickle,
-        }
+        value = cls._read_get(filename, (section, key))
+        return decoded_value(section, key, value)
+
+    # The internal methods used to read or get provenance for each file suffix
+    _read_get_methods = {
+        ".hdf": "_read_get_hdf",
+        ".hdf5": "_read_get_hdf",
+        ".fits": "_read_get_fits",
+        ".fit": "_read_get_fits",
+        ".yml": "_read_get_yaml",
+        ".yaml": "_read_get_yaml",
+        ".pkl": "_read_get_pickle",
+        ".pickle": "_read_get_pickle",
+        ".prov": "_read_get_prov",
+    }
 
-        method = getters.get(p.suffix)
+    @classmethod
+    def _read_get(cls, filename, item=None):
+        # Read everything, or a single item, from a named file of any type,
+        # using the cache if it is switched on.
+        method = cls._read_get_methods.get(pathlib.Path(filename).suffix)
         if method is None:
             raise errors.ProvenanceFileTypeUnknown(filename)
+        method = getattr(cls, method)
+
+        c = _active_cache()
+        if c is None:
+            return method(filename, item)
+        return c.read_get(filename, item, lambda: method(filename, item))
+
+    @classmethod
+    def enable_cache(
+        cls,
+        max_entries=1024,
+        max_bytes=256 * 2**20,
+        sqlite_path=None,
+        sqlite_max_entries=100000,
+    ):
+        """
+        Switch on caching of the provenance read by get and read.
+
+        Files are only re-read if their size, modification time, or inode
+        have changed.  The cache is kept in memory, and optionally also in an
+        SQLite database that other processes on the same machine can share.
+
+        Parameters
+        ----------
+        max_entries: int
+            Maximum number of files to keep in memory
+
+        max_bytes: int
+            Maximum total memory to use for the cache, roughly.  The least
+            recently used files are dropped first.
+
+        sqlite_path: str or None
+            Path to an SQLite database to also cache provenance in.
+
+        sqlite_max_entries: int
+            Maximum number of files to keep in the database
+
+        Returns
+        -------
+        desc_provenance.cache.ProvenanceCache
+            The new cache
+        """
+        from . import cache
+
+        return cache.enable(max_entries, max_bytes, sqlite_path, sqlite_max_entries)
+
+    @classmethod
+    def disable_cache(cls):
+        """Switch off caching of the provenance read by get and read."""
+        from . import cache
+
+        cache.disable()
+
+    @classmethod
+    def enable_hdf_pool(cls, max_handles=64, locking=False):
+        """
+        Keep HDF5 files that are read by get, read, or add_input_file open.
+
+        Opening HDF5 files can be slow on parallel file systems.  With this
+        switched on, up to max_handles files are kept open for reading, and
+        re-used if they are read again.  Files are re-opened if they change
+        on disk, and closed before they are written to.
+
+        Parameters
+        ----------
+        max_handles: int
+            Maximum number of files to keep open
+
+        locking: bool
+            Whether to open the files with HDF5 file locking, which stops
+            other processes writing to them while they are in the pool.
+
+        Returns
+        -------
+        desc_provenance.pool.HDFHandlePool
+            The new pool
+        """
+        from . import pool
+
+        return pool.enable(max_handles, locking)
+
+    @classmethod
+    def disable_hdf_pool(cls):
+        """Close any pooled HDF5 files, and stop keeping them open."""
+        from . import pool
+
+        pool.disable()
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Open a read-only view of the provenance in a file, guessing
+        the file type from its suffix.
+
+        The view keeps the file open and loads nothing until it is needed,
+        so it is much faster than get for reading several items.  HDF5
+        sections and indexed FITS items are read individually; other formats
+        are read in full the first time anything is asked for.  Use it as a
+        context manager, or close it:
+        ```
+        with Provenance.open(filename) as view:
+            file_id, head = view.get_many([("base", "file_id"), ("git", "head")])
+            config = view.section("config")
+        ```
+
+        Parameters
+        ----------
+        filename: str
+
+        Returns
+        -------
+        ProvenanceView
+        """
+        from .view import ProvenanceView
+
+        return ProvenanceView(filename)
+
+    @classmethod
+    def ancestry(cls, filename, max_depth=None, max_workers=None, memo=None):
+        """
+        Follow the input files recorded in a file back through their own inputs.
+
+        Each file is read only once, however many files used it, and the files
+        at each generation are read in parallel.  Each edge of the result notes
+        whether the file_id recorded for an input matches the ID in that file
+        now.  To find what was made from a file instead, use
+        desc_provenance.catalog.Catalog.descendants.
+
+        Parameters
+        ----------
+        filename: str or pathlib.Path
+
+        max_depth: int or None
+            Maximum number of generations to follow, or None for no limit
+
+        max_workers: int or None
+            Maximum number of threads to read files with.  None for the
+            default number.
+
+        memo: dict or None
+            What has been read from each file, which can be passed to several
+            calls to avoid reading the same files again.  Only share it between
+            calls when the files are not changing.
+
+        Returns
+        -------
+        desc_provenance.lineage.Lineage
+            The graph of the file and its ancestors
+        """
+        from .lineage import ancestry
+
+        return ancestry(filename, max_depth, max_workers, memo)
+
+    async def awrite(self, f, suffix=None, executor=None):
+        """
+        Coroutine version of write, which runs the file I/O in an executor.
+
+        Parameters
+        ----------
+        f: str or writeable object
+        suffix: str
+            Must be supplied if f is a file-like object
+        executor: concurrent.futures.Executor or None
+            Executor to run the write in.  Defaults to the loop's
+            default executor.
+
+        Returns
+        -------
+        str
+            The newly-assigned file ID
+        """
+        import asyncio
 
-        return method(filename, section, key)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(self.write, f, suffix)
+        )
+
+    async def aread(self, filename, executor=None):
+        """
+        Coroutine version of read, which runs the file I/O in an executor.
+
+        Parameters
+        ----------
+        filename: str
+        executor: concurrent.futures.Executor or None
+            Executor to run the read in.  Defaults to the loop's
+            default executor.
+
+        Returns
+        -------
+        None
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.read, filename)
+
+    @classmethod
+    async def aget(cls, filename, section, key, executor=None):
+        """
+        Coroutine version of get, which runs the file I/O in an executor.
+
+        Parameters
+        ----------
+        filename: str
+
+        section: str
+
+        key: str
+
+        executor: concurrent.futures.Executor or None
+            Executor to run the read in.  Defaults to the loop's
+            default executor.
+
+        Returns
+        -------
+        value: any
+            The native value of the key in this value
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, cls.get, filename, section, key
+        )
 
     # HDF Methods
     # -----------
     @classmethod
+    @reader_method
     def _read_get_hdf(cls, hdf_file, item=None):
         with utils.open_hdf(hdf_file, "r") as f:
             # If the whole provenance section is missing, e.g.
@@ -379,21 +1235,20 @@ class Provenance:
                 for section in g.keys():
                     sg = g[section]
                     if section == comments_section:
-                        for val in sg.attrs.values():
-                            comments.append(val)
+                        comments.extend(hdf_comments(sg))
                     else:
-                        # and read all the attributes in each one
-                        for key, val in sg.attrs.items():
+                        # and read all the items in each one
+                        for key, val in hdf_section_items(sg).items():
                             d[section, key] = val
                 return d, comments
             # Otherwise just read the one requested item
             else:
                 section, key = item
-                if section not in g.keys():
+                if section not in g:
                     raise errors.ProvenanceMissingItem(f"{section}/{key}")
 
                 # Will be None if not present
-                value = g[section].attrs.get(key)
+                value = hdf_section_item(g[section], key)
 
                 if value is None:
                     raise errors.ProvenanceMissingItem(item)
@@ -420,7 +1275,8 @@ class Provenance:
         value
             The value (of any type) found in the file
         """
-        return cls._read_get_hdf(hdf_file, (section, key))
+        value = cls._read_get_hdf(hdf_file, (section, key))
+        return decoded_value(section, key, value)
 
     def read_hdf(self, hdf_file):
         """Read provenance from an HDF5 file.
@@ -452,26 +1308,39 @@ class Provenance:
         str
             The newly-assigned file ID
         """
+        if self.hdf_layout not in hdf_layouts:
+            raise ValueError(
+                f"Unknown HDF layout {self.hdf_layout}; should be one of {hdf_layouts}"
+            )
+
         with utils.open_hdf(hdf_file, "a") as f:
             # Group may or may not exist already
-            if provenance_group in f.keys():
+            if provenance_group in f:
                 g = f[provenance_group]
             else:
                 g = f.create_group(provenance_group)
 
+            if self.hdf_layout == "compact":
+                self._write_hdf_compact(g)
+                return
+
             # Write each category to a subgroup
+            subgroups = {}
             for (section, key), value in self.provenance.items():
-                # Create subgroup if it does not exist already
-                if section not in g.keys():
-                    subg = g.create_group(section)
-                else:
-                    subg = g[section]
+                subg = subgroups.get(section)
+                if subg is None:
+                    # Create subgroup if it does not exist already
+                    if section not in g:
+                        subg = g.create_group(section)
+                    else:
+                        subg = g[section]
+                    subgroups[section] = subg
 
                 # Write values to subgroup attributes
                 subg.attrs[key] = value
 
             # Write comments in this section if needed
-            if comments_section not in g.keys():
+            if comments_section not in g:
                 subg = g.create_group(comments_section)
             else:
                 subg = g[comments_section]
@@ -479,6 +1348,35 @@ class Provenance:
             for i, comment in enumerate(self.comments):
                 subg.attrs[f"comment_{i}"] = comment
 
+    def _write_hdf_compact(self, g):
+        # Write each section as a single dataset, in one call
+        import h5py
+
+        sections = collections.defaultdict(dict)
+        for (section, key), value in self.provenance.items():
+            sections[section][key] = value
+
+        for section, items in sections.items():
+            if section in g:
+                # Keep any items already in the file, in either layout,
+                # unless we are replacing them
+                old = hdf_section_items(g[section])
+                old.update(items)
+                items = old
+                del g[section]
+            data, extras = _encode_compact_section(items)
+            ds = g.create_dataset(section, data=data)
+            for key, value in extras.items():
+                ds.attrs[key] = value
+
+        # As in the attribute layout, our comments replace the first ones
+        # already in the file
+        comments = self.comments
+        if comments_section in g:
+            comments = comments + hdf_comments(g[comments_section])[len(comments) :]
+            del g[comments_section]
+        g.create_dataset(comments_section, data=comments, dtype=h5py.string_dtype())
+
     # FITS Methods
     # ------------
     @classmethod
@@ -501,7 +1399,8 @@ class Provenance:
         value
             The value (of any type) found in the file
         """
-        return cls._read_get_fits(fits_file, (section, key))
+        value = cls._read_get_fits(fits_file, (section, key))
+        return decoded_value(section, key, value)
 
     def read_fits(self, fits_file):
         """Read proveance from a FITS file.
@@ -532,151 +1431,390 @@ class Provenance:
         str
             The newly-assigned file ID
         """
+        # Build the complete list of header keywords first, so that we can
+        # reserve space for them all and then write them in one go.
+        # To maintain case we store items as a trio of keys specifying
+        # category, key, and value.  Each entry is the list of records
+        # for one item.
+        items = []
+
+        for i, ((section, key), value) in enumerate(self.provenance.items()):
+            # FITS header items can't contain newlines, so we break up
+            # any text with newlines into separate entries which we patch
+            # together again when loading
+            if isinstance(value, str) and "\n" in value:
+                values = value.split("\n")
+                # There's some kind of bug in CFITSIO that lets you write
+                # but not read certain text that includes new lines when the
+                # key is longer than 8 characters.  This avoids that because
+                # our keys are always shorter than this in this case
+                if len(values) > 999:
+                    warnings.warn(
+                        f"Cannot write all very long item {section}/{key} to FITS provenance (>999 lines).  Truncating."
+                    )
+                    values = values[:999]
+                suffixes = [f"{i}_{j}" for j in range(len(values))]
+            # or if it's any other item we just put it in directly
+            else:
+                values = [value]
+                suffixes = [i]
+            records = []
+            for v, suffix in zip(values, suffixes):
+                records += [(f"SEC{suffix}", section), (f"KEY{suffix}", key), (f"VAL{suffix}", v)]
+            items.append((section, key, records))
+
+        # Format the cards ourselves where we can.  Appending these directly
+        # is much faster than having CFITSIO search the header for an
+        # existing key each time, and means we know where each item will be,
+        # for the index.  Items with any cards we can't format are left to
+        # CFITSIO, after everything else.
+        formatted = []
+        unformatted = []
+        for section, key, records in items:
+            cards = [utils.format_fits_cards(name, value) for name, value in records]
+            if None in cards:
+                unformatted.append((section, key, records))
+            else:
+                formatted.append((section, key, sum(cards, [])))
+
+        # The index comes first, and its card numbers count from the
+        # card holding its size, so that it stays right if cards before it
+        # are removed or after it are added.
+        nindex = min(max(1, (len(items) + 1) // 2), fits_index_max_cards)
+        index = [[] for _ in range(nindex)]
+        position = nindex + 1
+        for section, key, cards in formatted:
+            slot, tag = _fits_index_slot(section, key, nindex)
+            index[slot].append(f"{tag}{position:x}")
+            position += len(cards)
+        for section, key, _ in unformatted:
+            # These could be anywhere
+            slot, tag = _fits_index_slot(section, key, nindex)
+            index[slot].append(f"{tag}?")
+
+        header = [(fits_version_keyword, fits_layout_version), (fits_index_keyword, nindex)]
+        for i, entries in enumerate(index):
+            entries = " ".join(entries)
+            # Items in full cards have to be looked up the slow way
+            if len(entries) > fits_index_entry_size:
+                entries = "*"
+            header.append((f"{fits_index_prefix}{i}", entries))
+        cards = sum((utils.format_fits_cards(name, value) for name, value in header), [])
+        for _, _, item_cards in formatted:
+            cards += item_cards
+
+        # The comments go after the items, so don't affect the index
+        comment_cards = [utils.format_fits_comment(c) for c in self.comments]
+        if None in comment_cards:
+            unformatted_comments = self.comments
+        else:
+            cards += sum(comment_cards, [])
+            unformatted_comments = []
+
+        # Number of header cards to reserve space for
+        nreserve = len(cards)
+        nreserve += sum(len(comment) // 70 + 1 for comment in unformatted_comments)
+        nreserve += sum(3 * len(records) for _, _, records in unformatted)
+
         with utils.open_fits(fits_file, "rw") as f:
 
             # Create the group if it doesn't exist
             if provenance_group in f:
                 ext = f[provenance_group]
+                # Remove the old provenance, since the index has to come
+                # before all the items
+                old = [
+                    r["name"]
+                    for r in ext.read_header_list()
+                    if _fits_item_card(r["name"])
+                    or r["name"].startswith(fits_index_prefix)
+                    or r["name"] in (fits_version_keyword, fits_index_keyword)
+                ]
+                ext.delete_keys(old)
             else:
-                f.create_image_hdu(extname=provenance_group)
-                f.update_hdu_list()
-                ext = f[provenance_group]
-
-            # Helper local function to write a key.
-            # To maintain case we store items as a trio
-            # of keys specifying category, key, and value
-            def write_key(s, k, v, i):
-                ext.write_key(f"SEC{i}", s)
-                ext.write_key(f"KEY{i}", k)
-                ext.write_key(f"VAL{i}", v)
-
-            # Write the keys we have one by one
-            for i, ((section, key), value) in enumerate(self.provenance.items()):
-                # FITS header items can't contain newlines, so we break up
-                # any text with newlines into separate entries which we patch
-                # together again when loading
-                if isinstance(value, str) and "\n" in value:
-                    values = value.split("\n")
-                    # There's some kind of bug in CFITSIO that lets you write
-                    # but not read certain text that includes new lines when the
-                    # key is longer than 8 characters.  This avoids that because
-                    # our keys are always shorter than this in this case
-                    if len(values) > 999:
-                        warnings.warn(
-                            f"Cannot write all very long item {section}/{key} to FITS provenance (>999 lines).  Truncating."
-                        )
-                        values = values[:999]
-                    for j, v in enumerate(values):
-                        write_key(section, key, v, f"{i}_{j}")
-                # or if it's any other item we just put it in directly
+                # The header argument is only used to reserve space
+                reserve = [None] * nreserve
+                if len(f) == 0:
+                    f.create_image_hdu(extname=provenance_group, header=reserve)
                 else:
-                    write_key(section, key, value, i)
+                    # fitsio only allows an image-less HDU as the primary
+                    f.create_image_hdu(
+                        dims=[0], dtype="u1", extname=provenance_group, header=reserve
+                    )
+                # The new HDU is always the last one
+                ext = f[len(f) - 1]
 
-            for comment in self.comments:
+            if utils.can_write_fits_cards(f):
+                utils.write_fits_cards(f, ext, cards)
+            else:
+                # Without raw cards we can't tell where CFITSIO will put
+                # things, so write everything the slow way and no index
+                unformatted = items
+                unformatted_comments = self.comments
+
+            for comment in unformatted_comments:
                 ext.write_comment(comment)
 
+            for _, _, records in unformatted:
+                for name, value in records:
+                    ext.write_key(name, value)
+
     # Internal method implementing the read and get methods
     @classmethod
+    @reader_method
     def _read_get_fits(cls, fits_file, item=None):
-        with utils.open_fits(fits_file, "r") as f:
-            ext = f[0]
-            # We may be called from the get or read methods.
-            # In the former case we will be given a specific item
-            # to get, which we split here
-            if item is not None:
-                target_sec, target_key = item
+        # If we just want a single item from a file with an index then
+        # we can read it directly from the raw header.
+        if item is not None and utils.is_path(fits_file):
+            with open(fits_file, "rb") as f:
+                found, value = cls._get_fits_indexed(f, item)
+            if found:
+                return value
 
+        with utils.open_fits(fits_file, "r") as f:
+            ext = fits_provenance_hdu(f)
             # Read the entire header. A bit wasteful if we only want a single
             # item from it, but this shouldn't be a performance bottleneck.
             hdr = ext.read_header()
+            return cls._parse_fits_header(hdr, item)
 
-            comments = [
-                k["value"].strip() for k in hdr.records() if k["name"] == "COMMENT"
-            ]
+    @classmethod
+    def _find_fits_index(cls, f):
+        # Find the index in a FITS file opened in binary mode.  Returns the
+        # header and the number of the card holding the size of the index,
+        # or None if there is no usable index.
+        header = utils.find_fits_extension(f, provenance_group)
+        if header is None:
+            return None
+
+        # The index comes before all the items, after any other cards
+        c = 0
+        while True:
+            name = utils.fits_card_name(header, c)
+            if name == fits_version_keyword:
+                break
+            if name in ("END", "") or _fits_item_card(name):
+                return None
+            c += 1
+        if (
+            utils.fits_card_value(header, c) != fits_layout_version
+            or utils.fits_card_name(header, c + 1) != fits_index_keyword
+        ):
+            return None
+        return header, c + 1
 
-            # Remove sone of the standard FITS comments put in everything
-            # by CFITSIO.
-            try:
-                comments.remove(
-                    "FITS (Flexible Image Transport System) format is defined in 'Astronomy"
-                )
-                comments.remove(
-                    "and Astrophysics', volume 376, page 359; bibcode: 2001A&A...376..359H"
-                )
-            except ValueError:
-                pass
-            # We have recorded items in trios of KEY0, SEC0, VAL0, 1, 2 etc.
-            # so count how many keys we have
-            indices = [k[3:] for k in hdr if k.upper().startswith("KEY")]
-            indices = [k for k in indices if k and k[0] in "0123456789"]
-
-            # We will collect the number of lines for each multi-line
-            # item, so we can patch together later.
-            multiline_indices = collections.defaultdict(int)
-            d = {}
-
-            # split these keys into multi-line and normal keys
-            for index in indices:
-                if "_" in index:
-                    orig_index, _ = index.split("_", 1)
-                    multiline_indices[orig_index] += 1
-                else:
-                    # Handle the normal keys just by reading them
-                    sec = hdr[f"SEC{index}"]
-                    val = hdr[f"VAL{index}"]
-                    key = hdr[f"KEY{index}"]
-                    # If this is called from get_ then return
-                    # if we have found the desired object
-                    if item is not None:
-                        if (sec == target_sec) and (key == target_key):
-                            return val
-                    # Otherwise just build up all the items
-                    else:
-                        d[sec, key] = val
-
-            # Now deal with all the multiline ones we found.
-            # we recorded the number of entries for each of them
-            for index, n in multiline_indices.items():
-                vals = []
-                # sec and key should be the same for them all
-                sec = hdr[f"SEC{index}_0"]
-                key = hdr[f"KEY{index}_0"]
-
-                # reassemble into a multi-line text
-                for i in range(n):
-                    vals.append(hdr[f"VAL{index}_{i}"])
-                val = "\n".join(vals)
-
-                # Check if the target is this multiline item
+    @classmethod
+    def _get_fits_indexed(cls, f, item, index=None):
+        # Look up an item using the index in a FITS file opened in binary
+        # mode, reading only the cards needed.  The index can be passed in
+        # if it has already been found.  Returns (False, None) if there is
+        # no usable index, in which case the caller should search the
+        # whole header instead.
+        if index is None:
+            index = cls._find_fits_index(f)
+            if index is None:
+                return False, None
+        header, start = index
+        nindex = utils.fits_card_value(header, start)
+
+        section, key = item
+        slot, tag = _fits_index_slot(section, key, nindex)
+        if utils.fits_card_name(header, start + 1 + slot) != f"{fits_index_prefix}{slot}":
+            return False, None
+        entries = utils.fits_card_value(header, start + 1 + slot) or ""
+        if entries == "*":
+            return False, None
+
+        for entry in entries.split():
+            if entry[:6] == tag:
+                break
+        else:
+            raise errors.ProvenanceMissingItem(f"Missing item {section} {key}")
+        if entry[6:] == "?":
+            return False, None
+        return cls._read_fits_item(header, start + int(entry[6:], 16), item)
+
+    @staticmethod
+    def _read_fits_item(header, c, item):
+        # Read an item from the trios of cards starting at card c, checking
+        # that they are the ones we expect, in case the header has been
+        # changed since the index was written.
+        match = _fits_item_card(utils.fits_card_name(header, c))
+        if match is None or match.group(1) != "SEC" or match.group(3) not in (None, "_0"):
+            return False, None
+        i = match.group(2)
+        multiline = match.group(3) is not None
+
+        values = []
+        while True:
+            suffix = f"{i}_{len(values)}" if multiline else i
+            trio = []
+            for prefix in ("SEC", "KEY", "VAL"):
+                if utils.fits_card_name(header, c) != f"{prefix}{suffix}":
+                    break
+                trio.append(utils.fits_card_value(header, c))
+                # Skip over any continuation cards
+                c += 1
+                while header[c * utils.FITS_CARD_SIZE : c * utils.FITS_CARD_SIZE + 8] == b"CONTINUE":
+                    c += 1
+            if len(trio) < 3:
+                break
+            if tuple(trio[:2]) != tuple(item):
+                return False, None
+            values.append(trio[2])
+            if not multiline:
+                break
+
+        if not values:
+            return False, None
+        if not multiline:
+            return True, values[0]
+        return True, "\n".join(values)
+
+    @classmethod
+    def _parse_fits_header(cls, hdr, item=None):
+        # We may be called from the get or read methods.
+        # In the former case we will be given a specific item
+        # to get, which we split here
+        if item is not None:
+            target_sec, target_key = item
+
+        comments = [
+            k["value"].strip() for k in hdr.records() if k["name"] == "COMMENT"
+        ]
+
+        # Remove sone of the standard FITS comments put in everything
+        # by CFITSIO.
+        try:
+            comments.remove(
+                "FITS (Flexible Image Transport System) format is defined in 'Astronomy"
+            )
+            comments.remove(
+                "and Astrophysics', volume 376, page 359; bibcode: 2001A&A...376..359H"
+            )
+        except ValueError:
+            pass
+        # We have recorded items in trios of KEY0, SEC0, VAL0, 1, 2 etc.
+        # so count how many keys we have
+        indices = [k[3:] for k in hdr if k.upper().startswith("KEY")]
+        indices = [k for k in indices if k and k[0] in "0123456789"]
+
+        # We will collect the number of lines for each multi-line
+        # item, so we can patch together later.
+        multiline_indices = collections.defaultdict(int)
+        d = {}
+
+        # split these keys into multi-line and normal keys
+        for index in indices:
+            if "_" in index:
+                orig_index, _ = index.split("_", 1)
+                multiline_indices[orig_index] += 1
+            else:
+                # Handle the normal keys just by reading them
+                sec = hdr[f"SEC{index}"]
+                val = hdr[f"VAL{index}"]
+                key = hdr[f"KEY{index}"]
+                # If this is called from get_ then return
+                # if we have found the desired object
                 if item is not None:
                     if (sec == target_sec) and (key == target_key):
                         return val
+                # Otherwise just build up all the items
                 else:
                     d[sec, key] = val
 
-            # If we were not asked for a specific item then return
-            # the entire thing
-            if item is None:
-                return d, comments
+        # Now deal with all the multiline ones we found.
+        # we recorded the number of entries for each of them
+        for index, n in multiline_indices.items():
+            vals = []
+            # sec and key should be the same for them all
+            sec = hdr[f"SEC{index}_0"]
+            key = hdr[f"KEY{index}_0"]
+
+            # reassemble into a multi-line text
+            for i in range(n):
+                vals.append(hdr[f"VAL{index}_{i}"])
+            val = "\n".join(vals)
+
+            # Check if the target is this multiline item
+            if item is not None:
+                if (sec == target_sec) and (key == target_key):
+                    return val
             else:
-                # If we were asked for an item then if we've got this far
-                # then we've failed.
-                raise errors.ProvenanceMissingItem(
-                    f"Missing item {target_sec} {target_key}"
-                )
+                d[sec, key] = val
+
+        # If we were not asked for a specific item then return
+        # the entire thing
+        if item is None:
+            return d, comments
+        else:
+            # If we were asked for an item then if we've got this far
+            # then we've failed.
+            raise errors.ProvenanceMissingItem(
+                f"Missing item {target_sec} {target_key}"
+            )
 
     # Other I/O Methods
     # -----------------
 
+    @staticmethod
+    def _yaml(round_trip):
+        # Make a YAML reader/writer in the chosen mode
+        import ruamel.yaml as yaml
+
+        if round_trip:
+            return yaml.YAML()
+        # This uses the C implementation if ruamel.yaml.clib is installed
+        y = yaml.YAML(typ="safe")
+        # Write nested sections in block style and in their original order,
+        # as in round-trip mode
+        y.default_flow_style = False
+        y.sort_base_mapping_type_on_output = False
+        return y
+
+    @staticmethod
+    def _is_provenance_only_yaml(text):
+        # A quick check, without parsing, for YAML text that is empty or
+        # contains only provenance, like the files we write ourselves.
+        # Every unindented line must be the provenance key, so top-level
+        # comments, other keys, and document markers all count as other
+        # content.  Anything inside the provenance is replaced on writing,
+        # so doesn't matter.
+        for line in text.splitlines():
+            if line and not line[0].isspace() and not line.startswith("provenance:"):
+                return False
+        return True
+
     @classmethod
-    def _read_get_yaml(cls, yml_file, item):
+    @reader_method
+    def _read_get_yaml(cls, yml_file, item=None):
         import ruamel.yaml as yaml
 
-        y = yaml.YAML()
+        y = cls._yaml(cls.yaml_round_trip)
 
         with utils.open_file(yml_file, "r") as f:
-            # Read the whole file
-            data = y.load(f)
+            # Single items can be found without loading the whole document
+            if item is not None and not cls.yaml_round_trip:
+                start = f.tell()
+                try:
+                    found, value = cls._get_yaml_streaming(f, item)
+                except yaml.YAMLError:
+                    found = False
+                if found:
+                    return value
+                f.seek(start)
+
+            # Read the whole file.  Safe mode can't handle things like
+            # custom tags elsewhere in the file, so try again in round-trip
+            # mode if it fails.
+            start = f.tell()
+            try:
+                data = y.load(f)
+            except yaml.YAMLError:
+                if cls.yaml_round_trip:
+                    raise
+                f.seek(start)
+                data = cls._yaml(True).load(f)
             d = data["provenance"]
             if item is not None:
                 sd = d[item[0]]
@@ -695,9 +1833,109 @@ class Provenance:
                         out[section, key] = value
             return out, com
 
+    @classmethod
+    def _get_yaml_streaming(cls, f, item):
+        # Find a single item by walking through the YAML event stream,
+        # skipping everything else without constructing it, and stopping
+        # as soon as the item has been read.  Returns (False, None) if the
+        # value can't be constructed from its own events alone, in which
+        # case the caller should load the whole document instead.
+        from ruamel.yaml import events
+        from ruamel.yaml.nodes import ScalarNode, SequenceNode, MappingNode
+
+        y = cls._yaml(False)
+        stream = y.parse(f)
+        section, key = item
+
+        def skip(event):
+            # Skip over the rest of the node that starts with this event
+            depth = 0
+            while True:
+                if isinstance(event, (events.MappingStartEvent, events.SequenceStartEvent)):
+                    depth += 1
+                elif isinstance(event, (events.MappingEndEvent, events.SequenceEndEvent)):
+                    depth -= 1
+                if depth == 0:
+                    return
+                event = next(stream)
+
+        def find(name):
+            # Move to the value of a key in the current mapping, returning
+            # its first event, or None if the key isn't there
+            while True:
+                event = next(stream)
+                if isinstance(event, events.MappingEndEvent):
+                    return None
+                if isinstance(event, events.ScalarEvent) and event.value == name:
+                    return next(stream)
+                # skip both the key and its value
+                skip(event)
+                skip(next(stream))
+
+        # The document itself should be a mapping
+        for event in stream:
+            if isinstance(event, events.MappingStartEvent):
+                break
+            if not isinstance(event, (events.StreamStartEvent, events.DocumentStartEvent)):
+                raise errors.ProvenanceMissingSection("YAML file has no provenance")
+        else:
+            raise errors.ProvenanceMissingSection("YAML file has no provenance")
+
+        event = find("provenance")
+        if not isinstance(event, events.MappingStartEvent):
+            raise errors.ProvenanceMissingSection("YAML file has no provenance")
+
+        event = find(section)
+        if isinstance(event, events.MappingStartEvent):
+            event = find(key)
+        else:
+            event = None
+
+        if event is None:
+            raise errors.ProvenanceMissingItem(f"{section}/{key}")
+
+        # Build the node for the value from its events, working out types
+        # in the same way the loader would.  Aliases to nodes elsewhere
+        # in the file are left to the full loader.
+        anchors = {}
+
+        def compose(start):
+            if isinstance(start, events.AliasEvent):
+                # raises KeyError if the anchor is outside this value
+                return anchors[start.anchor]
+            if isinstance(start, events.ScalarEvent):
+                tag = start.tag
+                if tag is None or tag == "!":
+                    tag = y.resolver.resolve(ScalarNode, start.value, start.implicit)
+                node = ScalarNode(tag, start.value, style=start.style)
+            elif isinstance(start, events.SequenceStartEvent):
+                tag = start.tag or y.resolver.resolve(SequenceNode, None, start.implicit)
+                node = SequenceNode(tag, [])
+                event = next(stream)
+                while not isinstance(event, events.SequenceEndEvent):
+                    node.value.append(compose(event))
+                    event = next(stream)
+            else:
+                tag = start.tag or y.resolver.resolve(MappingNode, None, start.implicit)
+                node = MappingNode(tag, [])
+                event = next(stream)
+                while not isinstance(event, events.MappingEndEvent):
+                    node.value.append((compose(event), compose(next(stream))))
+                    event = next(stream)
+            if start.anchor is not None:
+                anchors[start.anchor] = node
+            return node
+
+        try:
+            node = compose(event)
+        except KeyError:
+            return False, None
+        return True, y.constructor.construct_object(node, deep=True)
+
     @classmethod
     def get_yaml(self, yml_file, section, key):
-        return self._read_get_yaml(yml_file, (section, key))
+        value = self._read_get_yaml(yml_file, (section, key))
+        return decoded_value(section, key, value)
 
     def read_yaml(self, yml_file):
         """Read provenance from a YAML file.
@@ -744,11 +1982,6 @@ class Provenance:
         """
         import ruamel.yaml as yaml
 
-        # Create the YAML loader.  The default instance
-        # of this preserves comments in the YAML if present,
-        # which means we can run this code on existing
-        # commented yaml without destroying it
-        y = yaml.YAML()
         p = self._make_yml()
 
         if utils.is_path(yml_file) or "r" in yml_file.mode:
@@ -758,12 +1991,27 @@ class Provenance:
                 # and load the yaml from the start
                 s = f.tell()
                 f.seek(0)
-                d = y.load(f)
+                text = f.read()
+
+                # Files that contain nothing but provenance, like the
+                # ones we write ourselves, have nothing we need to preserve,
+                # so we can use the faster safe mode.  Otherwise the round-trip
+                # mode preserves any comments in the YAML, which means we can
+                # run this code on existing commented yaml without destroying it
+                fast = not self.yaml_round_trip and self._is_provenance_only_yaml(text)
+                if fast:
+                    try:
+                        d = self._yaml(False).load(text)
+                    except yaml.YAMLError:
+                        fast = False
+                y = self._yaml(not fast)
+                if not fast:
+                    d = y.load(text)
 
                 # if file was empty before:
                 if d is None:
                     d = {}
-                elif not (isinstance(d, yaml.comments.CommentedMap)):
+                elif not isinstance(d, dict):
                     # go back to where we started but complain that this is
                     # not a dict-type yaml file
                     f.seek(s)
@@ -779,8 +2027,9 @@ class Provenance:
                 y.dump(d, f)
                 f.truncate()
         else:
-            # filed opened in write-only mpde
-            y.dump(x, f)
+            # file opened in write-only mode, so there is nothing to preserve
+            y = self._yaml(self.yaml_round_trip)
+            y.dump({"provenance": p}, yml_file)
 
     @writer_method
     def write_pickle(self, pickle_file):
@@ -797,48 +2046,77 @@ class Provenance:
             The newly-assigned file ID
         """
 
+        # Store a plain dict, in case this is a copy
+        record = [pickle_record_marker, dict(self.provenance), self.comments]
+
         if utils.is_path(pickle_file) or "r" in pickle_file.mode:
-            with utils.open_file(pickle_file, "r+") as f:
+            with utils.open_file(pickle_file, "r+b") as f:
                 # jump to the end of the file
                 f.seek(0, 2)
-                # save the pickle info
-                pickle.dump(["provenance_dump", self.provenance, self.comments], f)
+                # save the pickle info, and the trailer pointing to it
+                offset = f.tell()
+                pickle.dump(record, f)
+                f.write(_pickle_trailer(offset))
 
         else:
             # filed opened in write-only mode already
-            pickle.dump(
-                ["provenance_dump", self.provenance, self.comments], pickle_file
-            )
+            offset = pickle_file.tell()
+            pickle.dump(record, pickle_file)
+            pickle_file.write(_pickle_trailer(offset))
 
     @classmethod
-    def _read_get_pickle(cls, pickle_file):
-        f = utils.open_file(pickle_file, "r")
-        s = f.tell()
+    @reader_method
+    def _read_get_pickle(cls, pickle_file, item=None):
+        with utils.open_file(pickle_file, "rb") as f:
+            s = f.tell()
+            try:
+                _, d, com = cls._find_pickle_record(f)
+            finally:
+                # Leave open files where they were
+                if not utils.is_path(pickle_file):
+                    f.seek(s)
 
-        try:
-            n = 0
-            while True:
-                try:
-                    item = pickle.load(f)
-                except:
-                    break
-            if n == 0:
-                raise ProvenanceError(f"Nothing readable found in file {pickle_file}")
-            if (
-                (not isinstance(item, list))
-                or (len(item) != 3)
-                or (item[0] != "provenance_dump")
-            ):
-                raise ProvenanceError(f"No provenance found in file {pickle_file}")
-                _, d, c = item
-        finally:
-            if utils.is_path(pickle_file):
-                f.close()
-            else:
-                f.seek(s)
+        if item is None:
+            return d, com
+        if item not in d:
+            raise errors.ProvenanceMissingItem(f"{item[0]}/{item[1]}")
+        return d[item]
+
+    @classmethod
+    def _find_pickle_record(cls, f):
+        # Use the trailer to go straight to the provenance record if we can
+        f.seek(0, 2)
+        size = f.tell()
+        trailer_size = len(_pickle_trailer(0))
+        if size >= trailer_size:
+            f.seek(size - trailer_size)
+            offset = _parse_pickle_trailer(f.read(trailer_size))
+            if offset is not None:
+                f.seek(offset)
+                record = pickle.load(f)
+                if _is_pickle_record(record):
+                    return record
+
+        # Otherwise, for files written before we added the trailer, we have
+        # to read every object in the file and use the last provenance record
+        f.seek(0)
+        record = None
+        while True:
+            try:
+                obj = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                break
+            if _is_pickle_record(obj):
+                record = obj
+
+        if record is None:
+            raise errors.ProvenanceMissingSection(
+                "Pickle file is missing provenance section"
+            )
+        return record
 
     def read_pickle(self, pickle_file):
-        """Read provenance from a YAML file.
+        """Read provenance from a Pickle file.
 
         Updates the provenance object.
 
@@ -856,9 +2134,83 @@ class Provenance:
         self.comments.extend(com)
 
     @classmethod
-    def get_pickle(self, pickle_file, section, key):
-        d, com = self._read_get_pickle(pickle_file)
-        return d[section, key]
+    def get_pickle(cls, pickle_file, section, key):
+        value = cls._read_get_pickle(pickle_file, (section, key))
+        return decoded_value(section, key, value)
+
+    @writer_method
+    def write_prov(self, prov_file):
+        """Write provenance to a binary .prov file.
+
+        This compact format is quick to read, and single items can be
+        read from it without loading the rest.  See the binary module
+        for details.  Any existing file is replaced.
+
+        Parameters
+        ----------
+        prov_file: str or file
+            The file name or an open binary file object
+
+        Returns
+        -------
+        str
+            The newly-assigned file ID
+        """
+        from . import binary
+
+        data = binary.encode(self.provenance, self.comments)
+        if utils.is_path(prov_file):
+            # Replace the file rather than overwriting it, so that anyone
+            # with the old one memory-mapped is not affected
+            p = pathlib.Path(prov_file)
+            # A unique temporary name, so that writers to the same file
+            # at once do not clash.  It is created as open would, so that the
+            # umask applies, rather than with mkstemp, which makes it private.
+            tmp = p.with_name(f"{p.name}.{uuid.uuid4().hex[:16]}.tmp")
+            fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, p)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+                raise
+        else:
+            prov_file.write(data)
+
+    @classmethod
+    @reader_method
+    def _read_get_prov(cls, prov_file, item=None):
+        from . import binary
+
+        with binary.open_reader(prov_file) as r:
+            if item is None:
+                return r.items(), r.comments()
+            return r.get(*item)
+
+    def read_prov(self, prov_file):
+        """Read provenance from a binary .prov file.
+
+        Updates the provenance object.
+
+        Parameters
+        ----------
+        prov_file: str or file
+            The file name or an open binary file object
+
+        Returns
+        -------
+        None
+        """
+        d, com = self._read_get_prov(prov_file)
+        self.update(d)
+        self.comments.extend(com)
+
+    @classmethod
+    def get_prov(cls, prov_file, section, key):
+        value = cls._read_get_prov(prov_file, (section, key))
+        return decoded_value(section, key, value)
 
     def to_string_dict(self):
         d = {f"{s}/{k}": str(v) for (s, k), v in self.provenance.items()}
@@ -867,4 +2219,14 @@ class Provenance:
         return d
 
     def generate_file_id(self):
-        self[base_section, "file_id"] = uuid.uuid4().hex
+        file_id = uuid.uuid4().hex
+        self[base_section, "file_id"] = file_id
+        return file_id
+
+    def _with_file_id(self, file_id):
+        # A shallow copy of this object with a file ID added, sharing
+        # everything else, and leaving this object unchanged.
+        cp = copy.copy(self)
+        cp.provenance = utils.CopyOnWriteDict(self.provenance)
+        cp[base_section, "file_id"] = file_id
+        return cp
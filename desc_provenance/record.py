@@ -0,0 +1,203 @@
+"""
+Compact read-only provenance records, for holding very many at once.
+
+A Provenance object keeps its own dictionary, with its own copies of every
+section name, key name, and value.  When the provenance of many files is
+loaded, most of that is repeated: the files share the same set of keys, and
+often the same values, like git/head and the versions of each package.
+
+ProvenanceRecord stores only a tuple of values, with the keys held in a
+layout that is shared by every record with the same keys, and equal values
+shared between records through an Interner.  Use Provenance.read_record to
+read one from a file.
+"""
+from .provenance import Provenance, decoded_value, base_section, git_section
+import sys
+import collections.abc
+
+
+class _Layout:
+    # The keys of a record, in order, and where to find each one.
+    # Shared by all the records that have the same keys.
+    __slots__ = ["keys", "index"]
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+
+
+# Values that are different in almost every file, so are not worth sharing
+_unshared = {
+    (base_section, "file_id"),
+    (base_section, "process_id"),
+    (base_section, "creation"),
+    (git_section, "diff"),
+}
+
+
+def _is_shared(section, key):
+    # Whether a value is likely to be the same in other files
+    if (section, key) in _unshared:
+        return False
+    return not (section == base_section and key.startswith("argv_"))
+
+
+class Interner:
+    """A store of values and record layouts shared between records.
+
+    Values are shared if they are equal and of the same type.  To limit
+    the memory used, at most max_values values and max_layouts layouts
+    are stored; once it is full, records made afterwards get their own
+    copies of anything new.  Values that are different in almost every
+    file, like file IDs, creation times, command lines, and git diffs, are
+    never stored.  For long-running jobs that read records in batches and
+    then discard them, use a separate Interner for each batch, or clear
+    the default one.
+
+    Parameters
+    ----------
+    max_values: int or None
+        Maximum number of values to store, or None for no limit
+
+    max_layouts: int or None
+        Maximum number of layouts to store, or None for no limit
+    """
+
+    def __init__(self, max_values=100_000, max_layouts=1_000):
+        self.max_values = max_values
+        self.max_layouts = max_layouts
+        self._values = {}
+        self._layouts = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def value(self, value):
+        """Return the shared copy of a value.
+
+        Parameters
+        ----------
+        value: any
+
+        Returns
+        -------
+        any
+            An equal value, possibly the same object
+        """
+        # Include the type, since 1, 1.0, and True are all equal
+        k = (type(value), value)
+        try:
+            shared = self._values.get(k)
+        except TypeError:
+            # Unhashable values, like lists, are not shared
+            return value
+        if shared is not None:
+            return shared
+        if self.max_values is None or len(self._values) < self.max_values:
+            self._values[k] = value
+        return value
+
+    def layout(self, keys):
+        """Return the shared layout for a tuple of (section, key) pairs."""
+        layout = self._layouts.get(keys)
+        if layout is None:
+            keys = tuple((sys.intern(s), sys.intern(k)) for s, k in keys)
+            layout = _Layout(keys)
+            if self.max_layouts is None or len(self._layouts) < self.max_layouts:
+                layout = self._layouts.setdefault(keys, layout)
+        return layout
+
+    def clear(self):
+        """Forget all the shared values and layouts.
+
+        Existing records are not affected, but will not share
+        anything with records made afterwards.
+        """
+        self._values.clear()
+        self._layouts.clear()
+
+
+# Used by records unless another Interner is given
+default_interner = Interner()
+
+
+class ProvenanceRecord(collections.abc.Mapping):
+    """A compact, read-only set of provenance.
+
+    This can be used like a read-only Provenance object, with
+    record[section, key], and like a read-only dictionary of (section, key)
+    pairs otherwise.
+
+    Parameters
+    ----------
+    items: dict
+        Maps (section, key) to values
+
+    comments: list
+        Comment strings
+
+    interner: Interner or None
+        Where to share values with other records.  Defaults to
+        default_interner.
+    """
+
+    __slots__ = ["_layout", "_values", "_comments"]
+
+    def __init__(self, items, comments=(), interner=None):
+        if interner is None:
+            interner = default_interner
+        self._layout = interner.layout(tuple(items))
+        self._values = tuple(
+            interner.value(v) if _is_shared(*k) else v for k, v in items.items()
+        )
+        self._comments = tuple(interner.value(c) for c in comments)
+
+    @classmethod
+    def from_provenance(cls, provenance, interner=None):
+        """Make a record from a Provenance object.
+
+        Parameters
+        ----------
+        provenance: Provenance
+
+        interner: Interner or None
+
+        Returns
+        -------
+        ProvenanceRecord
+        """
+        return cls(provenance.provenance, provenance.comments, interner)
+
+    def to_provenance(self):
+        """Make a Provenance object, which can be changed, from this record.
+
+        Returns
+        -------
+        Provenance
+        """
+        p = Provenance()
+        p.update(dict(zip(self._layout.keys, self._values)))
+        p.comments.extend(self._comments)
+        return p
+
+    @property
+    def comments(self):
+        """The list of comments."""
+        return list(self._comments)
+
+    def __getitem__(self, section_key):
+        section, key = section_key
+        i = self._layout.index[section, key]
+        return decoded_value(section, key, self._values[i])
+
+    def __contains__(self, section_key):
+        return section_key in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"<ProvenanceRecord with {len(self)} items>"
@@ -0,0 +1,183 @@
+"""
+Timing of provenance generation and file I/O.
+
+Functions can be registered with add_hook to be told about each file that
+provenance is written to, read from, or got from, and each stage of
+Provenance.generate.  Each is called with a Span describing what was
+done and how long it took.  When no hooks are registered nothing is
+timed, so the cost is negligible.
+
+To save everything for later analysis, one JSON object per line:
+```
+exporter = trace.JSONLExporter("provenance-trace.jsonl")
+trace.add_hook(exporter)
+```
+"""
+import os
+import json
+import time
+import threading
+import contextlib
+
+# The registered hooks.  Use add_hook and remove_hook to change this.
+hooks = []
+
+
+def add_hook(hook):
+    """Register a function to be called with each finished Span.
+
+    Hooks are called in the thread that did the work, so should be quick
+    and thread-safe.  Exceptions they raise are not caught.
+
+    Parameters
+    ----------
+    hook: callable
+    """
+    global hooks
+    # Replace the list rather than changing it, so that spans
+    # finishing in other threads meanwhile are not affected
+    hooks = hooks + [hook]
+
+
+def remove_hook(hook):
+    """Stop calling a function registered with add_hook.
+
+    Parameters
+    ----------
+    hook: callable
+    """
+    global hooks
+    hooks = [h for h in hooks if h != hook]
+
+
+class Span:
+    """A record of one operation.
+
+    Attributes
+    ----------
+    name: str
+        What was done, e.g. "write_hdf", "get_fits", or "generate.git_diff"
+
+    path: str or None
+        The file involved, if there was one and it had a name
+
+    start: float
+        When the operation started, as a Unix time
+
+    duration: float
+        How long it took in seconds
+
+    nbytes: int or None
+        The size of the file afterwards, if known
+
+    nkeys: int or None
+        The number of provenance items written or read, if known
+
+    error: str or None
+        The exception raised, if there was one
+
+    thread: str
+        The name of the thread that did the work
+    """
+
+    __slots__ = [
+        "name",
+        "path",
+        "start",
+        "duration",
+        "nbytes",
+        "nkeys",
+        "error",
+        "thread",
+    ]
+
+    def __init__(self, name, path=None, nkeys=None):
+        self.name = name
+        self.path = path
+        self.start = time.time()
+        self.duration = None
+        self.nbytes = None
+        self.nkeys = nkeys
+        self.error = None
+        self.thread = threading.current_thread().name
+
+    def to_dict(self):
+        """Return the span as a dict."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"<Span {self.name} {self.duration}s>"
+
+
+@contextlib.contextmanager
+def span(name, path=None, nkeys=None):
+    """Time an operation and pass the result to each hook.
+
+    Callers should check that hooks is not empty first, so that
+    nothing is done when nobody is listening.
+
+    Parameters
+    ----------
+    name: str
+
+    path: str or pathlib.Path or open file object or None
+        Only names are recorded; open files are ignored
+
+    nkeys: int or None
+        The number of items involved, if known in advance.  It can also
+        be set on the yielded Span.
+
+    Yields
+    ------
+    Span
+    """
+    if not isinstance(path, (str, os.PathLike)):
+        path = None
+    s = Span(name, None if path is None else os.fspath(path), nkeys)
+    t = time.perf_counter()
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.duration = time.perf_counter() - t
+        if s.path is not None and s.nbytes is None:
+            try:
+                s.nbytes = os.path.getsize(s.path)
+            except OSError:
+                pass
+        for hook in hooks:
+            hook(s)
+
+
+class JSONLExporter:
+    """A hook that writes each span to a file as a line of JSON.
+
+    Parameters
+    ----------
+    f: str or pathlib.Path or file object
+        The file to append to, or an open text file
+    """
+
+    def __init__(self, f):
+        if isinstance(f, (str, os.PathLike)):
+            self.file = open(f, "a")
+            self._owned = True
+        else:
+            self.file = f
+            self._owned = False
+        self._lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self._lock:
+            self.file.write(line)
+
+    def close(self):
+        """Flush the file, and close it if we opened it."""
+        with self._lock:
+            if self._owned:
+                self.file.close()
+            else:
+                self.file.flush()
@@ -1,10 +1,16 @@
-import distutils.version
+import collections
+import collections.abc
+import threading
+import getpass
+import socket
 import sys
 import os
-import inspect
+import re
 import pathlib
 import contextlib
 import shutil
+import numbers
+import math
 
 
 def is_path(p):
@@ -21,12 +27,12 @@ def get_caller_directory(parent_frames=0):
     parent_frames: int
         Number of additional frames to go up in the call stack
     """
-    previous_frame = inspect.currentframe().f_back
+    previous_frame = sys._getframe(1)
     # go back more frames if desired
     for i in range(parent_frames):
         previous_frame = previous_frame.f_back
 
-    filename = inspect.getframeinfo(previous_frame).filename
+    filename = previous_frame.f_code.co_filename
     p = pathlib.Path(filename)
     if not p.exists():
         # dynamically generated or interactive mode
@@ -34,39 +40,316 @@ def get_caller_directory(parent_frames=0):
     return str(p.parent)
 
 
-def find_module_versions():
+# The fully-qualified domain name can take a long time to look up if
+# DNS is misbehaving, so we look it up once per process in a background
+# thread and don't wait forever for it.
+DEFAULT_HOST_TIMEOUT = 1.0
+_host_lock = threading.Lock()
+_host_thread = None
+_host_result = None
+
+# User names, keyed by the environment variables that getpass checks
+_user_names = {}
+
+
+def _lookup_host():
+    global _host_result
+    name = socket.getfqdn()
+    with _host_lock:
+        _host_result = (name, "getfqdn")
+
+
+def start_host_lookup():
+    """Start looking up the domain name of this machine in the background,
+    if this has not already been done.
+    """
+    global _host_thread
+    with _host_lock:
+        if _host_thread is None:
+            _host_thread = threading.Thread(
+                target=_lookup_host, name="desc_provenance_host_lookup", daemon=True
+            )
+            _host_thread.start()
+
+
+def _reset_host_lookup():
+    # A lookup that was running in the parent process doesn't exist in a
+    # forked child, so start again there if it hadn't finished.  The lock
+    # could have been held by another thread when the process forked.
+    global _host_lock, _host_thread
+    _host_lock = threading.Lock()
+    if _host_result is None:
+        _host_thread = None
+
+
+# os.register_at_fork is not available on Windows, where there is no fork
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_host_lookup)
+
+
+def host_name(timeout=DEFAULT_HOST_TIMEOUT):
+    """Get the fully-qualified domain name of this machine.
+
+    The name is looked up once per process, and again in processes forked
+    before it finished. If the lookup takes longer than the timeout then the
+    plain host name is used instead, until the lookup finishes.
+
+    Parameters
+    ----------
+    timeout: float or None
+        Maximum time in seconds to wait for the lookup
+
+    Returns
+    -------
+    name: str
+        The host name
+    source: str
+        "getfqdn" or "gethostname", depending on which was used
+    """
+    start_host_lookup()
+    _host_thread.join(timeout)
+    with _host_lock:
+        result = _host_result
+    if result is None:
+        return socket.gethostname(), "gethostname"
+    return result
+
+
+def user_name():
+    """Get the name of the user running this process.
+
+    This is cached, unless the environment variables that determine it change.
+
+    Returns
+    -------
+    str
+    """
+    key = tuple(os.environ.get(k) for k in ("LOGNAME", "USER", "LNAME", "USERNAME"))
+    name = _user_names.get(key)
+    if name is None:
+        name = _user_names[key] = getpass.getuser()
+    return name
+
+
+# Versions of the modules we have already examined, and the module objects
+# themselves, so that each scan only needs to look at modules imported (or
+# replaced) since the last one.
+_module_versions = {}
+_modules_seen = {}
+_module_versions_lock = threading.Lock()
+_distributions = None
+
+
+def _module_version(module):
+    # Get the version of a single module, or None if it does not have one.
+    # Some packages have a "version" sub-module as well as __version__,
+    # so we check both.
+    for attr in ("version", "__version__"):
+        v = getattr(module, attr, None)
+        if isinstance(v, str) or _is_version_object(v):
+            return str(v)
+    return None
+
+
+def _is_initializing(module):
+    # Whether a module is still being imported, in which case it may not
+    # have set its version yet
+    spec = getattr(module, "__spec__", None)
+    return bool(getattr(spec, "_initializing", False))
+
+
+# Classes used by some packages for their version objects.
+_version_classes = [
+    ("distutils.version", "Version"),
+    ("setuptools._distutils.version", "Version"),
+    ("packaging.version", "Version"),
+]
+
+
+def _is_version_object(v):
+    # Importing the version-parsing modules is slow, but a module can
+    # only have a version object of these types if the corresponding module
+    # is already imported, so we only check those ones.
+    for module_name, class_name in _version_classes:
+        module = sys.modules.get(module_name)
+        if module is not None and isinstance(v, getattr(module, class_name)):
+            return True
+    return False
+
+
+def find_module_versions(group=True):
     """
     Generate a dictionary of versions of all imported modules
     by looking for __version__ or version attributes on them.
 
+    Modules are only examined the first time they are seen, so repeated
+    calls are cheap.  Modules that are reloaded or replaced in sys.modules
+    are examined again, as are ones that were still being imported.
+
     Parameters
     ----------
-    None
+    group: bool
+        If True (the default), leave out sub-modules and other modules
+        from the same distribution that have the same version as their
+        top-level package.  See group_module_versions.
 
     Returns
     -------
     dict:
         A dictioary of the versions of all loaded modules
     """
-    versions = {}
-    for name, module in sys.modules.items():
-        if hasattr(module, "version"):
-            v = module.version
-        elif hasattr(module, "__version__"):
-            v = module.__version__
+    global _modules_seen
+    with _module_versions_lock:
+        # Copying the items is atomic, so this is safe even if another
+        # thread is importing things
+        modules = dict(sys.modules)
+
+        # Forget any modules that have been removed
+        for name in _modules_seen.keys() - modules.keys():
+            _module_versions.pop(name, None)
+
+        seen = {}
+        for name, module in modules.items():
+            if _modules_seen.get(name) is module:
+                seen[name] = module
+                continue
+            v = _module_version(module)
+            if v is None:
+                _module_versions.pop(name, None)
+            else:
+                _module_versions[name] = v
+            # Look again next time at modules that haven't finished importing
+            if not _is_initializing(module):
+                seen[name] = module
+
+        _modules_seen = seen
+        versions = dict(_module_versions)
+
+    if group:
+        versions = group_module_versions(versions)
+    return versions
+
+
+def module_distributions():
+    """
+    Get a mapping from top-level module names to the name of the
+    distribution that installed them.
+
+    This is computed once and then cached.
+
+    Returns
+    -------
+    dict
+        Distribution names for each top-level module that we can find one for
+    """
+    global _distributions
+    if _distributions is None:
+        try:
+            import importlib.metadata
+        except ImportError:
+            # importlib.metadata was added in python 3.8, so before that
+            # modules are not grouped by distribution
+            packages = {}
         else:
+            if hasattr(importlib.metadata, "packages_distributions"):
+                packages = importlib.metadata.packages_distributions()
+            else:
+                packages = _packages_distributions(importlib.metadata)
+        _distributions = {module: dists[0] for module, dists in packages.items()}
+    return _distributions
+
+
+def _packages_distributions(metadata):
+    # The same as importlib.metadata.packages_distributions, which was
+    # added in python 3.10, for earlier versions
+    packages = collections.defaultdict(list)
+    for dist in metadata.distributions():
+        top_level = dist.read_text("top_level.txt")
+        if top_level:
+            names = top_level.split()
+        else:
+            names = {
+                f.parts[0] if len(f.parts) > 1 else f.with_suffix("").name
+                for f in dist.files or ()
+                if f.suffix == ".py"
+            }
+        for name in names:
+            packages[name].append(dist.metadata["Name"])
+    return dict(packages)
+
+
+def _normalize_distribution_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def group_module_versions(versions):
+    """
+    Reduce a dictionary of module versions by grouping modules
+    under their top-level package and distribution.
+
+    Sub-modules are left out if their version matches their top-level
+    module, and if a distribution installs several top-level modules with the
+    same version then only one of them is kept, preferring the one named after
+    the distribution.
+
+    Parameters
+    ----------
+    versions: dict
+        Module name: version string
+
+    Returns
+    -------
+    dict
+        The subset of the versions to keep
+    """
+    distributions = module_distributions()
+
+    # Collect the candidates to represent each distribution version
+    candidates = collections.defaultdict(list)
+    keep = {}
+    for name, v in versions.items():
+        top = name.partition(".")[0]
+        if name != top and versions.get(top) == v:
             continue
-        if isinstance(v, str) or isinstance(v, distutils.version.Version):
-            versions[name] = str(v)
-    return versions
+        dist = distributions.get(top)
+        if dist is None:
+            keep[name] = v
+        else:
+            candidates[dist, v].append(name)
+
+    for (dist, v), names in candidates.items():
+        normalized = _normalize_distribution_name(dist)
+        for name in names:
+            if _normalize_distribution_name(name) == normalized:
+                break
+        else:
+            name = names[0]
+        keep[name] = v
+
+    # Keep the original ordering
+    return {name: v for name, v in versions.items() if name in keep}
 
 
 @contextlib.contextmanager
 def open_hdf(hdf_file, mode):
-    """Open an HDF file, or if a file is provided, simply return it"""
+    """Open an HDF file, or if a file is provided, simply return it
+
+    If the HDF5 handle pool is switched on then files opened for reading
+    are taken from it and left open afterwards.
+    """
     import h5py
+    from . import pool
 
     if is_path(hdf_file):
+        handles = pool.active()
+        if handles is not None:
+            if mode == "r":
+                with handles.open(hdf_file) as f:
+                    yield f
+                return
+            # We can't write to a file we still have open for reading
+            handles.evict(hdf_file)
+
         f = h5py.File(hdf_file, mode)
         try:
             yield f
@@ -105,8 +388,9 @@ def open_file(file, mode):
     """Open a regular file, or if a file is already provided simply return it"""
 
     if is_path(file):
-        if mode == "r+" and not os.path.exists(file):
-            f = open(file, "w+")
+        # Create the file if needed when opening it for update
+        if mode in ("r+", "r+b") and not os.path.exists(file):
+            f = open(file, mode.replace("r", "w"))
         else:
             f = open(file, mode=mode)
 
@@ -116,3 +400,424 @@ def open_file(file, mode):
             f.close()
     else:
         yield file
+
+
+# FITS headers are made of fixed-size 80 character cards, so if we know
+# where a card is we can read it directly from the raw bytes without
+# parsing the rest of the header.  Headers and data are both stored in
+# blocks of 36 cards.
+FITS_CARD_SIZE = 80
+FITS_BLOCK_SIZE = 2880
+
+
+class FitsHeaderCards:
+    """Raw access to a FITS header in an open file, reading only what is used.
+
+    The header is read in 2880 byte blocks as they are needed, so a few
+    cards can be looked up without reading the rest of a large header.
+    Slicing it gives the raw bytes, like slicing a header read into memory,
+    so it can be passed to fits_card_name and fits_card_value.
+
+    Parameters
+    ----------
+    f: file
+        The FITS file, opened in binary mode
+
+    start: int
+        The offset in the file where the header starts
+    """
+
+    def __init__(self, f, start):
+        self.file = f
+        self.start = start
+        self._blocks = {}
+
+    def _block(self, n):
+        block = self._blocks.get(n)
+        if block is None:
+            self.file.seek(self.start + n * FITS_BLOCK_SIZE)
+            block = self._blocks[n] = self.file.read(FITS_BLOCK_SIZE)
+        return block
+
+    def __getitem__(self, s):
+        first = s.start // FITS_BLOCK_SIZE
+        last = (s.stop - 1) // FITS_BLOCK_SIZE
+        data = b"".join(self._block(n) for n in range(first, last + 1))
+        offset = first * FITS_BLOCK_SIZE
+        return data[s.start - offset : s.stop - offset]
+
+
+def find_fits_extension(f, extname):
+    """Find where the header of a named extension starts in a FITS file.
+
+    The headers of the HDUs before it are read to find their sizes, but
+    only the start of its own header, up to its EXTNAME, is read.
+
+    Parameters
+    ----------
+    f: file
+        The FITS file, opened in binary mode
+
+    extname: str
+        The name of the extension, in any case
+
+    Returns
+    -------
+    FitsHeaderCards or None
+        The extension header, or None if there is no such extension
+    """
+    extname = extname.lower()
+    start = 0
+    while True:
+        header = FitsHeaderCards(f, start)
+        keys = {}
+        index = 0
+        while True:
+            card = header[index * FITS_CARD_SIZE : (index + 1) * FITS_CARD_SIZE]
+            if len(card) < FITS_CARD_SIZE:
+                # The end of the file
+                return None
+            name = fits_card_name(header, index)
+            if name == "END":
+                break
+            if name == "EXTNAME":
+                if str(fits_card_value(header, index)).lower() == extname:
+                    return header
+            elif name in ("BITPIX", "PCOUNT", "GCOUNT") or name.startswith("NAXIS"):
+                keys[name] = fits_card_value(header, index)
+            index += 1
+
+        # Skip over the rest of the header and the data, both of which
+        # are padded to a whole number of blocks
+        naxis = keys.get("NAXIS", 0)
+        npix = 1 if naxis else 0
+        for i in range(naxis):
+            npix *= keys.get(f"NAXIS{i + 1}", 0)
+        size = abs(keys.get("BITPIX", 8)) // 8
+        size *= keys.get("GCOUNT", 1) * (keys.get("PCOUNT", 0) + npix)
+        header_size = (index + 1) * FITS_CARD_SIZE
+        nblock = -(-header_size // FITS_BLOCK_SIZE) + -(-size // FITS_BLOCK_SIZE)
+        start += nblock * FITS_BLOCK_SIZE
+
+
+def _fits_string_pieces(value, size):
+    # Split a string, with quotes already doubled, into pieces that fit
+    # within the given size, without splitting a doubled quote.
+    pieces = []
+    while len(value) > size:
+        n = size - 1
+        # An odd number of quotes before the split point would leave
+        # half of a doubled quote at the end of the piece
+        if (len(value[:n]) - len(value[:n].rstrip("'"))) % 2:
+            n -= 1
+        pieces.append(value[:n] + "&")
+        value = value[n:]
+    pieces.append(value)
+    return pieces
+
+
+def format_fits_cards(name, value):
+    """Format a header keyword as raw 80 character FITS cards.
+
+    Long strings are split over CONTINUE cards in the same way as
+    CFITSIO does, and long keywords use HIERARCH cards.  The cards
+    can then be appended to a header without CFITSIO searching for
+    any existing keyword with the same name.
+
+    Parameters
+    ----------
+    name: str
+        The keyword name
+
+    value: str, int, float, bool, or None
+
+    Returns
+    -------
+    list or None
+        The card strings, or None if this value can't be formatted
+        here, in which case the caller should use CFITSIO to write it.
+    """
+    name = name.upper()
+    if len(name) <= 8 and " " not in name:
+        prefix = f"{name:<8}= "
+    else:
+        prefix = f"HIERARCH {name} = "
+
+    if value is None:
+        return [prefix.rstrip().ljust(FITS_CARD_SIZE)]
+
+    if isinstance(value, bool):
+        text = "T" if value else "F"
+    elif isinstance(value, numbers.Integral):
+        text = str(int(value))
+    elif isinstance(value, numbers.Real):
+        value = float(value)
+        # FITS has no way to write these
+        if not math.isfinite(value):
+            return None
+        text = repr(value).upper()
+    elif isinstance(value, str):
+        if not (value.isascii() and value.isprintable()):
+            return None
+        # Short strings are padded to eight characters
+        value = value.replace("'", "''").ljust(8)
+        pieces = _fits_string_pieces(value, FITS_CARD_SIZE - len(prefix) - 2)
+        cards = [f"{prefix}'{pieces[0]}'"]
+        for piece in pieces[1:]:
+            cards.append(f"CONTINUE  '{piece}'")
+        # The first card may have been too short for even one character
+        if any(len(card) > FITS_CARD_SIZE for card in cards) or not pieces[0]:
+            return None
+        return [card.ljust(FITS_CARD_SIZE) for card in cards]
+    else:
+        return None
+
+    card = f"{prefix}{text:>20}"
+    if len(card) > FITS_CARD_SIZE:
+        return None
+    return [card.ljust(FITS_CARD_SIZE)]
+
+
+def format_fits_comment(comment):
+    """Format a comment as raw 80 character FITS COMMENT cards.
+
+    Long comments are split over several cards, and empty ones are left
+    out, in the same way as CFITSIO does.
+
+    Parameters
+    ----------
+    comment: str
+
+    Returns
+    -------
+    list or None
+        The card strings, or None if the comment can't be formatted here
+    """
+    comment = str(comment)
+    if not (comment.isascii() and comment.isprintable()):
+        return None
+    size = FITS_CARD_SIZE - 8
+    pieces = [comment[i : i + size] for i in range(0, len(comment), size)]
+    return [f"COMMENT {piece}".ljust(FITS_CARD_SIZE) for piece in pieces]
+
+
+# fitsio versions known to have the internal method used to append raw cards
+_fitsio_raw_card_versions = ((1, 0), (2, 0))
+
+
+def can_write_fits_cards(f):
+    """Whether raw cards can be appended to the headers of an open FITS file.
+
+    fitsio has no public method for this, so write_fits_cards uses an
+    internal one, which is only relied on in the versions known to have it.
+    Otherwise callers should use the slower public methods like write_key.
+
+    Parameters
+    ----------
+    f: fitsio.FITS
+
+    Returns
+    -------
+    bool
+    """
+    import fitsio
+
+    match = re.match(r"(\d+)\.(\d+)", fitsio.__version__)
+    if match is None:
+        return False
+    version = (int(match.group(1)), int(match.group(2)))
+    low, high = _fitsio_raw_card_versions
+    return low <= version < high and hasattr(getattr(f, "_FITS", None), "write_record")
+
+
+def write_fits_cards(f, hdu, cards):
+    """Append raw cards to a FITS header.
+
+    Check can_write_fits_cards first.
+
+    Parameters
+    ----------
+    f: fitsio.FITS
+
+    hdu: fitsio HDU
+        The HDU in f to add the cards to
+
+    cards: list
+        80 character card strings, e.g. from format_fits_cards
+    """
+    hdunum = hdu.get_extnum() + 1
+    write_record = f._FITS.write_record
+    for card in cards:
+        write_record(hdunum, card)
+
+
+def fits_card_name(header, index):
+    """Get the keyword name of a card in a raw FITS header.
+
+    Parameters
+    ----------
+    header: bytes
+        The raw header
+
+    index: int
+        The card number
+
+    Returns
+    -------
+    str
+    """
+    card = header[index * FITS_CARD_SIZE : (index + 1) * FITS_CARD_SIZE]
+    card = card.decode("ascii", errors="replace")
+    if card.startswith("HIERARCH "):
+        return card[9:].split("=", 1)[0].strip()
+    return card[:8].rstrip()
+
+
+def _parse_fits_string(text):
+    # Text starts with the opening quote; quotes inside are doubled
+    pieces = []
+    i = 1
+    while True:
+        j = text.find("'", i)
+        if j < 0:
+            pieces.append(text[i:])
+            break
+        pieces.append(text[i:j])
+        if text[j + 1 : j + 2] != "'":
+            break
+        pieces.append("'")
+        i = j + 2
+    return "".join(pieces)
+
+
+def fits_card_value(header, index):
+    """Get the value of a card in a raw FITS header.
+
+    Long strings continued over following CONTINUE cards are joined
+    together.  Values are converted in the same way as CFITSIO does,
+    so that trailing spaces are removed from strings.
+
+    Parameters
+    ----------
+    header: bytes
+        The raw header
+
+    index: int
+        The card number
+
+    Returns
+    -------
+    str, int, float, bool, or None
+    """
+    card = header[index * FITS_CARD_SIZE : (index + 1) * FITS_CARD_SIZE]
+    card = card.decode("ascii", errors="replace")
+    if card.startswith("HIERARCH "):
+        text = card.split("=", 1)[1].strip()
+    else:
+        text = card[10:].strip()
+
+    if not text.startswith("'"):
+        text = text.split("/", 1)[0].strip()
+        if not text:
+            return None
+        if text in ("T", "F"):
+            return text == "T"
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text.replace("D", "E"))
+        except ValueError:
+            return text
+
+    value = _parse_fits_string(text)
+    while value.endswith("&"):
+        index += 1
+        card = header[index * FITS_CARD_SIZE : (index + 1) * FITS_CARD_SIZE]
+        card = card.decode("ascii", errors="replace")
+        if not card.startswith("CONTINUE"):
+            break
+        value = value[:-1] + _parse_fits_string(card[10:].strip())
+    return value.rstrip(" ")
+
+
+class CopyOnWriteDict(collections.abc.MutableMapping):
+    """A dictionary that can share its items with copies of it.
+
+    The items are kept in a base dictionary that is never changed, and which
+    can be shared between several of these.  Each keeps its own changes and
+    deletions separately.  Items are in the same order as they would be in
+    a regular dict that had the same changes made to it.
+
+    Parameters
+    ----------
+    base: dict
+        The initial items.  This is used directly, not copied, so must not be
+        changed afterwards.
+    """
+
+    __slots__ = ["_base", "_changed", "_deleted"]
+
+    def __init__(self, base=None):
+        self._base = {} if base is None else base
+        self._changed = {}
+        # Deleted keys from the base.  A key that is deleted and then set
+        # again stays here, so that it moves to the end as in a dict.
+        self._deleted = set()
+
+    def copy(self):
+        """Return a new dictionary with the same items, sharing them with this one.
+
+        Returns
+        -------
+        CopyOnWriteDict
+        """
+        # Fold our changes into a new base, which the copy can then share
+        if self._changed or self._deleted:
+            self._base = dict(self.items())
+            self._changed = {}
+            self._deleted = set()
+        return self.__class__(self._base)
+
+    def _in_base(self, key):
+        return key in self._base and key not in self._deleted
+
+    def __getitem__(self, key):
+        if key in self._changed:
+            return self._changed[key]
+        if self._in_base(key):
+            return self._base[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._changed[key] = value
+
+    def __delitem__(self, key):
+        if key in self._changed:
+            del self._changed[key]
+        elif not self._in_base(key):
+            raise KeyError(key)
+        if key in self._base:
+            self._deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self._changed or self._in_base(key)
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._deleted:
+                yield key
+        for key in self._changed:
+            if key not in self._base or key in self._deleted:
+                yield key
+
+    def __len__(self):
+        n = len(self._base) - len(self._deleted)
+        for key in self._changed:
+            if key not in self._base or key in self._deleted:
+                n += 1
+        return n
+
+    def __repr__(self):
+        return repr(dict(self.items()))
@@ -0,0 +1,336 @@
+"""
+Read-only views of the provenance stored in a file.
+
+A view keeps its file open so that many items can be read from it without
+re-opening it each time, and only loads the parts of the provenance
+that are asked for.  Sections of HDF5 files, and items in FITS files with
+an index, are read individually.  Other formats can only be read in a single
+pass, so are loaded in full the first time anything is asked for, but not
+when the view is opened.  Use Provenance.open to make one.
+"""
+from . import errors
+from . import utils
+from .provenance import (
+    Provenance,
+    decoded_value,
+    fits_provenance_hdu,
+    hdf_section_items,
+    hdf_section_item,
+    hdf_comments,
+    provenance_group,
+    comments_section,
+)
+import collections
+import collections.abc
+import pathlib
+
+# Used to indicate that no default was given to get_many
+_missing = object()
+_missing_item = object()
+
+
+class _HDFBackend:
+    # Reads provenance from an open HDF5 file, one section at a time.
+    def __init__(self, hdf_file):
+        self._context = utils.open_hdf(hdf_file, "r")
+        f = self._context.__enter__()
+        if provenance_group not in f.keys():
+            self.close()
+            raise errors.ProvenanceMissingSection(
+                "HDF File is missing provenance section"
+            )
+        self._group = f[provenance_group]
+
+    def section_names(self):
+        return [s for s in self._group.keys() if s != comments_section]
+
+    def load_section(self, section):
+        if section not in self._group or section == comments_section:
+            return None
+        return hdf_section_items(self._group[section])
+
+    def get_many(self, items):
+        import h5py
+
+        # Look up each item directly, without reading whole sections
+        # where possible
+        by_section = collections.defaultdict(list)
+        for section, key in items:
+            by_section[section].append(key)
+
+        out = {}
+        for section, keys in by_section.items():
+            if section not in self._group:
+                continue
+            group = self._group[section]
+            # Compact sections are read in one go anyway
+            if isinstance(group, h5py.Dataset):
+                found = hdf_section_items(group)
+                values = [found.get(key) for key in keys]
+            else:
+                values = [hdf_section_item(group, key) for key in keys]
+            for key, value in zip(keys, values):
+                if value is not None:
+                    out[section, key] = value
+        return out
+
+    def comments(self):
+        if comments_section not in self._group:
+            return []
+        return hdf_comments(self._group[comments_section])
+
+    def close(self):
+        self._context.__exit__(None, None, None)
+
+
+class _MappingBackend:
+    # For formats where the provenance is read in a single pass anyway,
+    # like YAML documents.  load is called to read everything, as a
+    # dict and a list of comments, the first time anything is needed.
+    def __init__(self, load):
+        self._load = load
+        self._sections = None
+        self._comments = None
+
+    def _loaded(self):
+        if self._sections is None:
+            d, comments = self._load()
+            sections = collections.defaultdict(dict)
+            for (section, key), value in d.items():
+                sections[section][key] = value
+            self._sections = sections
+            self._comments = comments
+        return self._sections
+
+    def section_names(self):
+        return list(self._loaded())
+
+    def load_section(self, section):
+        return self._loaded().get(section)
+
+    def get_many(self, items):
+        sections = self._loaded()
+        out = {}
+        for section, key in items:
+            sec = sections.get(section)
+            if sec is not None and key in sec:
+                out[section, key] = sec[key]
+        return out
+
+    def comments(self):
+        self._loaded()
+        return self._comments[:]
+
+    def close(self):
+        pass
+
+
+class _FITSBackend:
+    # Looks up single items in the raw header using its index, if it
+    # has one, and parses the whole header only when that is needed.
+    def __init__(self, fits_file):
+        self._file = open(fits_file, "rb")
+        try:
+            self._index = Provenance._find_fits_index(self._file)
+        except BaseException:
+            self._file.close()
+            raise
+        self._all = _MappingBackend(lambda: self._read_header(fits_file))
+
+    @staticmethod
+    def _read_header(fits_file):
+        with utils.open_fits(fits_file, "r") as f:
+            hdr = fits_provenance_hdu(f).read_header()
+        return Provenance._parse_fits_header(hdr)
+
+    def section_names(self):
+        return self._all.section_names()
+
+    def load_section(self, section):
+        return self._all.load_section(section)
+
+    def get_many(self, items):
+        if self._index is None:
+            return self._all.get_many(items)
+        out = {}
+        rest = []
+        for item in items:
+            try:
+                found, value = Provenance._get_fits_indexed(
+                    self._file, item, self._index
+                )
+            except errors.ProvenanceMissingItem:
+                continue
+            if found:
+                out[item] = value
+            else:
+                rest.append(item)
+        if rest:
+            out.update(self._all.get_many(rest))
+        return out
+
+    def comments(self):
+        return self._all.comments()
+
+    def close(self):
+        self._file.close()
+
+
+def _yaml_backend(yml_file):
+    return _MappingBackend(lambda: Provenance._read_get_yaml(yml_file, None))
+
+
+def _pickle_backend(pickle_file):
+    return _MappingBackend(lambda: Provenance._read_get_pickle(pickle_file))
+
+
+def _prov_backend(prov_file):
+    return _MappingBackend(lambda: Provenance._read_get_prov(prov_file))
+
+
+_backends = {
+    ".hdf": _HDFBackend,
+    ".hdf5": _HDFBackend,
+    ".fits": _FITSBackend,
+    ".fit": _FITSBackend,
+    ".yml": _yaml_backend,
+    ".yaml": _yaml_backend,
+    ".pkl": _pickle_backend,
+    ".pickle": _pickle_backend,
+    ".prov": _prov_backend,
+}
+
+
+class ProvenanceView(collections.abc.Mapping):
+    """A read-only view of the provenance in a file.
+
+    This can be used like a read-only Provenance object, with
+    view[section, key], and as a context manager that closes the file
+    at the end.  Nothing is loaded until it is needed; see the module
+    documentation for which formats can be read piece by piece.
+
+    Parameters
+    ----------
+    filename: str or pathlib.Path
+        The file to read.  Its type is guessed from its suffix.
+    """
+
+    def __init__(self, filename):
+        p = pathlib.Path(filename)
+        if not p.exists():
+            raise errors.ProvenanceMissingFile(filename)
+
+        backend = _backends.get(p.suffix)
+        if backend is None:
+            raise errors.ProvenanceFileTypeUnknown(filename)
+
+        self.filename = str(filename)
+        self._backend = backend(filename)
+        self._sections = {}
+        self._section_names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the underlying file."""
+        self._backend.close()
+
+    def sections(self):
+        """Return the names of all the sections in the file.
+
+        Returns
+        -------
+        list
+        """
+        if self._section_names is None:
+            self._section_names = self._backend.section_names()
+        return self._section_names[:]
+
+    def section(self, section):
+        """Return all the items in one section.
+
+        Parameters
+        ----------
+        section: str
+
+        Returns
+        -------
+        dict
+            The key: value pairs in the section
+        """
+        d = self._sections.get(section)
+        if d is None:
+            d = self._backend.load_section(section)
+            if d is None:
+                raise errors.ProvenanceMissingSection(section)
+            self._sections[section] = d
+        return {key: decoded_value(section, key, value) for key, value in d.items()}
+
+    @property
+    def comments(self):
+        """The list of comments in the file."""
+        return self._backend.comments()
+
+    def get_many(self, items, default=_missing):
+        """Get several items at once.
+
+        This is faster than getting them one by one, since the file
+        is only searched once.
+
+        Parameters
+        ----------
+        items: list
+            (section, key) pairs to look up
+
+        default: any
+            Value to return for missing items.  If not set then
+            ProvenanceMissingItem is raised for them instead.
+
+        Returns
+        -------
+        list
+            The values, in the same order as the items
+        """
+        items = [tuple(item) for item in items]
+        found = {}
+        needed = []
+        for item in items:
+            section, key = item
+            loaded = self._sections.get(section)
+            if loaded is not None:
+                if key in loaded:
+                    found[item] = loaded[key]
+            else:
+                needed.append(item)
+
+        if needed:
+            found.update(self._backend.get_many(needed))
+
+        out = []
+        for item in items:
+            if item in found:
+                out.append(decoded_value(item[0], item[1], found[item]))
+            elif default is _missing:
+                raise errors.ProvenanceMissingItem(f"{item[0]}/{item[1]}")
+            else:
+                out.append(default)
+        return out
+
+    def __getitem__(self, section_key):
+        # Mapping methods like get and "in" rely on this raising KeyError
+        value = self.get_many([section_key], default=_missing_item)
+        if value[0] is _missing_item:
+            raise KeyError(section_key)
+        return value[0]
+
+    def __iter__(self):
+        for section in self.sections():
+            for key in self.section(section):
+                yield section, key
+
+    def __len__(self):
+        return sum(len(self.section(section)) for section in self.sections())
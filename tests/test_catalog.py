@@ -0,0 +1,129 @@
+from desc_provenance import Provenance
+from desc_provenance.catalog import Catalog
+import tempfile
+import os
+
+
+def test_catalog():
+    with tempfile.TemporaryDirectory() as dirname:
+        os.mkdir(os.path.join(dirname, "sub"))
+        input_file = os.path.join(dirname, "input.hdf")
+        output_file = os.path.join(dirname, "sub", "output.yml")
+        other_file = os.path.join(dirname, "sub", "other.prov")
+        bad_file = os.path.join(dirname, "bad.yml")
+
+        p = Provenance()
+        p["git", "head"] = "abc123"
+        p.write(input_file)
+        input_id = Provenance.get(input_file, "base", "file_id")
+
+        q = Provenance()
+        q["git", "head"] = "def456"
+        q.add_input_file("cat", input_file)
+        q.write(output_file)
+        q.write(other_file)
+
+        with open(bad_file, "w") as f:
+            f.write("not: provenance\n")
+        # Files of other types are ignored
+        with open(os.path.join(dirname, "notes.txt"), "w") as f:
+            f.write("hello\n")
+
+        with Catalog(os.path.join(dirname, "catalog.db")) as catalog:
+            result = catalog.scan(dirname, max_workers=2)
+            assert result == {"unchanged": 0, "updated": 4, "failed": 1, "removed": 0}
+            assert len(catalog) == 4
+
+            input_file = os.path.realpath(input_file)
+            output_file = os.path.realpath(output_file)
+            other_file = os.path.realpath(other_file)
+            bad_file = os.path.realpath(bad_file)
+
+            assert catalog.from_revision("abc") == [input_file]
+            assert catalog.from_revision("def456") == [other_file, output_file]
+            assert catalog.using_input(file_id=input_id) == [other_file, output_file]
+            assert catalog.using_input(path=input_file) == [other_file, output_file]
+            assert catalog.file_id(input_file) == input_id
+            assert catalog.find_file_id(input_id) == [input_file]
+            assert catalog.inputs(output_file) == {"cat": (input_file, input_id)}
+            assert catalog.items(output_file)["input_id", "cat"] == input_id
+            assert list(catalog.errors()) == [bad_file]
+
+            # Nothing is re-read if nothing has changed
+            result = catalog.scan(dirname, max_workers=1)
+            assert result == {"unchanged": 4, "updated": 0, "failed": 0, "removed": 0}
+
+            os.remove(other_file)
+            r = Provenance()
+            r["git", "head"] = "abc999"
+            r.write(output_file)
+            result = catalog.scan(dirname, max_workers=1)
+            assert result == {"unchanged": 2, "updated": 1, "failed": 0, "removed": 1}
+            assert catalog.from_revision("abc") == [input_file, output_file]
+            assert catalog.using_input(file_id=input_id) == []
+
+
+def test_descendants():
+    with tempfile.TemporaryDirectory() as dirname:
+        paths = {
+            name: os.path.realpath(os.path.join(dirname, f"{name}.yml"))
+            for name in "abcd"
+        }
+
+        def make(name, inputs):
+            p = Provenance()
+            for i in inputs:
+                p.add_input_file(i, paths[i])
+            p.write(paths[name])
+
+        make("d", [])
+        make("b", ["d"])
+        make("c", ["d"])
+        make("a", ["b", "c"])
+
+        with Catalog(os.path.join(dirname, "catalog.db")) as catalog:
+            catalog.scan(dirname, max_workers=1)
+            g = catalog.descendants(paths["d"])
+            assert g.direction == "descendants"
+            assert {n.path: n.depth for n in g.nodes.values()} == {
+                paths["d"]: 0,
+                paths["b"]: 1,
+                paths["c"]: 1,
+                paths["a"]: 2,
+            }
+            assert len(g.edges) == 4
+            assert all(e.status == "verified" for e in g.edges)
+            assert [e.child for e in g.children(paths["b"])] == [paths["a"]]
+
+            g = catalog.descendants(paths["d"], max_depth=1)
+            assert paths["a"] not in g
+
+
+def test_symlinks():
+    with tempfile.TemporaryDirectory() as dirname:
+        real_dir = os.path.join(dirname, "real")
+        tree = os.path.join(dirname, "tree")
+        os.mkdir(real_dir)
+        os.mkdir(tree)
+        target = os.path.join(real_dir, "data.yml")
+        link = os.path.join(tree, "link.yml")
+        other_link = os.path.join(tree, "other_link.yml")
+
+        p = Provenance()
+        p["git", "head"] = "abc123"
+        p.write(target)
+        os.symlink(target, link)
+        os.symlink(target, other_link)
+        for i in range(3):
+            p.write(os.path.join(tree, f"file{i}.yml"))
+
+        with Catalog(os.path.join(dirname, "catalog.db")) as catalog:
+            # Files reached through links are stored once, under their real
+            # path, so that queries through either path find them
+            result = catalog.scan(tree, max_workers=1, batch_size=2)
+            assert result == {"unchanged": 0, "updated": 4, "failed": 0, "removed": 0}
+            assert catalog.file_id(link) == catalog.file_id(target) is not None
+            assert os.path.realpath(target) in catalog.from_revision("abc123")
+
+            result = catalog.scan(tree, max_workers=1)
+            assert result == {"unchanged": 4, "updated": 0, "failed": 0, "removed": 0}
@@ -0,0 +1,139 @@
+import os
+import subprocess
+import tempfile
+import pytest
+from desc_provenance import git
+
+
+def run_git(dirname, *args):
+    cmd = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(cmd + list(args), cwd=dirname, check=True, capture_output=True)
+
+
+@pytest.fixture
+def repo():
+    git.clear_cache()
+    with tempfile.TemporaryDirectory() as dirname:
+        run_git(dirname, "init", "-q")
+        with open(os.path.join(dirname, "a.txt"), "w") as f:
+            f.write("one\n")
+        run_git(dirname, "add", "a.txt")
+        run_git(dirname, "commit", "-q", "-m", "first")
+        yield dirname
+    git.clear_cache()
+
+
+def test_tracked_files(repo):
+    r = git.find_repository(os.path.join(repo))
+    assert r.root == os.path.abspath(repo)
+    assert git.tracked_files(r) == ["a.txt"]
+
+
+def test_diff_cache(repo, monkeypatch):
+    assert git.diff(repo) == ""
+    rev = git.current_revision(repo)
+    assert len(rev.strip()) == 40
+
+    # Nothing has changed, so we should not need to run git again
+    def fail(*args, **kwargs):
+        raise AssertionError("git should not be run")
+
+    with monkeypatch.context() as m:
+        m.setattr(git.subprocess, "run", fail)
+        assert git.diff(repo) == ""
+        assert git.current_revision(repo) == rev
+
+    # Modifying a tracked file should invalidate the diff
+    with open(os.path.join(repo, "a.txt"), "w") as f:
+        f.write("two\n")
+    assert "+two" in git.diff(repo)
+
+    # and so should a new commit
+    run_git(repo, "commit", "-q", "-a", "-m", "second")
+    assert git.diff(repo) == ""
+    assert git.current_revision(repo) != rev
+
+
+def test_read_revision(repo, monkeypatch):
+    # the subprocess should not be needed in a normal repository
+    with monkeypatch.context() as m:
+        m.setattr(git.subprocess, "run", None)
+        rev = git.current_revision(repo)
+    assert rev == git._run_rev_parse(repo)
+
+    # packed refs
+    run_git(repo, "pack-refs", "--all")
+    assert git.read_revision(repo) == git._run_rev_parse(repo)
+
+    # detached head
+    run_git(repo, "commit", "-q", "--allow-empty", "-m", "second")
+    rev2 = git.read_revision(repo)
+    run_git(repo, "checkout", "-q", "--detach", "HEAD~1")
+    assert git.read_revision(repo) == rev
+
+    # linked worktree, where .git is a file
+    worktree = os.path.join(repo, "wt")
+    run_git(repo, "worktree", "add", "-q", "--detach", worktree, rev2.strip())
+    assert os.path.isfile(os.path.join(worktree, ".git"))
+    assert git.read_revision(worktree) == git._run_rev_parse(worktree)
+    assert git.read_revision(worktree) == rev2
+
+    # and outside a repository we fall back to git, which fails
+    with tempfile.TemporaryDirectory() as dirname:
+        assert git.read_revision(dirname) is None
+        assert git.current_revision(dirname) == "ERROR_GIT_FAIL"
+
+
+def test_diff_info(repo):
+    with open(os.path.join(repo, "a.txt"), "w") as f:
+        f.write("".join(f"line {i} \N{GREEK SMALL LETTER ALPHA}\n" for i in range(1000)))
+
+    full = git.diff_info(repo, max_bytes=None)
+    assert not full["diff_truncated"]
+    assert full["diff_size"] == len(full["diff"].encode())
+
+    # Truncated diffs still record the size and hash of the full diff
+    info = git.diff_info(repo, max_bytes=1001)
+    assert info["diff_truncated"]
+    assert len(info["diff"].encode()) <= 1001
+    assert full["diff"].startswith(info["diff"])
+    assert info["diff_size"] == full["diff_size"]
+    assert info["diff_sha256"] == full["diff_sha256"]
+
+    # diff itself is not capped unless asked
+    assert git.diff(repo) == full["diff"]
+    assert git.diff(repo, max_bytes=1001) == info["diff"]
+
+    # Compressed diffs are decoded back to the same text
+    info = git.diff_info(repo, max_bytes=None, compression="zlib")
+    assert info["diff"].startswith(git.COMPRESSED_PREFIXES["zlib"])
+    assert len(info["diff"]) < len(full["diff"])
+    assert git.decode_diff(info["diff"]) == full["diff"]
+    assert git.decode_diff(full["diff"]) == full["diff"]
+
+    with pytest.raises(ValueError):
+        git.diff_info(repo, compression="lzma")
+
+
+def test_async_cache_lookup(repo, monkeypatch):
+    import asyncio
+    import threading
+
+    # Statting the repository's files should not block the event loop
+    threads = []
+    state_signature = git.state_signature
+
+    def recording_state_signature(r):
+        threads.append(threading.current_thread())
+        return state_signature(r)
+
+    monkeypatch.setattr(git, "state_signature", recording_state_signature)
+
+    async def run():
+        first = await git.adiff_info(repo)
+        second = await git.adiff_info(repo)
+        return first, second, threading.current_thread()
+
+    first, second, loop_thread = asyncio.run(run())
+    assert first == second
+    assert threads and loop_thread not in threads
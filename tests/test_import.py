@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+# Maximum time in milliseconds that importing desc_provenance may take.
+# This leaves some room for slow machines, but not so much that a few
+# eagerly imported modules go unnoticed; it can be changed locally by
+# setting the environment variable.
+IMPORT_BUDGET_MS = float(os.environ.get("DESC_PROVENANCE_IMPORT_BUDGET_MS", 100))
+
+# Modules that should only be loaded when a feature needs them
+HEAVY_MODULES = [
+    "numpy",
+    "h5py",
+    "fitsio",
+    "ruamel.yaml",
+    "distutils",
+    "asyncio",
+    "json",
+    "sqlite3",
+    "hashlib",
+    "base64",
+    "tempfile",
+    "desc_provenance.cache",
+    "desc_provenance.pool",
+    "desc_provenance.binary",
+    "desc_provenance.trace",
+]
+
+
+def import_time_ms():
+    # Run in a fresh interpreter and report the cumulative time for the package
+    # from the -X importtime output, which is in microseconds.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import desc_provenance"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "desc_provenance":
+            return int(parts[1]) / 1000
+    raise ValueError("desc_provenance not found in import time output")
+
+
+def test_import_time():
+    # Take the best of a few runs to reduce noise
+    best = min(import_time_ms() for _ in range(3))
+    assert best < IMPORT_BUDGET_MS
+
+
+def test_lazy_imports():
+    code = (
+        "import sys, desc_provenance;"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert proc.stdout.strip() == ""
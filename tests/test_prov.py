@@ -1,10 +1,13 @@
 import tempfile
-from desc_provenance import Provenance, __version__ as lib_version, errors, utils
+import io
+import json
+from desc_provenance import Provenance, __version__ as lib_version, errors, utils, git
 from pprint import pprint
 import pytest
 import datetime
 import os
 import random
+import time
 import string
 
 
@@ -147,6 +150,412 @@ def test_fits_multiline():
         assert p["sec", "aaa"] == q["sec", "aaa"]
 
 
+def test_fits_index(monkeypatch):
+    import fitsio
+
+    p = Provenance()
+    p["sec", "multi"] = "Two households;\nboth alike in dignity, it's said  \n\nend"
+    p["sec", "long"] = "x" * 300
+    p["sec", "flag"] = True
+    p["sec", "pi"] = 3.14
+    # enough items that some keywords need HIERARCH cards
+    for i in range(120):
+        p["many", f"k{i}"] = i
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.fits")
+        p.write(fname)
+        q = Provenance()
+        q.read(fname)
+
+        # Single items should be found from the index without opening
+        # the file with CFITSIO, and reading only a few blocks
+        def fail(*args, **kwargs):
+            raise AssertionError("file should not be opened with CFITSIO")
+
+        reads = []
+
+        class CountingFile(io.FileIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        def counting_open(name, mode="r", *args, **kwargs):
+            return CountingFile(name, mode)
+
+        with monkeypatch.context() as m:
+            m.setattr(fitsio.FITS, "__init__", fail)
+            m.setattr("builtins.open", counting_open)
+            assert Provenance.get(fname, "many", "k100") == 100
+            assert len(reads) <= 4 and all(size <= 2880 for size in reads)
+            for (section, key), value in q.provenance.items():
+                assert Provenance.get(fname, section, key) == value
+            with pytest.raises(errors.ProvenanceMissingItem):
+                Provenance.get(fname, "sec", "missing")
+
+        # If the header is changed the index is out of date, and we fall back
+        # to searching the header
+        with fitsio.FITS(fname, "rw") as f:
+            f["provenance"].write_key("VAL1", "short")
+        assert Provenance.get(fname, "sec", "long") == "short"
+        assert Provenance.get(fname, "many", "k100") == 100
+
+        # Files without an index can still be read
+        fname = os.path.join(dirname, "old.fits")
+        with fitsio.FITS(fname, "rw") as f:
+            f.create_image_hdu(extname="provenance")
+            f.update_hdu_list()
+            ext = f["provenance"]
+            for i, (key, value) in enumerate([("aaa", 1), ("bbb", "xyz")]):
+                ext.write_key(f"SEC{i}", "sec")
+                ext.write_key(f"KEY{i}", key)
+                ext.write_key(f"VAL{i}", value)
+        assert Provenance.get(fname, "sec", "bbb") == "xyz"
+        with pytest.raises(errors.ProvenanceMissingItem):
+            Provenance.get(fname, "sec", "ccc")
+
+
+def test_fits_write_existing(monkeypatch):
+    import fitsio
+    import numpy as np
+
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+    p["sec", "pi"] = 3.14
+    # Quotes have to be doubled in FITS and must not be split
+    # across continuation cards, wherever they fall
+    for i in range(4):
+        p["quotes", f"q{i}"] = "x" * i + "'" * 150
+        p["quotes", f"m{i}"] = "x" * i + "a'b" * 50
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.fits")
+        image = np.arange(100.0)
+        with fitsio.FITS(fname, "rw") as f:
+            f.write(image)
+
+        p.write(fname)
+
+        with fitsio.FITS(fname) as f:
+            # The image is untouched and the provenance is in an extension
+            assert np.all(f[0].read() == image)
+            hdr = f["provenance"].read_header()
+            assert hdr["PROVVER"] == 3
+
+        q = Provenance()
+        q.read(fname)
+        del q["base", "file_id"]
+        assert q.provenance == p.provenance
+
+        # and writing again updates the existing values
+        p["sec", "pi"] = 3.0
+        p.write(fname)
+        assert Provenance.get(fname, "sec", "pi") == 3.0
+        assert Provenance.get(fname, "quotes", "q1") == "x" + "'" * 150
+
+        # The extension is found by skipping over the image data, without
+        # opening the file with CFITSIO
+        fname = os.path.join(dirname, "image.fits")
+        image = np.arange(3000.0).reshape(30, 100)
+        with fitsio.FITS(fname, "rw") as f:
+            f.write(image)
+            f.write(np.arange(10), extname="other")
+        p.write(fname)
+        with monkeypatch.context() as m:
+            m.setattr(fitsio.FITS, "__init__", None)
+            with open(fname, "rb") as f:
+                assert utils.find_fits_extension(f, "other") is not None
+                assert utils.find_fits_extension(f, "missing") is None
+            assert Provenance.get(fname, "sec", "pi") == 3.0
+            assert Provenance.get(fname, "quotes", "m3") == "xxx" + "a'b" * 50
+
+        # Versions of fitsio where raw cards can't be written use the
+        # public methods instead
+        monkeypatch.setattr(utils, "can_write_fits_cards", lambda f: False)
+        p.comments.append("a comment")
+        fname = os.path.join(dirname, "public.fits")
+        p.write(fname)
+        q = Provenance()
+        q.read(fname)
+        del q["base", "file_id"]
+        assert q.provenance == p.provenance
+        assert q.comments == ["a comment"]
+        assert Provenance.get(fname, "quotes", "m2") == "xxa'b" + "a'b" * 49
+
+
+def test_hdf_compact():
+    import h5py
+
+    p = Provenance()
+    p.hdf_layout = "compact"
+    p["sec", "aaa"] = "xxx"
+    p["sec", "bbb"] = 123
+    p["sec", "ccc"] = 3.14
+    p["sec", "ddd"] = True
+    p["other", "eee"] = "yyy"
+    p.comments.append("a comment")
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.hdf5")
+        p.write(fname)
+
+        # each section is a single dataset
+        with h5py.File(fname, "r") as f:
+            assert isinstance(f["provenance/sec"], h5py.Dataset)
+
+        q = Provenance()
+        q.read(fname)
+        del q["base", "file_id"]
+        assert q.provenance == p.provenance
+        assert q.comments == p.comments
+        assert Provenance.get(fname, "sec", "ccc") == 3.14
+        with pytest.raises(errors.ProvenanceMissingItem):
+            Provenance.get(fname, "sec", "zzz")
+
+        # The two layouts can be mixed in the same file
+        r = Provenance()
+        r["sec", "aaa"] = "zzz"
+        r["sec", "fff"] = 4
+        r.write(fname)
+        assert Provenance.get(fname, "sec", "aaa") == "zzz"
+        assert Provenance.get(fname, "sec", "bbb") == 123
+
+        r.hdf_layout = "compact"
+        r["new", "ggg"] = 5
+        r.write(fname)
+        q = Provenance()
+        q.read(fname)
+        assert q["sec", "aaa"] == "zzz"
+        assert q["sec", "fff"] == 4
+        assert q["sec", "ddd"] is True
+        assert q["new", "ggg"] == 5
+
+        r.hdf_layout = "bad"
+        with pytest.raises(ValueError):
+            r.write(fname)
+
+
+def test_hdf_pool(monkeypatch):
+    import h5py
+    import subprocess
+    import sys
+    import threading
+
+    opened = []
+    h5py_file = h5py.File
+
+    def counting_file(name, mode="r", *args, **kwargs):
+        opened.append((name, mode))
+        return h5py_file(name, mode, *args, **kwargs)
+
+    monkeypatch.setattr(h5py, "File", counting_file)
+
+    p = Provenance()
+    p["sec", "aaa"] = 1
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.hdf5")
+        p.write(fname)
+        pool = Provenance.enable_hdf_pool(max_handles=2)
+        try:
+            opened.clear()
+            assert Provenance.get(fname, "sec", "aaa") == 1
+            q = Provenance()
+            q.read(fname)
+            assert q["sec", "aaa"] == 1
+            # Only opened the first time
+            assert len(opened) == 1
+            assert len(pool) == 1
+
+            # Writing closes our handle first, and we re-open afterwards
+            p["sec", "aaa"] = 2
+            p.write(fname)
+            assert Provenance.get(fname, "sec", "aaa") == 2
+
+            # We notice if another process changes it
+            code = (
+                "import h5py, sys;"
+                "f = h5py.File(sys.argv[1], 'a');"
+                "f['provenance/sec'].attrs['aaa'] = int(sys.argv[2]);"
+                "f.close()"
+            )
+            subprocess.run([sys.executable, "-c", code, fname, "3"], check=True)
+            assert Provenance.get(fname, "sec", "aaa") == 3
+
+            # If the file changes while its old handle is in use, other
+            # threads wait for it to be finished with before re-opening it,
+            # since they would otherwise see the old contents
+            results = []
+            with pool.open(fname):
+                subprocess.run([sys.executable, "-c", code, fname, "4"], check=True)
+                thread = threading.Thread(
+                    target=lambda: results.append(Provenance.get(fname, "sec", "aaa"))
+                )
+                thread.start()
+                thread.join(0.2)
+                assert thread.is_alive()
+                # This thread carries on with the handle it has
+                assert Provenance.get(fname, "sec", "aaa") == 3
+            thread.join()
+            assert results == [4]
+
+            # The pool is bounded
+            for i in range(3):
+                other = os.path.join(dirname, f"test{i}.hdf5")
+                p.write(other)
+                Provenance.get(other, "sec", "aaa")
+            assert len(pool) == 2
+
+            pool.close_all()
+            assert len(pool) == 0
+        finally:
+            Provenance.disable_hdf_pool()
+
+
+def test_yaml_modes():
+    p = Provenance()
+    p["sec", "zzz"] = 1.5
+    p["sec", "aaa"] = "xxx"
+
+    with tempfile.TemporaryDirectory() as dirname:
+        # Comments in existing files are always preserved
+        fname = os.path.join(dirname, "config.yml")
+        with open(fname, "w") as f:
+            f.write("# a comment\nalpha: 1  # another\n")
+        p.write(fname)
+        with open(fname) as f:
+            text = f.read()
+        assert text.startswith("# a comment\nalpha: 1  # another\n")
+        assert Provenance.get(fname, "sec", "aaa") == "xxx"
+
+        # Provenance-only files are written in safe mode, keeping the
+        # original order
+        fname = os.path.join(dirname, "prov.yml")
+        p.write(fname)
+        p.write(fname)
+        with open(fname) as f:
+            text = f.read()
+        assert text.index("zzz") < text.index("aaa")
+
+        q = Provenance()
+        q.read(fname)
+        assert type(q["sec", "zzz"]) is float
+
+        # Round-trip mode can still be used for everything
+        Provenance.yaml_round_trip = True
+        try:
+            q = Provenance()
+            q.read(fname)
+            assert type(q["sec", "zzz"]) is not float
+            assert q["sec", "zzz"] == 1.5
+        finally:
+            Provenance.yaml_round_trip = False
+
+        # Files with custom tags can't be loaded in safe mode, so are
+        # read in round-trip mode instead
+        fname = os.path.join(dirname, "tagged.yml")
+        with open(fname, "w") as f:
+            f.write("other: !custom tagged\n")
+        p.write(fname)
+        assert Provenance.get(fname, "sec", "aaa") == "xxx"
+        q = Provenance()
+        q.read(fname)
+        assert q["sec", "zzz"] == 1.5
+        with open(fname) as f:
+            assert f.read().startswith("other: !custom tagged\n")
+
+
+def test_yaml_streaming_get(monkeypatch):
+    from ruamel.yaml.constructor import SafeConstructor
+
+    text = "catalog:\n"
+    text += "".join(f"  - {{id: {i}, name: obj{i}}}\n" for i in range(100))
+    text += "other: &anchor [1, 2]\n"
+    text += "provenance:\n  sec:\n    aaa: 1.5\n    bbb: [1, {c: 2}]\n    ccc: *anchor\n"
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.yml")
+        with open(fname, "w") as f:
+            f.write(text)
+
+        # Only the value we want should be constructed
+        calls = []
+        construct_object = SafeConstructor.construct_object
+
+        def counting_construct_object(self, node, deep=False):
+            calls.append(node)
+            return construct_object(self, node, deep=deep)
+
+        with monkeypatch.context() as m:
+            m.setattr(SafeConstructor, "construct_object", counting_construct_object)
+            assert Provenance.get(fname, "sec", "aaa") == 1.5
+            assert len(calls) == 1
+
+        assert Provenance.get(fname, "sec", "bbb") == [1, {"c": 2}]
+        # Aliases to elsewhere in the file need the whole file
+        assert Provenance.get(fname, "sec", "ccc") == [1, 2]
+
+        with pytest.raises(errors.ProvenanceMissingItem):
+            Provenance.get(fname, "sec", "ddd")
+        with pytest.raises(errors.ProvenanceMissingItem):
+            Provenance.get(fname, "nope", "aaa")
+
+
+def test_pickle(monkeypatch):
+    import pickle
+
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+    p["sec", "bbb"] = 123
+    p.comments.append("a comment")
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.pkl")
+        # Some existing data in the file
+        with open(fname, "wb") as f:
+            pickle.dump(list(range(1000)), f)
+            pickle.dump({"more": "data"}, f)
+
+        p.write(fname)
+
+        # The provenance should be found without loading the data before it
+        load = pickle.load
+
+        def checking_load(f, *args, **kwargs):
+            obj = load(f, *args, **kwargs)
+            assert not isinstance(obj, (dict, list)) or "provenance_dump" in obj
+            return obj
+
+        with monkeypatch.context() as m:
+            m.setattr(pickle, "load", checking_load)
+            assert Provenance.get(fname, "sec", "bbb") == 123
+            q = Provenance()
+            q.read(fname)
+        del q["base", "file_id"]
+        assert q.provenance == p.provenance
+        assert q.comments == p.comments
+
+        # The file can still be read object by object
+        objects = []
+        with open(fname, "rb") as f:
+            while True:
+                try:
+                    objects.append(pickle.load(f))
+                except EOFError:
+                    break
+        assert objects[1] == {"more": "data"}
+        assert objects[2][0] == "provenance_dump"
+
+        # Older files without the trailer are searched instead
+        fname = os.path.join(dirname, "old.pkl")
+        with open(fname, "wb") as f:
+            pickle.dump({"some": "data"}, f)
+            pickle.dump(["provenance_dump", {("sec", "ccc"): 4}, []], f)
+        assert Provenance.get(fname, "sec", "ccc") == 4
+        with pytest.raises(errors.ProvenanceMissingItem):
+            Provenance.get(fname, "sec", "ddd")
+
+
 def test_existing_hdf():
     import h5py
 
@@ -221,11 +630,105 @@ def test_yml():
         assert q["base", "process_id"] == q["base", "process_id"]
 
 
+def test_prov(monkeypatch):
+    from desc_provenance import binary
+
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+    p["sec", "bbb"] = 123
+    p["sec", "ccc"] = 1.5
+    p["sec", "ddd"] = True
+    p["sec", "eee"] = None
+    p["other", "fff"] = [1, 2, 3]
+    p["other", "ggg"] = "caf\u00e9\nline two"
+    p.comments.append("a comment")
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.prov")
+        p.write(fname)
+
+        q = Provenance()
+        q.read(fname)
+        del q["base", "file_id"]
+        assert q.provenance == p.provenance
+        assert q.comments == p.comments
+
+        # Single items should be found without decoding everything
+        with monkeypatch.context() as m:
+            m.setattr(binary.ProvReader, "items", None)
+            for (section, key), value in p.provenance.items():
+                assert Provenance.get(fname, section, key) == value
+            with pytest.raises(errors.ProvenanceMissingItem):
+                Provenance.get(fname, "sec", "zzz")
+
+        with Provenance.open(fname) as v:
+            assert v["other", "fff"] == [1, 2, 3]
+
+        # Numpy scalars are stored as the matching Python types
+        np = pytest.importorskip("numpy")
+        r = Provenance()
+        r["np", "true"] = np.True_
+        r["np", "false"] = np.bool_(False)
+        r["np", "int"] = np.int32(7)
+        r["np", "float"] = np.float64(2.5)
+        r.write_prov(fname)
+        expected = {"true": True, "false": False, "int": 7, "float": 2.5}
+        for key, value in expected.items():
+            v = Provenance.get(fname, "np", key)
+            assert v == value and type(v) is type(value)
+
+        # Open files work too
+        buf = io.BytesIO()
+        p.write_prov(buf)
+        assert Provenance.get_prov(io.BytesIO(buf.getvalue()), "sec", "bbb") == 123
+
+        fname = os.path.join(dirname, "bad.prov")
+        with open(fname, "wb") as f:
+            f.write(b"not a provenance file" * 10)
+        with pytest.raises(errors.ProvenanceFileSchemeUnsupported):
+            Provenance.get(fname, "sec", "aaa")
+
+        # Truncated files are reported in the same way
+        data = buf.getvalue()
+        with open(fname, "wb") as f:
+            f.write(data[: len(data) // 2])
+        with pytest.raises(errors.ProvenanceFileSchemeUnsupported):
+            Provenance.get(fname, "sec", "aaa")
+        with pytest.raises(errors.ProvenanceFileSchemeUnsupported):
+            Provenance().read(fname)
+
+        # Files are replaced through a temporary file, which is not left
+        # behind, and get the usual permissions
+        fname = os.path.join(dirname, "test.prov")
+        p.write(fname)
+        assert sorted(os.listdir(dirname)) == ["bad.prov", "test.prov"]
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(fname).st_mode & 0o777 == 0o666 & ~umask
+
+
 def test_write_fails():
     p = Provenance()
     p.generate()
     with pytest.raises(errors.ProvenanceFileTypeUnknown):
-        p.write("test.xyz")
+        with io.BytesIO() as f:
+            p.write(f, suffix=".xyz")
+
+
+def test_write_sidecar():
+    p = Provenance()
+    p["sec", "key"] = "value"
+    with tempfile.TemporaryDirectory() as dirname:
+        # Other file types get a .prov file alongside them
+        fname = os.path.join(dirname, "test.xyz")
+        p.write(fname)
+        sidecar = fname + ".provenance.prov"
+        assert Provenance.get(sidecar, "sec", "key") == "value"
+
+        # and directories get one inside them
+        p.write(dirname)
+        sidecar = os.path.join(dirname, "provenance.prov")
+        assert Provenance.get(sidecar, "sec", "key") == "value"
 
 
 def test_long():
@@ -267,6 +770,556 @@ def test_comments():
                 assert c in q.comments
 
 
+def test_async():
+    import asyncio
+
+    p = Provenance()
+    p.generate(user_config={"xxx": 1})
+
+    async def run(fname):
+        q = Provenance()
+        await q.agenerate(user_config={"xxx": 1})
+        await q.awrite(fname)
+        r = Provenance()
+        await r.aread(fname)
+        value = await Provenance.aget(fname, "config", "xxx")
+        return q, r, value
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.yml")
+        q, r, value = asyncio.run(run(fname))
+
+    # The same things should be collected in the same order
+    assert list(p.provenance) == list(q.provenance)
+    assert p["git", "head"] == q["git", "head"]
+    assert p["git", "diff"] == q["git", "diff"]
+    assert r["base", "process_id"] == q["base", "process_id"]
+    assert value == 1
+
+
+def test_compressed_diff():
+    p = Provenance()
+    p.generate()
+
+    # make a compressed diff to store
+    capture = git.DiffCapture(compression="zlib")
+    capture.update(b"+new line\n")
+    for key, value in capture.finish().items():
+        p["git", key] = value
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.hdf5")
+        p.write(fname)
+
+        # The compressed form is kept in the file, but decoded on access
+        q = Provenance()
+        q.read(fname)
+        assert q.provenance["git", "diff"].startswith("ZLIB+BASE64:")
+        assert q["git", "diff"] == "+new line\n"
+        assert Provenance.get(fname, "git", "diff") == "+new line\n"
+        assert q["git", "diff_size"] == 10
+
+
+@pytest.mark.parametrize("file_type", ["hdf", "fits", "yml"])
+def test_open(file_type):
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+    p["sec", "bbb"] = 123
+    p["other", "ccc"] = 3.14
+    p.add_comment("a comment")
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, f"test.{file_type}")
+        p.write(fname)
+
+        with Provenance.open(fname) as view:
+            assert view.get_many([("sec", "bbb"), ("other", "ccc")]) == [123, 3.14]
+            assert view["sec", "aaa"] == "xxx"
+            assert view.section("sec") == {"aaa": "xxx", "bbb": 123}
+            assert set(view.sections()) >= {"sec", "other", "base"}
+            assert ("other", "ccc") in view
+            assert view.get(("sec", "zzz")) is None
+            assert view.get_many([("sec", "zzz")], default=0) == [0]
+            with pytest.raises(errors.ProvenanceMissingItem):
+                view.get_many([("sec", "zzz")])
+            with pytest.raises(errors.ProvenanceMissingSection):
+                view.section("zzz")
+            assert "a comment" in view.comments
+            assert len(view) == len(p.provenance) + 1
+
+
+def test_open_lazy(monkeypatch):
+    import fitsio
+
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+    p["sec", "bbb"] = 123
+
+    def fail(*args, **kwargs):
+        raise AssertionError("should not be read in full")
+
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.yml")
+        p.write(fname)
+        with monkeypatch.context() as m:
+            # Nothing is read when a view is opened
+            m.setattr(Provenance, "_read_get_yaml", fail)
+            view = Provenance.open(fname)
+        assert view["sec", "bbb"] == 123
+        view.close()
+
+        # Items in FITS files are read from the index
+        fname = os.path.join(dirname, "test.fits")
+        p.write(fname)
+        with Provenance.open(fname) as view:
+            with monkeypatch.context() as m:
+                m.setattr(fitsio.hdu.base.HDUBase, "read_header", fail)
+                assert view.get_many([("sec", "aaa"), ("sec", "bbb")]) == ["xxx", 123]
+                assert view.get(("sec", "zzz")) is None
+            assert view.section("sec") == {"aaa": "xxx", "bbb": 123}
+
+
+def test_add_input_files(monkeypatch):
+    import subprocess
+    import sys
+
+    p = Provenance()
+    p["sec", "aaa"] = "xxx"
+
+    with tempfile.TemporaryDirectory() as dirname:
+        names = [f"tag{i}" for i in range(5)]
+        input_files = {}
+        for name in names:
+            input_files[name] = os.path.join(dirname, f"{name}.yml")
+            p.write(input_files[name])
+        input_files["missing"] = os.path.join(dirname, "missing.yml")
+        input_files["slow"] = os.path.join(dirname, "slow.yml")
+
+        # Make one of the files very slow to read
+        get = Provenance.get.__func__
+
+        def slow_get(cls, path, section, key):
+            if path.endswith("slow.yml"):
+                time.sleep(2)
+            return get(cls, path, section, key)
+
+        monkeypatch.setattr(Provenance, "get", classmethod(slow_get))
+
+        q = Provenance()
+        q.add_input_files(input_files, max_workers=3, timeout=0.5)
+
+        # Recorded in the same order as given
+        assert [k for s, k in q.provenance if s == "input_path"] == list(input_files)
+
+        for name in names:
+            assert q["input_id", name] != "UNKNOWN"
+            assert ("input_error", name) not in q.provenance
+
+        # and the reasons for unknown IDs are recorded
+        assert q["input_id", "missing"] == "UNKNOWN"
+        assert q["input_error", "missing"].startswith("ProvenanceMissingFile")
+        assert q["input_id", "slow"] == "UNKNOWN"
+        assert q["input_error", "slow"].startswith("TimeoutError")
+
+    # Threads stuck on a file don't stop the interpreter from exiting
+    script = """
+import threading
+from desc_provenance import Provenance
+
+Provenance._find_input_id = lambda self, path: threading.Event().wait()
+p = Provenance()
+p.add_input_files({"a": "a.yml", "b": "b.yml"}, timeout=0.1)
+print(p["input_error", "a"])
+"""
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, timeout=30
+    )
+    assert result.stdout.startswith("TimeoutError")
+
+
+def test_cache(monkeypatch):
+    from desc_provenance import cache
+
+    p = Provenance()
+    p.generate()
+    p["a", "b"] = 12
+
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, "test.yml")
+        p.write(filename)
+        c = Provenance.enable_cache(sqlite_path=os.path.join(dirname, "cache.db"))
+        try:
+            assert Provenance.get(filename, "a", "b") == 12
+            q = Provenance()
+            q.read(filename)
+            assert q["a", "b"] == 12
+
+            # Now everything should come from memory, without opening the file
+            def fail(*args, **kwargs):
+                raise AssertionError("file should not be read")
+
+            with monkeypatch.context() as m:
+                m.setattr(Provenance, "_read_get_yaml", classmethod(fail))
+                assert Provenance.get(filename, "a", "b") == 12
+                with pytest.raises(errors.ProvenanceMissingItem):
+                    Provenance.get(filename, "a", "c")
+
+                # or from the database, in a new cache
+                c.memory.clear()
+                assert Provenance.get(filename, "a", "b") == 12
+
+            # Re-writing the file should invalidate the cache
+            p["a", "b"] = 13
+            p.write(filename)
+            assert Provenance.get(filename, "a", "b") == 13
+
+            # and so should changing it some other way
+            with open(filename, "a") as f:
+                f.write("\n")
+            c.memory.clear()
+            with monkeypatch.context() as m:
+                m.setattr(Provenance, "_read_get_yaml", classmethod(fail))
+                with pytest.raises(AssertionError):
+                    Provenance.get(filename, "a", "b")
+        finally:
+            Provenance.disable_cache()
+    assert cache.active() is None
+
+
+def test_cache_values(monkeypatch):
+    import numpy as np
+    from desc_provenance import cache
+
+    p = Provenance()
+    p["a", "bytes"] = b"xyz"
+    p["a", "array"] = np.arange(3)
+    p["a", "int"] = np.int64(3)
+
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, "test.pkl")
+        p.write(filename)
+        c = Provenance.enable_cache(sqlite_path=os.path.join(dirname, "cache.db"))
+        try:
+            q = Provenance()
+            q.read(filename)
+            # Values that can't be stored exactly are left out of the database
+            c.memory.clear()
+            assert Provenance.get(filename, "a", "bytes") == b"xyz"
+            assert len(c.memory) == 1
+            c.memory.clear()
+            value = Provenance.get(filename, "a", "array")
+            assert isinstance(value, np.ndarray) and list(value) == [0, 1, 2]
+        finally:
+            Provenance.disable_cache()
+
+    # Memory use is limited by the size of what is stored
+    m = cache.MemoryCache(max_bytes=10000)
+    for i in range(10):
+        m.put((f"file{i}",), cache._Entry({("a", "b"): "x" * 2000}, [], True))
+    assert 1 < len(m) < 10
+    assert m.get(("file9",)) is not None
+    assert m.get(("file0",)) is None
+
+    # Reading from the database only writes to it now and then
+    with tempfile.TemporaryDirectory() as dirname:
+        db = cache.SQLiteCache(os.path.join(dirname, "cache.db"))
+        signature = ("file", 1, 2, 3, 4)
+        db.put(signature, cache._Entry({("a", "b"): 1}, [], True))
+        touched = []
+        with monkeypatch.context() as m:
+            m.setattr(db, "_touch", lambda *args: touched.append(args[1]))
+            assert db.get(signature).items == {("a", "b"): 1}
+            assert touched == []
+            m.setattr(db, "access_interval", -1)
+            db.get(signature)
+            assert touched == ["file"]
+        db.access_interval = -1
+        assert db.get(signature).complete
+
+
+def test_ancestry(monkeypatch):
+    from desc_provenance import lineage
+
+    with tempfile.TemporaryDirectory() as dirname:
+        paths = {name: os.path.join(dirname, f"{name}.prov") for name in "abcd"}
+
+        def make(name, inputs):
+            p = Provenance()
+            for i in inputs:
+                p.add_input_file(i, paths[i])
+            p.write(paths[name])
+            return Provenance.get(paths[name], "base", "file_id")
+
+        # d is used by both b and c
+        ids = {}
+        ids["d"] = make("d", [])
+        ids["b"] = make("b", ["d"])
+        ids["c"] = make("c", ["d"])
+        ids["a"] = make("a", ["b", "c"])
+
+        read_links = lineage.read_links
+        reads = []
+
+        def counting_read_links(path):
+            reads.append(path)
+            return read_links(path)
+
+        monkeypatch.setattr(lineage, "read_links", counting_read_links)
+
+        paths = {name: os.path.realpath(path) for name, path in paths.items()}
+        g = Provenance.ancestry(paths["a"])
+        assert sorted(reads) == sorted(paths.values())
+        assert g.root == paths["a"]
+        assert {n.path: n.depth for n in g.nodes.values()} == {
+            paths["a"]: 0,
+            paths["b"]: 1,
+            paths["c"]: 1,
+            paths["d"]: 2,
+        }
+        assert len(g.edges) == 4
+        assert all(e.status == lineage.verified for e in g.edges)
+        assert [e.parent for e in g.parents(paths["b"])] == [paths["d"]]
+        assert g.cycles == []
+
+        g = Provenance.ancestry(paths["a"], max_depth=1, max_workers=1)
+        assert paths["d"] not in g
+        assert not g.nodes[paths["b"]].expanded
+
+        # Overwriting an input, making a loop back to a descendant
+        make("d", ["a"])
+        g = Provenance.ancestry(paths["a"])
+        mismatches = g.mismatches()
+        assert len(mismatches) == 2
+        assert all(e.parent == paths["d"] for e in mismatches)
+        assert all(e.recorded_id == ids["d"] for e in mismatches)
+        assert len(g.cycles) == 1
+        assert g.cycles[0].child == paths["d"]
+        assert g.cycles[0].status == lineage.verified
+
+        # Missing inputs
+        os.remove(paths["c"])
+        g = Provenance.ancestry(paths["a"])
+        (edge,) = [e for e in g.edges if e.parent == paths["c"]]
+        assert edge.status == lineage.missing
+
+
+def test_record():
+    from desc_provenance.record import ProvenanceRecord, Interner
+
+    with tempfile.TemporaryDirectory() as dirname:
+        p = Provenance()
+        p["git", "head"] = "abc123"
+        p["sec", "flag"] = True
+        p["sec", "one"] = 1
+        p["sec", "list"] = [1, 2]
+        p.comments.append("a comment")
+
+        interner = Interner()
+        records = []
+        for i in range(3):
+            fname = os.path.join(dirname, f"test{i}.prov")
+            p.write(fname)
+            records.append(Provenance.read_record(fname, interner))
+
+        r = records[0]
+        assert r["git", "head"] == "abc123"
+        assert r["sec", "flag"] is True
+        assert r["sec", "one"] == 1 and r["sec", "one"] is not True
+        assert r["sec", "list"] == [1, 2]
+        assert ("sec", "one") in r
+        assert r.get(("sec", "missing")) is None
+        with pytest.raises(KeyError):
+            r["sec", "missing"]
+        assert r.comments == ["a comment"]
+        assert len(r) == 5
+        assert dict(r) == {**p.provenance, ("base", "file_id"): r["base", "file_id"]}
+
+        # Keys and equal values are shared between records
+        assert records[1]._layout is r._layout
+        i = r._layout.index["git", "head"]
+        assert records[1]._values[i] is r._values[i]
+        assert records[1]["base", "file_id"] != r["base", "file_id"]
+        # Values that differ between files are not kept by the interner
+        assert (str, r["base", "file_id"]) not in interner._values
+
+        # Full interners stop storing new values
+        small = Interner(max_values=2)
+        items = {("a", "b"): "x", ("a", "c"): "y", ("a", "d"): "z"}
+        record = ProvenanceRecord(items, interner=small)
+        assert len(small) == 2
+        assert record["a", "d"] == "z"
+
+        q = r.to_provenance()
+        assert q.provenance == dict(r)
+        assert q.comments == r.comments
+
+
+def test_copy():
+    p = Provenance()
+    p["sec", "a"] = 1
+    p["sec", "b"] = 2
+    p["git", "diff"] = "x" * 100000
+    p.comments.append("a comment")
+
+    q = p.copy()
+    assert q.provenance == p.provenance
+    # The original is left as it was
+    assert type(p.provenance) is dict
+    # The values are shared, not copied
+    assert q.provenance["git", "diff"] is p.provenance["git", "diff"]
+
+    # Changes to either do not affect the other
+    q["sec", "a"] = 10
+    q["sec", "c"] = 3
+    del q["sec", "b"]
+    q.comments.append("another")
+    p["sec", "d"] = 4
+    assert p.provenance == {
+        ("sec", "a"): 1,
+        ("sec", "b"): 2,
+        ("git", "diff"): "x" * 100000,
+        ("sec", "d"): 4,
+    }
+    assert list(q.provenance.items()) == [
+        (("sec", "a"), 10),
+        (("git", "diff"), "x" * 100000),
+        (("sec", "c"), 3),
+    ]
+    assert p.comments == ["a comment"]
+    assert type(p.provenance) is dict
+
+    # Deleting and setting again moves an item to the end, as in a dict
+    r = q.copy()
+    del r["sec", "a"]
+    r["sec", "a"] = 5
+    assert list(r.provenance) == [("git", "diff"), ("sec", "c"), ("sec", "a")]
+    assert len(r.provenance) == 3
+    assert ("sec", "b") not in r.provenance
+    with pytest.raises(KeyError):
+        del r["sec", "b"]
+    assert q["sec", "a"] == 10
+
+    # Copies made in between changes share one snapshot of the items,
+    # rather than each storing its own
+    q1 = p.copy()
+    q2 = p.copy()
+    assert q1.provenance._base is q2.provenance._base
+    assert type(p.provenance) is dict
+    p["sec", "e"] = 5
+    q3 = p.copy()
+    assert q3.provenance._base is not q1.provenance._base
+    assert q3["sec", "e"] == 5
+    assert ("sec", "e") not in q1.provenance
+
+    # Settings made on the object are kept
+    p.hdf_layout = "compact"
+    p.diff_max_bytes = 100
+    p.yaml_round_trip = True
+    q4 = p.copy()
+    assert q4.hdf_layout == "compact"
+    assert q4.diff_max_bytes == 100
+    assert q4.yaml_round_trip
+    assert q4.code_dir == p.code_dir
+
+    # Copies are written as normal
+    with tempfile.TemporaryDirectory() as dirname:
+        for suffix in ["pkl", "yml", "prov"]:
+            fname = os.path.join(dirname, f"test.{suffix}")
+            r.write(fname)
+            s = Provenance()
+            s.read(fname)
+            del s["base", "file_id"]
+            assert s.provenance == r.provenance
+
+
+def test_write_many():
+    p = Provenance()
+    p["sec", "key"] = "value"
+
+    with tempfile.TemporaryDirectory() as dirname:
+        paths = [
+            os.path.join(dirname, f"test{i}.{suffix}")
+            for i in range(10)
+            for suffix in ["hdf", "yml", "pkl", "prov"]
+        ]
+        ids = p.write_many(paths, max_workers=8)
+        assert list(ids) == paths
+        assert len(set(ids.values())) == len(paths)
+        for path, file_id in ids.items():
+            assert Provenance.get(path, "base", "file_id") == file_id
+            assert Provenance.get(path, "sec", "key") == "value"
+
+    # The object itself is not changed by writing
+    assert p.provenance == {("sec", "key"): "value"}
+
+
+def test_trace():
+    import asyncio
+    from desc_provenance import trace
+
+    p = Provenance()
+    p.generate()
+    stages = ["core", "git_diff", "git_head", "module_versions", "argv", "user_info"]
+    assert list(p.timings) == stages
+
+    spans = []
+    trace.add_hook(spans.append)
+    with tempfile.TemporaryDirectory() as dirname:
+        fname = os.path.join(dirname, "test.hdf")
+        exporter = trace.JSONLExporter(os.path.join(dirname, "trace.jsonl"))
+        trace.add_hook(exporter)
+        try:
+            p.generate()
+            p.write(fname)
+            Provenance.get(fname, "base", "user")
+            q = Provenance()
+            q.read(fname)
+            with pytest.raises(FileNotFoundError):
+                Provenance().read_prov(os.path.join(dirname, "missing.prov"))
+        finally:
+            trace.remove_hook(spans.append)
+            trace.remove_hook(exporter)
+            exporter.close()
+
+        names = [s.name for s in spans]
+        assert names == [f"generate.{stage}" for stage in stages] + [
+            "write_hdf",
+            "get_hdf",
+            "read_hdf",
+            "read_prov",
+        ]
+        assert p.timings["core"] == spans[0].duration
+
+        write, get, read, missing = spans[-4:]
+        assert write.path == get.path == read.path == fname
+        assert write.nbytes == os.path.getsize(fname)
+        # The file ID is added when writing
+        assert write.nkeys == read.nkeys == len(p.provenance) + 1
+        assert get.nkeys == 1
+        assert write.error is None
+        assert missing.error.startswith("FileNotFoundError")
+
+        with open(os.path.join(dirname, "trace.jsonl")) as f:
+            lines = [json.loads(line) for line in f]
+        assert [line["name"] for line in lines] == names
+        assert lines[-4]["nbytes"] == write.nbytes
+
+        # Nothing is traced once the hooks are removed
+        p.write_prov(os.path.join(dirname, "test.prov"))
+        assert len(spans) == len(names)
+
+    # The coroutine version times the same stages, some at the same time
+    spans.clear()
+    trace.add_hook(spans.append)
+    try:
+        q = Provenance()
+        asyncio.run(q.agenerate())
+    finally:
+        trace.remove_hook(spans.append)
+    assert set(q.timings) == set(stages)
+    assert sorted(s.name for s in spans) == sorted(f"generate.{s}" for s in stages)
+
+
 if __name__ == "__main__":
     # test_comments()
     test_long()
@@ -0,0 +1,143 @@
+import os
+import sys
+import types
+import pytest
+from desc_provenance import utils
+
+
+class CountingModule(types.ModuleType):
+    # A module that counts how often its attributes are looked up
+    lookups = 0
+
+    def __getattr__(self, name):
+        CountingModule.lookups += 1
+        if name == "__version__":
+            return "1.2.3"
+        raise AttributeError(name)
+
+
+def test_module_versions_incremental():
+    utils.find_module_versions()
+    module = CountingModule("fake_module_for_test")
+    sys.modules["fake_module_for_test"] = module
+    try:
+        assert utils.find_module_versions()["fake_module_for_test"] == "1.2.3"
+        n = CountingModule.lookups
+        assert n > 0
+
+        # The module should not be examined again
+        assert utils.find_module_versions()["fake_module_for_test"] == "1.2.3"
+        assert CountingModule.lookups == n
+    finally:
+        del sys.modules["fake_module_for_test"]
+
+    # and removed modules should be forgotten
+    assert "fake_module_for_test" not in utils.find_module_versions()
+
+
+def test_module_versions_replaced():
+    import importlib.machinery
+
+    module = types.ModuleType("fake_module_for_test")
+    module.__spec__ = importlib.machinery.ModuleSpec("fake_module_for_test", None)
+    module.__spec__._initializing = True
+    sys.modules["fake_module_for_test"] = module
+    try:
+        # Modules are looked at again until they have finished importing
+        assert "fake_module_for_test" not in utils.find_module_versions()
+        module.__version__ = "1.0"
+        del module.__spec__._initializing
+        assert utils.find_module_versions()["fake_module_for_test"] == "1.0"
+
+        # and if they are replaced
+        module = types.ModuleType("fake_module_for_test")
+        module.__version__ = "2.0"
+        sys.modules["fake_module_for_test"] = module
+        assert utils.find_module_versions()["fake_module_for_test"] == "2.0"
+    finally:
+        del sys.modules["fake_module_for_test"]
+
+
+def test_packages_distributions():
+    # importlib.metadata was added in python 3.8
+    metadata = pytest.importorskip("importlib.metadata")
+
+    packages = utils._packages_distributions(metadata)
+    assert "pytest" in packages["pytest"]
+    assert "pytest" in packages["_pytest"]
+
+
+def test_group_module_versions():
+    versions = {
+        "pkg": "1.0",
+        "pkg.sub": "1.0",
+        "pkg.other": "2.0",
+        "standalone": "3.0",
+    }
+    grouped = utils.group_module_versions(versions)
+    assert grouped == {"pkg": "1.0", "pkg.other": "2.0", "standalone": "3.0"}
+
+    # Top-level modules from the same distribution, such as pytest and _pytest,
+    # are grouped under the one named after the distribution
+    if "_pytest" in utils.module_distributions():
+        versions = {"_pytest": pytest.__version__, "pytest": pytest.__version__}
+        assert utils.group_module_versions(versions) == {"pytest": pytest.__version__}
+
+
+def test_host_name(monkeypatch):
+    import socket
+    import threading
+
+    release = threading.Event()
+
+    def slow_getfqdn():
+        release.wait(5)
+        return "slow.example.com"
+
+    monkeypatch.setattr(utils, "_host_thread", None)
+    monkeypatch.setattr(utils, "_host_result", None)
+    monkeypatch.setattr(socket, "getfqdn", slow_getfqdn)
+
+    # If the lookup is slow we fall back to the host name
+    assert utils.host_name(timeout=0.01) == (socket.gethostname(), "gethostname")
+
+    # but use the full name once it arrives
+    release.set()
+    assert utils.host_name(timeout=5) == ("slow.example.com", "getfqdn")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_host_name_fork(monkeypatch):
+    import socket
+    import threading
+
+    parent = os.getpid()
+    release = threading.Event()
+
+    def slow_getfqdn():
+        if os.getpid() == parent:
+            release.wait(5)
+        return f"{os.getpid()}.example.com"
+
+    monkeypatch.setattr(utils, "_host_thread", None)
+    monkeypatch.setattr(utils, "_host_result", None)
+    monkeypatch.setattr(socket, "getfqdn", slow_getfqdn)
+
+    # Fork while the lookup is still running in the parent
+    assert utils.host_name(timeout=0.01)[1] == "gethostname"
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child should do its own lookup
+        try:
+            name, source = utils.host_name(timeout=5)
+            os.write(write_fd, f"{name} {source}".encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    release.set()
+    utils._host_thread.join(5)
+    assert output == f"{pid}.example.com getfqdn"